@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Admission control and cancellation shared by the local AI services
+The inference schedulers reject work with Overloaded once their queue is full (HTTP 429 with
+Retry-After), and check each request's Cancellation between denoising steps / generated tokens
+so work for a client that went away, or whose deadline passed, stops early.
+"""
+
+import time
+import socket
+import concurrent.futures
+
+
+class Overloaded(Exception):
+    """The inference queue is full; retry_after is a hint in whole seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class RequestCancelled(Exception):
+    """The request's work was stopped; reason is "deadline" or "disconnected\""""
+
+    def __init__(self, reason):
+        super().__init__("Deadline exceeded" if reason == "deadline" else "Client disconnected")
+        self.reason = reason
+
+
+def client_disconnected(environ):
+    """
+    True if the client of a request has closed its connection
+    Peeks at the socket the development server exposes as 'werkzeug.socket'; servers that do
+    not expose it never report a disconnect (streaming responses still notice on write).
+    """
+    sock = environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+class Cancellation:
+    """
+    Cancellation token of one request.
+
+    Fires once its deadline passes, cancel() is called, or the optional probe (e.g. a
+    client-disconnect check) returns True. The probe is polled at most every probe_interval
+    seconds, so checking `cancelled` on every step or token stays cheap.
+    """
+
+    def __init__(self, timeout=None, probe=None, probe_interval=0.25):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self._probe = probe
+        self._probe_interval = probe_interval
+        self._next_probe = 0.0
+
+    @classmethod
+    def for_request(cls, environ, timeout=None):
+        """Token that also fires when the client of this WSGI request disconnects"""
+        return cls(timeout, probe=lambda: client_disconnected(environ))
+
+    def cancel(self, reason="disconnected"):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is not None:
+            return True
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self.reason = "deadline"
+        elif self._probe is not None and now >= self._next_probe:
+            self._next_probe = now + self._probe_interval
+            if self._probe():
+                self.reason = "disconnected"
+        return self.reason is not None
+
+    def remaining(self):
+        """Seconds left until the deadline, or None without one"""
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None
+
+    def wait_interval(self):
+        """How long a waiter may block before checking the token again (None: until done)"""
+        remaining = self.remaining()
+        if self._probe is None:
+            return remaining
+        return self._probe_interval if remaining is None else min(remaining, self._probe_interval)
+
+    def check(self):
+        """Raise RequestCancelled if the token has fired"""
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+
+def wait_result(future, cancel=None):
+    """
+    Result of a future some other thread computes (a scheduler batch, a coalesced request),
+    waited for only as long as the request's token has not fired
+    A request whose deadline passes or whose client disconnects gives up right away with
+    RequestCancelled (a scheduler worker then drops its item) instead of blocking until the
+    work running ahead of it finishes.
+    """
+    if cancel is None:
+        return future.result()
+    while True:
+        try:
+            return future.result(timeout=cancel.wait_interval())
+        except concurrent.futures.TimeoutError:
+            if future.done():
+                raise
+            if cancel.cancelled:
+                raise RequestCancelled(cancel.reason)
+
+
+def retry_after_seconds(queued, batch_size, avg_batch_seconds):
+    """Retry-After hint: time for the batches ahead of a new request to drain"""
+    batches_ahead = queued // max(1, batch_size) + 1
+    return max(1, int(round(batches_ahead * (avg_batch_seconds or 1.0))))
+
+
+def error_response(error):
+    """Flask response for Overloaded (429 + Retry-After) or RequestCancelled (504 deadline, 499 client gone)"""
+    from flask import jsonify
+
+    if isinstance(error, Overloaded):
+        return (jsonify({"error": str(error), "retry_after": error.retry_after}), 429,
+                {"Retry-After": str(error.retry_after)})
+    return jsonify({"error": str(error), "cancelled": error.reason}), 504 if error.reason == "deadline" else 499
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Offline per-stage benchmark for the image editor and recommendation services
+Runs CPU-only with tiny randomly initialized diffusers/transformers models - no downloads.
+Times every stage separately and writes machine-readable results (JSON).
+
+Usage:
+    python benchmark_services.py                              # run both suites, write benchmark_results.json
+    python benchmark_services.py --suite image --repeat 10
+    python benchmark_services.py --output new.json --compare baseline.json --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import io
+import argparse
+import contextlib
+import platform
+import statistics
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+SAMPLE_USER = {
+    "faceShape": "oval",
+    "skinTone": {"label": "medium", "value": "medium"},
+    "hairLength": "medium",
+    "hairType": "wavy",
+    "stylePreferences": ["modern", "low-maintenance"],
+}
+
+SAMPLE_RESPONSE = json.dumps([
+    {"id": 3, "name": "Textured Lob", "matchScore": 94,
+     "whyRecommendation": "A textured lob balances an oval face and works with natural waves. "
+                          "It is modern and needs little daily styling."},
+    {"id": 7, "name": "Curtain Bangs", "matchScore": 88,
+     "whyRecommendation": "Curtain bangs frame the face softly. They grow out gracefully."},
+    {"id": 12, "name": "Layered Shag", "matchScore": 85,
+     "whyRecommendation": "Layers add movement to wavy hair while keeping the length."},
+], indent=2)
+
+
+def sample_catalog(size=40):
+    """Synthetic hairstyle catalog shaped like the kiosk's hairstyleOptions"""
+    categories = ["short", "medium", "long"]
+    hair_types = ["straight", "wavy", "curly", "coily"]
+    tags = ["modern", "classic", "low-maintenance", "bold", "elegant", "casual", "layered", "textured"]
+    return [
+        {
+            "id": i,
+            "name": f"Style {i}",
+            "category": categories[i % len(categories)],
+            "hairType": hair_types[i % len(hair_types)],
+            "styleTags": [tags[i % len(tags)], tags[(i * 3 + 1) % len(tags)]],
+        }
+        for i in range(size)
+    ]
+
+
+def sample_image_base64(size):
+    """Noisy RGB test image encoded the way the kiosk sends it (PNG data URL)"""
+    torch.manual_seed(0)
+    pixels = torch.randint(0, 256, (size[1], size[0], 3), dtype=torch.uint8).numpy()
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+class StageTimer:
+    """Collects wall-clock samples per named stage"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.samples.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+    def add(self, name, ms):
+        self.samples.setdefault(name, []).append(ms)
+
+    def summary(self, warmup=0):
+        results = {}
+        for name, values in self.samples.items():
+            values = values[warmup:] or values
+            ordered = sorted(values)
+            results[name] = {
+                "runs": len(values),
+                "mean_ms": round(statistics.fmean(values), 4),
+                "median_ms": round(statistics.median(values), 4),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+                "min_ms": round(ordered[0], 4),
+            }
+        return results
+
+
+def build_tiny_clip_tokenizer(directory):
+    """Byte-level CLIP tokenizer with no merges (one token per byte) written to directory"""
+    from tokenizers import pre_tokenizers
+    from transformers import CLIPTokenizer
+
+    # Same 256 byte-to-unicode symbols CLIP's byte-level BPE uses
+    symbols = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {}
+    for symbol in symbols + [s + "</w>" for s in symbols]:
+        vocab[symbol] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_img2img_pipeline():
+    """Randomly initialized StableDiffusionImg2ImgPipeline small enough to run on any CPU"""
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionImg2ImgPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    # Four blocks so latents are 1/8 of the image size, like the real SD VAE
+    vae = AutoencoderKL(
+        block_out_channels=[32, 32, 64, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        latent_channels=4,
+        norm_num_groups=16,
+    )
+    tokenizer = build_tiny_clip_tokenizer(tempfile.mkdtemp(prefix="bench-clip-"))
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=len(tokenizer),
+    ))
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                              clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+    pipe = StableDiffusionImg2ImgPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def build_tiny_causal_lm():
+    """Randomly initialized Phi-3 style causal LM (Llama fallback) with a byte-level tokenizer"""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast
+
+    byte_symbols = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {symbol: i for i, symbol in enumerate(sorted(byte_symbols))}
+    vocab["<|endoftext|>"] = len(vocab)
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<|endoftext|>",
+                                        pad_token="<|endoftext|>", model_max_length=8192)
+
+    config_kwargs = dict(
+        vocab_size=len(vocab),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=8192,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(0)
+    try:
+        from transformers import Phi3Config, Phi3ForCausalLM
+        model = Phi3ForCausalLM(Phi3Config(**config_kwargs))
+    except ImportError:
+        from transformers import LlamaConfig, LlamaForCausalLM
+        model = LlamaForCausalLM(LlamaConfig(**config_kwargs))
+    model.eval()
+    return model, tokenizer
+
+
+def benchmark_image(timer, args):
+    """Stage timings for one /edit-image request path"""
+    import image_editor_service as svc
+
+    pipe = build_tiny_img2img_pipeline()
+    body = json.dumps({
+        "prompt": "short textured bob haircut, photorealistic",
+        "image": sample_image_base64((args.image_size, args.image_size)),
+        "strength": 0.6,
+        "guidance_scale": 7.5,
+        "num_inference_steps": args.steps,
+    }).encode('utf-8')
+
+    for _ in range(args.warmup + args.repeat):
+        with timer.stage("image.request_json_parse"):
+            data = json.loads(body)
+        with timer.stage("image.base64_decode"):
+            image_bytes = svc.base64_to_bytes(data["image"])
+        with timer.stage("image.image_decode"):
+            image = svc.bytes_to_image(image_bytes)
+        with timer.stage("image.resize"):
+            if max(image.size) > 1024:
+                image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+            target = svc.bucket_size(*image.size, min(512, max(image.size)))
+            image = image.resize(target, Image.Resampling.LANCZOS)
+        with timer.stage("image.text_encoding"), torch.no_grad():
+            prompt_embeds, negative_embeds = pipe.encode_prompt(
+                data["prompt"], pipe.device, num_images_per_prompt=1, do_classifier_free_guidance=True
+            )
+        with timer.stage("image.vae_encode"), torch.no_grad():
+            pixels = pipe.image_processor.preprocess(image)
+            pipe.vae.encode(pixels).latent_dist.sample()
+        pipeline_start = time.perf_counter()
+        with torch.no_grad():
+            latents = pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                image=image,
+                strength=data["strength"],
+                guidance_scale=data["guidance_scale"],
+                num_inference_steps=data["num_inference_steps"],
+                output_type="latent",
+            ).images
+        # Pipeline call minus the separately timed VAE encode is the denoising loop
+        timer.add("image.denoise", (time.perf_counter() - pipeline_start) * 1000
+                  - timer.samples["image.vae_encode"][-1])
+        with timer.stage("image.vae_decode"), torch.no_grad():
+            decoded = pipe.vae.decode(latents / pipe.vae.config.scaling_factor).sample
+            result = pipe.image_processor.postprocess(decoded, output_type="pil")[0]
+        for image_format in ("png", "webp", "jpeg"):
+            with timer.stage(f"image.encode_{image_format}"):
+                svc.image_to_base64(result, image_format)
+
+    # Aggregate throughput for N clients submitting together, with and without cross-request batching
+    model = svc.resolve_model_path()
+    for clients in args.clients:
+        for label, max_batch_size in (("batched", args.batch_size), ("serial", 1)):
+            scheduler = svc.BatchScheduler(max_batch_size, svc.BATCH_MAX_WAIT_MS)
+
+            def edit(index):
+                return scheduler.submit(
+                    pipe, prompt=data["prompt"], image=image, strength=data["strength"],
+                    guidance_scale=data["guidance_scale"], num_inference_steps=data["num_inference_steps"],
+                    seed=index, model=model, bounded=False,
+                ).result()
+
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                for _ in range(args.warmup + args.repeat):
+                    start = time.perf_counter()
+                    images = len(list(executor.map(edit, range(clients))))
+                    wall_ms = (time.perf_counter() - start) * 1000
+                    timer.add(f"image.clients_{clients}.{label}", wall_ms)
+                    timer.add(f"image.clients_{clients}.{label}.ms_per_image", wall_ms / images)
+
+
+def benchmark_recommend(timer, args):
+    """Stage timings for one /recommend request path"""
+    import recommendation_service as svc
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    model, tokenizer = build_tiny_causal_lm()
+    body = json.dumps({"userData": SAMPLE_USER, "hairstyleOptions": sample_catalog(args.catalog_size)}).encode('utf-8')
+    catalog, _ = svc.catalog_registry.put("benchmark", sample_catalog(args.catalog_size))
+    catalog.line_token_ids(tokenizer)
+
+    for _ in range(args.warmup + args.repeat):
+        with timer.stage("recommend.request_json_parse"):
+            data = json.loads(body)
+        with timer.stage("recommend.prerank"):
+            candidates, _ = svc.prerank_catalog(data["userData"], data["hairstyleOptions"])
+        with timer.stage("recommend.prompt_build"):
+            prompt_suffix = svc.build_recommendation_suffix(data["userData"], candidates)
+        with timer.stage("recommend.tokenization"):
+            tokenizer(prompt_suffix, return_tensors="pt", add_special_tokens=False)
+        # Same request against a registered catalog: no body parse of the list, prebuilt index and lines
+        with timer.stage("recommend.registered.prerank"):
+            registered_candidates, _ = svc.prerank_catalog(data["userData"], catalog.styles, index=catalog.index)
+        with timer.stage("recommend.registered.prompt_tokens"):
+            catalog.prompt_suffix(data["userData"], registered_candidates, tokenizer)
+        # Same greedy generation under each KV cache mode: full recompute, incremental, shared prefix
+        for kv_cache in ("off", "on", "prefix"):
+            generation_start = time.perf_counter()
+            new_tokens, stats = svc.generate_tokens(
+                model, tokenizer, prompt_suffix, "cpu", kv_cache=kv_cache,
+                max_new_tokens=args.max_new_tokens,
+                min_new_tokens=args.max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+            generation_ms = (time.perf_counter() - generation_start) * 1000
+            timer.add(f"recommend.generation.kv_{kv_cache}", generation_ms)
+            timer.add(f"recommend.generation_ms_per_token.kv_{kv_cache}", generation_ms / max(1, stats["new_tokens"]))
+        # Constrained decoding runs until the JSON array closes (explanations capped per object)
+        constraint = svc.RecommendationConstraint(tokenizer, candidates)
+        generation_start = time.perf_counter()
+        new_tokens, stats = svc.generate_tokens(
+            model, tokenizer, prompt_suffix, "cpu",
+            max_new_tokens=500,
+            do_sample=False,
+            pad_token_id=tokenizer.eos_token_id,
+            logits_processor=LogitsProcessorList([constraint]),
+            stopping_criteria=StoppingCriteriaList([constraint.stopping_criteria()]),
+        )
+        timer.add("recommend.generation.constrained", (time.perf_counter() - generation_start) * 1000)
+        with timer.stage("recommend.decode"):
+            response_text = tokenizer.decode(new_tokens, skip_special_tokens=True)
+        with timer.stage("recommend.json_extraction.constrained"):
+            svc.extract_recommendations_json(response_text)
+        with timer.stage("recommend.json_extraction"):
+            svc.extract_recommendations_json(SAMPLE_RESPONSE)
+        # Ranking-only mode: scorer picks, then three short explanations (one batch), then the cached case
+        with timer.stage("recommend.rank_only"):
+            _, ranked, _ = svc.rank_recommendations(data["userData"], data["hairstyleOptions"])
+        svc.explanation_cache = svc.RecommendationCache(max_entries=64)
+        with timer.stage("recommend.rank_explanations.cold"):
+            svc.explain_styles(data["userData"], ranked, model, tokenizer)
+        with timer.stage("recommend.rank_explanations.cached"):
+            svc.explain_styles(data["userData"], ranked, model, tokenizer)
+
+    # Aggregate throughput for N clients arriving together, with and without cross-request batching
+    face_shapes = ["oval", "round", "square", "heart", "diamond", "oblong", "triangle", "long"]
+    prompt_suffixes = []
+    for face_shape in face_shapes:
+        user = dict(SAMPLE_USER, faceShape=face_shape)
+        candidates, _ = svc.prerank_catalog(user, data["hairstyleOptions"])
+        prompt_suffixes.append(svc.build_recommendation_suffix(user, candidates))
+    for clients in args.clients:
+        for label, max_batch_size in (("batched", args.batch_size), ("serial", 1)):
+            scheduler = svc.GenerationScheduler(max_batch_size, svc.GENERATION_BATCH_MAX_WAIT_MS)
+            for _ in range(args.warmup + args.repeat):
+                start = time.perf_counter()
+                futures = [
+                    scheduler.submit(
+                        model, tokenizer, prompt_suffixes[i % len(prompt_suffixes)], "cpu",
+                        max_new_tokens=args.max_new_tokens,
+                        min_new_tokens=args.max_new_tokens,
+                        do_sample=False,
+                        pad_token_id=tokenizer.eos_token_id,
+                    )
+                    for i in range(clients)
+                ]
+                new_tokens = sum(future.result()[1]["new_tokens"] for future in futures)
+                wall_ms = (time.perf_counter() - start) * 1000
+                timer.add(f"recommend.clients_{clients}.{label}", wall_ms)
+                timer.add(f"recommend.clients_{clients}.{label}.ms_per_token", wall_ms / max(1, new_tokens))
+
+
+def compare(current, baseline, threshold):
+    """Print a per-stage comparison; returns the stages that regressed beyond threshold"""
+    regressions = []
+    print(f"{'stage':42} {'baseline ms':>12} {'current ms':>12} {'change':>9}")
+    for name in sorted(set(current["stages"]) | set(baseline["stages"])):
+        before = baseline["stages"].get(name, {}).get("median_ms")
+        after = current["stages"].get(name, {}).get("median_ms")
+        if before is None or after is None:
+            print(f"{name:42} {before if before is not None else '-':>12} {after if after is not None else '-':>12}")
+            continue
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:42} {before:12.3f} {after:12.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline per-stage benchmark for both services")
+    parser.add_argument("--suite", choices=["all", "image", "recommend"], default="all")
+    parser.add_argument("--repeat", type=int, default=5, help="measured iterations per stage")
+    parser.add_argument("--warmup", type=int, default=1, help="discarded warm-up iterations")
+    parser.add_argument("--image-size", type=int, default=768, help="side of the synthetic input image")
+    parser.add_argument("--steps", type=int, default=10, help="num_inference_steps for the img2img run")
+    parser.add_argument("--catalog-size", type=int, default=40, help="hairstyles in the synthetic catalog")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="tokens generated per recommendation")
+    parser.add_argument("--clients", type=lambda s: [int(n) for n in s.split(",")], default=[1, 4, 16],
+                        help="comma-separated concurrent client counts for the throughput stages")
+    parser.add_argument("--batch-size", type=int, default=4, help="max image / generation batch size for the batched runs")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write results")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against a previously saved result file")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="keep the services' own logging")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    timer = StageTimer()
+    # Keep the services' per-request logging out of the way unless asked for
+    # (their log level is read when they are imported)
+    if not args.verbose:
+        os.environ.setdefault("EDIT_LOG_LEVEL", "ERROR")
+        os.environ.setdefault("RECOMMEND_LOG_LEVEL", "ERROR")
+    quiet = open(os.devnull, "w") if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        if args.suite in ("all", "image"):
+            benchmark_image(timer, args)
+        if args.suite in ("all", "recommend"):
+            benchmark_recommend(timer, args)
+
+    import diffusers
+    import transformers
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "diffusers": diffusers.__version__,
+            "transformers": transformers.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "args": vars(args),
+        },
+        "stages": timer.summary(warmup=args.warmup),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, stats in results["stages"].items():
+        print(f"{name:42} median {stats['median_ms']:10.3f} ms  p95 {stats['p95_ms']:10.3f} ms")
+    for name, stats in results["stages"].items():
+        if "ms_per_token" in name and stats["median_ms"] > 0:
+            print(f"🔄 {name:58} {1000 / stats['median_ms']:8.1f} tokens/sec")
+        elif "ms_per_image" in name and stats["median_ms"] > 0:
+            print(f"🖼️ {name:58} {1000 / stats['median_ms']:8.2f} images/sec")
+    print(f"📊 Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} stage(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+        print("✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
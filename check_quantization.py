@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Accuracy/latency check of the recommendation model's CPU precisions
+Loads the model once per precision, each in its own process so resident memory is comparable,
+runs greedy constrained generation for a fixed set of profiles and compares the picks with the
+baseline precision (the first one listed, float32 by default).
+
+Usage:
+    python check_quantization.py                                  # RECOMMENDATION_MODEL: float32 vs bfloat16 vs int8
+    python check_quantization.py --precisions float32,int8 --catalog hairstyles.json
+    python check_quantization.py --tiny                           # offline smoke run with a tiny random model
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+import contextlib
+
+from benchmark_services import SAMPLE_USER, sample_catalog, build_tiny_causal_lm
+
+# Fixed profiles spanning the kiosk's face shapes, skin tones, hair types and lengths
+PROFILES = [
+    SAMPLE_USER,
+    {"faceShape": "round", "skinTone": {"label": "fair"}, "hairLength": "short", "hairType": "straight",
+     "stylePreferences": ["classic"]},
+    {"faceShape": "square", "skinTone": {"label": "deep"}, "hairLength": "long", "hairType": "coily",
+     "stylePreferences": ["bold", "textured"]},
+    {"faceShape": "heart", "skinTone": {"label": "olive"}, "hairLength": "medium", "hairType": "curly",
+     "stylePreferences": []},
+    {"faceShape": "diamond", "skinTone": {"label": "tan"}, "hairLength": "long", "hairType": "wavy",
+     "stylePreferences": ["elegant", "layered"]},
+    {"faceShape": "oblong", "skinTone": {"label": "light"}, "hairLength": "short", "hairType": "curly",
+     "stylePreferences": ["low-maintenance", "casual"]},
+]
+
+
+def run_worker(args):
+    """Load the model in one precision, generate for every profile and write the results as JSON"""
+    if not args.verbose:
+        os.environ.setdefault("RECOMMEND_LOG_LEVEL", "ERROR")
+    import recommendation_service as svc
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    catalog = load_catalog(args.catalog)
+    quiet = open(os.devnull, "w") if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        rss_before = svc.process_rss_mb()
+        start = time.perf_counter()
+        precision = svc.resolve_cpu_precision(args.precision)
+        if args.tiny:
+            model, tokenizer = build_tiny_causal_lm()
+            model = svc.apply_cpu_precision(model, precision)
+        else:
+            model, tokenizer = svc.load_model(args.model, precision=precision)
+        load_seconds = time.perf_counter() - start
+
+        def generate(profile):
+            candidates, _ = svc.prerank_catalog(profile, catalog)
+            constraint = svc.RecommendationConstraint(tokenizer, candidates)
+            generation_start = time.perf_counter()
+            new_tokens, stats = svc.generate_tokens(
+                model, tokenizer, svc.build_recommendation_suffix(profile, candidates), "cpu",
+                max_new_tokens=args.max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+                logits_processor=LogitsProcessorList([constraint]),
+                stopping_criteria=StoppingCriteriaList([constraint.stopping_criteria()]),
+            )
+            seconds = time.perf_counter() - generation_start
+            recommendations = svc.extract_recommendations_json(
+                tokenizer.decode(new_tokens, skip_special_tokens=True)) or []
+            return {
+                "ids": [rec.get("id") for rec in recommendations],
+                "scores": [rec.get("matchScore") for rec in recommendations],
+                "seconds": round(seconds, 4),
+                "new_tokens": stats["new_tokens"],
+                "tokens_per_sec": round(stats["new_tokens"] / seconds, 2) if seconds > 0 else 0.0,
+            }
+
+        generate(PROFILES[0])  # Warm-up (prefix prefill, allocator), not measured
+        profiles = [generate(profile) for profile in PROFILES]
+
+    result = {
+        "precision": precision,
+        "load_seconds": round(load_seconds, 2),
+        "rss_mb": svc.process_rss_mb(),
+        "model_rss_mb": round(svc.process_rss_mb() - rss_before, 1),
+        "profiles": profiles,
+    }
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+
+def load_catalog(path):
+    if not path:
+        return sample_catalog(40)
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, candidate):
+    """Agreement of a precision's picks with the baseline's, plus latency and memory ratios"""
+    pairs = list(zip(baseline["profiles"], candidate["profiles"]))
+    top1 = sum(1 for b, c in pairs if b["ids"][:1] == c["ids"][:1]) / len(pairs)
+    overlap = statistics.fmean(len(set(b["ids"]) & set(c["ids"])) / max(1, len(b["ids"])) for b, c in pairs)
+    exact = sum(1 for b, c in pairs if b["ids"] == c["ids"]) / len(pairs)
+    score_diffs = [abs(bs - cs) for b, c in pairs for bs, cs in zip(b["scores"], c["scores"])
+                   if b["ids"] == c["ids"] and isinstance(bs, (int, float)) and isinstance(cs, (int, float))]
+    baseline_latency = statistics.median(p["seconds"] for p in baseline["profiles"])
+    latency = statistics.median(p["seconds"] for p in candidate["profiles"])
+    return {
+        "top1_agreement": round(top1, 3),
+        "top3_overlap": round(overlap, 3),
+        "exact_match": round(exact, 3),
+        "mean_score_diff": round(statistics.fmean(score_diffs), 2) if score_diffs else None,
+        "median_seconds": round(latency, 4),
+        "tokens_per_sec": round(statistics.median(p["tokens_per_sec"] for p in candidate["profiles"]), 2),
+        "speedup": round(baseline_latency / latency, 2) if latency > 0 else None,
+        "rss_mb": candidate["rss_mb"],
+        "model_rss_mb": candidate["model_rss_mb"],
+        "memory_ratio": round(candidate["model_rss_mb"] / baseline["model_rss_mb"], 3)
+        if baseline["model_rss_mb"] > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recommendation model CPU precisions")
+    parser.add_argument("--precisions", default="float32,bfloat16,int8",
+                        help="comma-separated precisions; the first is the baseline")
+    parser.add_argument("--model", default=None, help="model to load (defaults to RECOMMENDATION_MODEL)")
+    parser.add_argument("--catalog", default=None, help="JSON file with a hairstyle catalog (default: synthetic)")
+    parser.add_argument("--max-new-tokens", type=int, default=500)
+    parser.add_argument("--tiny", action="store_true", help="use a tiny random model (offline smoke run)")
+    parser.add_argument("--output", default="quantization_results.json", help="where to write results")
+    parser.add_argument("--verbose", action="store_true", help="keep the service's own logging")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--precision", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = {}
+    for precision in args.precisions.split(","):
+        print(f"🔄 Running {precision}...")
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as handle:
+            result_file = handle.name
+        command = [sys.executable, os.path.abspath(__file__), "--worker", "--precision", precision,
+                   "--result-file", result_file, "--max-new-tokens", str(args.max_new_tokens)]
+        for flag, value in (("--model", args.model), ("--catalog", args.catalog)):
+            if value:
+                command += [flag, value]
+        command += ["--tiny"] if args.tiny else []
+        command += ["--verbose"] if args.verbose else []
+        try:
+            subprocess.run(command, check=True)
+            with open(result_file) as f:
+                results[precision] = json.load(f)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ {precision} failed (exit code {e.returncode})")
+        finally:
+            os.unlink(result_file)
+
+    if not results:
+        sys.exit(1)
+    baseline_name = next(iter(results))
+    comparison = {name: compare(results[baseline_name], result) for name, result in results.items()}
+    with open(args.output, "w") as f:
+        json.dump({"baseline": baseline_name, "comparison": comparison, "runs": results}, f, indent=2)
+
+    print(f"{'precision':10} {'top1':>6} {'top3':>6} {'exact':>6} {'score Δ':>8} {'median s':>9} "
+          f"{'tok/s':>8} {'speedup':>8} {'model MB':>9} {'mem':>6}")
+    for name, c in comparison.items():
+        optional = {key: c[key] if c[key] is not None else "-" for key in ("mean_score_diff", "speedup", "memory_ratio")}
+        print(f"{results[name]['precision']:10} {c['top1_agreement']:6.0%} {c['top3_overlap']:6.0%} "
+              f"{c['exact_match']:6.0%} {optional['mean_score_diff']:>8} {c['median_seconds']:9.3f} "
+              f"{c['tokens_per_sec']:8.1f} {optional['speedup']:>7}x {c['model_rss_mb']:9.1f} "
+              f"{optional['memory_ratio']:>6}")
+    print(f"📊 Results written to {args.output} (baseline: {baseline_name})")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,19 +11,1080 @@ import sys
 import json
 import base64
 import io
-from flask import Flask, request, jsonify
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import uuid
+import gc
+import weakref
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFilter
 import torch
+from service_metrics import CONTENT_TYPE, Metrics, create_logger, instrument_app
+from admission_control import (Cancellation, Overloaded, RequestCancelled, error_response, retry_after_seconds,
+                               wait_result)
+import prefork
+from service_runtime import StartupState, local_snapshot_kwargs, sse_event
 
 app = Flask(__name__)
 CORS(app)  # Allow CORS for frontend
 
+# Logging: EDIT_LOG_LEVEL=DEBUG traces every request stage, INFO (default) keeps model lifecycle
+# and one summary per batch, WARNING or ERROR silences the hot path in production
+log = create_logger("image_editor_service", os.environ.get('EDIT_LOG_LEVEL', 'INFO'))
+
+# Prometheus metrics, served on GET /metrics
+metrics = Metrics("edit")
+instrument_app(app, metrics)
+metrics.histogram("stage_seconds", "Latency per stage (transport, decode, model_load, denoise, encode)")
+metrics.counter("result_cache_total", "Edits by result cache outcome (hit, miss)")
+metrics.counter("images_total", "Images generated by the pipeline")
+metrics.counter("failures_total", "Failed edits not reported as a 5xx response (streams, jobs, fan-outs, batches)")
+metrics.counter("rejected_total", "Edits rejected with 429 because the inference queue was full")
+metrics.counter("cancelled_total", "Edits stopped early, by reason (deadline, disconnected) and stage (queued, denoising)")
+metrics.counter("session_latents_total", "Session edits by VAE latent cache outcome (hit, miss)")
+metrics.gauge("sessions", "Live try-on sessions", lambda: session_store.stats()["sessions"])
+metrics.gauge("images_per_second", "Throughput of the most recent pipeline batch")
+metrics.gauge("queue_depth", "Edits waiting for the batch scheduler", lambda: scheduler.queue_depth())
+metrics.gauge("ready", "1 once the default pipeline is loaded and warmed up", lambda: startup_state.ready)
+
 # Global variable to store the pipeline (loaded once)
 pipeline = None
 model_source = None  # Track which model is loaded
 
-def load_model(model_path=None, github_token=None):
+# Micro-batching: requests arriving within the wait window are run as one pipeline call
+BATCH_MAX_SIZE = int(os.environ.get('EDIT_BATCH_MAX_SIZE', 4))
+BATCH_MAX_WAIT_MS = float(os.environ.get('EDIT_BATCH_MAX_WAIT_MS', 50))
+
+# Admission control: the batch size above is the number of edits run at once, at most EDIT_MAX_QUEUE
+# more may wait (0 = unbounded) and further edits get 429 + Retry-After. Edits are cancelled between
+# denoising steps once their client disconnects or their deadline ('timeout_ms', default below) passes.
+MAX_QUEUE = int(os.environ.get('EDIT_MAX_QUEUE', 16))
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('EDIT_REQUEST_TIMEOUT_SECONDS', 0))  # 0 = no deadline
+
+# Model pool: keep several pipelines loaded up to this budget, evicting the least recently used
+MODEL_POOL_BUDGET_MB = float(os.environ.get('MODEL_POOL_BUDGET_MB', 8192))
+
+# Pipeline components that are commonly identical across SD checkpoints and can be shared
+SHAREABLE_COMPONENTS = ("vae", "text_encoder", "tokenizer")
+
+# Prompt-embedding cache: text-encoder outputs for repeated (catalog) prompts
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 256))
+PROMPT_WARMUP_FILE = os.environ.get('PROMPT_WARMUP_FILE')  # JSON list of prompts to encode at startup
+
+# Quality tiers: noise scheduler, default step count and resolution bucket (long side, snapped to 64)
+QUALITY_TIERS = {
+    "preview": {"scheduler": "dpm_multistep", "steps": 8, "bucket": 512},
+    "standard": {"scheduler": "dpm_multistep", "steps": 20, "bucket": 768},
+    "final": {"scheduler": "default", "steps": 30, "bucket": 1024},
+}
+
+# Hair-region mode: diffuse only a padded crop around the head, resized to a small bucket
+CROP_BUCKET = int(os.environ.get('EDIT_CROP_BUCKET', 512))  # Long side of the crop fed to the UNet
+CROP_PADDING = float(os.environ.get('EDIT_CROP_PADDING', 0.15))  # Padding around the region (fraction of its size)
+CROP_FEATHER = float(os.environ.get('EDIT_CROP_FEATHER', 0.06))  # Blend width (fraction of the crop's short side)
+
+# Async edit jobs: worker pool size and how long finished jobs are kept for polling; job creation is
+# rejected (429) once EDIT_JOB_MAX_ACTIVE jobs are queued or running, and only the newest
+# EDIT_JOB_MAX_FINISHED finished jobs are kept
+JOB_WORKERS = int(os.environ.get('EDIT_JOB_WORKERS', 2))
+JOB_TTL_SECONDS = float(os.environ.get('EDIT_JOB_TTL_SECONDS', 600))
+JOB_MAX_ACTIVE = int(os.environ.get('EDIT_JOB_MAX_ACTIVE', 16))
+JOB_MAX_FINISHED = int(os.environ.get('EDIT_JOB_MAX_FINISHED', 256))
+
+# Try-on sessions: the photo is uploaded once (POST /sessions) and kept decoded, with its VAE latents per
+# model and resolution, for EDIT_SESSION_TTL_SECONDS after last use; the least recently used sessions are
+# dropped once all of them together exceed EDIT_SESSION_MAX_MB
+SESSION_TTL_SECONDS = float(os.environ.get('EDIT_SESSION_TTL_SECONDS', 1800))
+SESSION_MAX_MB = float(os.environ.get('EDIT_SESSION_MAX_MB', 512))
+
+# Fan-out (/edit-image/batch): one photo and up to EDIT_FANOUT_MAX_PROMPTS prompts, submitted in chunks
+# (default: one scheduler batch) and streamed back per item
+FANOUT_MAX_PROMPTS = int(os.environ.get('EDIT_FANOUT_MAX_PROMPTS', 16))
+FANOUT_CHUNK_SIZE = int(os.environ.get('EDIT_FANOUT_CHUNK_SIZE', BATCH_MAX_SIZE))
+FANOUT_WORKERS = int(os.environ.get('EDIT_FANOUT_WORKERS', 8))
+
+# SSE progress stream: default preview interval (in denoising steps)
+STREAM_PREVIEW_EVERY = int(os.environ.get('EDIT_STREAM_PREVIEW_EVERY', 5))
+
+# Linear approximation of the SD 1.x/2.x VAE decoder (4 latent channels -> RGB),
+# good enough for a blurry progress preview at 1/8 resolution without running the VAE
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+# Output encodings the client can negotiate (Accept header or 'format' parameter)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+DEFAULT_OUTPUT_QUALITY = int(os.environ.get('EDIT_OUTPUT_QUALITY', 90))
+
+# Result cache: in-memory LRU tier plus optional on-disk tier (disabled when EDIT_CACHE_DIR is unset)
+CACHE_MAX_ENTRIES = int(os.environ.get('EDIT_CACHE_MAX_ENTRIES', 64))
+CACHE_DIR = os.environ.get('EDIT_CACHE_DIR')
+CACHE_DISK_MAX_MB = float(os.environ.get('EDIT_CACHE_DISK_MAX_MB', 512))
+
+# Cold start: optional local snapshot of safetensors weights (memory-mapped, no hub lookups), loaded in a
+# background thread while the HTTP server is already up, then warmed with a dummy edit before
+# /health/ready reports ready. Create one with: python image_editor_service.py --save-snapshot DIR
+SNAPSHOT_DIR = os.environ.get('EDIT_SNAPSHOT_DIR')
+BACKGROUND_LOAD = os.environ.get('EDIT_BACKGROUND_LOAD', '1') != '0'
+WARMUP_SIZE = int(os.environ.get('EDIT_WARMUP_SIZE', 512))  # Side of the dummy warm-up image
+WARMUP_STEPS = int(os.environ.get('EDIT_WARMUP_STEPS', 2))
+
+# Pre-fork serving (CPU only): with EDIT_WORKERS > 1 the pipeline is loaded once and that many HTTP workers
+# are forked, sharing its weights copy-on-write; each runs EDIT_WORKER_THREADS torch threads (0 = cores / workers)
+WORKERS = int(os.environ.get('EDIT_WORKERS', 1))
+WORKER_THREADS = int(os.environ.get('EDIT_WORKER_THREADS', 0))
+
+
+class BatchScheduler:
+    """
+    Cross-request micro-batching scheduler in front of the img2img pipeline.
+
+    Requests are queued and grouped by pipeline, num_inference_steps, strength,
+    guidance_scale and image resolution. A group is dispatched as one batched
+    pipeline call once it reaches max_batch_size or its oldest request has
+    waited max_wait_ms. The wait window is adaptive: while traffic is not concurrent
+    (the previous batch held a single request) a lone request is dispatched right
+    away instead of waiting for company that is unlikely to come. A single worker
+    thread owns all pipeline calls, so the shared pipeline is never entered concurrently.
+
+    The queue is bounded by max_queue: further requests are rejected with Overloaded.
+    Cancelled requests are dropped before their batch starts, and a batch whose
+    requests are all cancelled stops at the next denoising step.
+    """
+
+    def __init__(self, max_batch_size=4, max_wait_ms=50, max_queue=0):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = max(0, int(max_queue))
+        self._pending = []
+        self._tasks = []
+        self._task_ran = False
+        self._last_batch_size = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._busy_seconds = 0.0
+        self._rejected = 0
+        self._cancelled = 0
+
+    def check_capacity(self):
+        """Raise Overloaded if the queue is full (lets a request fail fast before decoding its image)"""
+        with self._cond:
+            self._reject_if_full()
+
+    def submit(self, pipe, prompt, image, strength, guidance_scale, num_inference_steps, seed=None,
+               callback=None, negative_prompt=None, model=None, scheduler_name="default", cancel=None,
+               bounded=True, session=None, view=None):
+        """
+        Queue one img2img request; returns a Future resolving to (image, batch_size)
+        
+        callback, if given, is called as callback(step, total_steps, latents) after every
+        denoising step with this request's slice of the batched latents.
+        model names the pipeline for the prompt-embedding cache.
+        scheduler_name selects the noise scheduler (see tier_scheduler()).
+        cancel is the request's Cancellation; the Future fails with RequestCancelled once it fires.
+        bounded=False skips the queue limit (for work that is already throttled, e.g. async jobs).
+        session, if given, is the try-on session the image comes from: its cached VAE latents for
+        (model, view) are used instead of encoding the image; view defaults to the image size.
+        Raises Overloaded if the queue is full.
+        """
+        item = {
+            "pipe": pipe,
+            "model": model,
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "image": image,
+            "strength": strength,
+            "guidance_scale": guidance_scale,
+            "num_inference_steps": num_inference_steps,
+            "seed": seed,
+            "callback": callback,
+            "cancel": cancel,
+            "session": session,
+            "view": view or image.size,
+            "scheduler_name": scheduler_name,
+            # Session requests pass latents instead of images, so they are batched separately
+            "key": (id(pipe), scheduler_name, int(num_inference_steps), float(strength), float(guidance_scale),
+                    image.size, session is not None),
+            "enqueued_at": time.monotonic(),
+            "future": Future(),
+        }
+        with self._cond:
+            if bounded:
+                self._reject_if_full()
+            self._ensure_worker()
+            self._pending.append(item)
+            self._cond.notify()
+        return item["future"]
+
+    def run_on_worker(self, fn):
+        """
+        Run fn() on the worker thread between batches; returns a Future of its result
+        For other pipeline work (e.g. encoding prompts) that must not overlap a running batch.
+        """
+        future = Future()
+        with self._cond:
+            self._ensure_worker()
+            self._tasks.append((fn, future))
+            self._cond.notify()
+        return future
+
+    def _ensure_worker(self):
+        """Start the worker thread if it is not running (call with _cond held)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="img2img-batcher", daemon=True)
+            self._thread.start()
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        """Snapshot of batching counters for /health"""
+        with self._stats_lock:
+            batches, images, busy = self._batches, self._images, self._busy_seconds
+            rejected, cancelled = self._rejected, self._cancelled
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queue_depth(),
+            "batches": batches,
+            "images": images,
+            "rejected": rejected,
+            "cancelled": cancelled,
+            "avg_batch_size": round(images / batches, 2) if batches else 0.0,
+            "images_per_sec": round(images / busy, 4) if busy > 0 else 0.0,
+        }
+
+    def _reject_if_full(self):
+        """Raise Overloaded if max_queue requests are already waiting (call with _cond held)"""
+        queued = len(self._pending)
+        if not self.max_queue or queued < self.max_queue:
+            return
+        with self._stats_lock:
+            self._rejected += 1
+            avg_batch_seconds = self._busy_seconds / self._batches if self._batches else None
+        metrics.inc("rejected_total")
+        raise Overloaded(retry_after_seconds(queued, self.max_batch_size, avg_batch_seconds))
+
+    def _cancel(self, item, stage):
+        reason = item["cancel"].reason
+        with self._stats_lock:
+            self._cancelled += 1
+        metrics.inc("cancelled_total", reason=reason, stage=stage)
+        item["future"].set_exception(RequestCancelled(reason))
+
+    def _next_batch(self):
+        """
+        Block until a group is full or its oldest request's wait window has expired
+        Queued run_on_worker() tasks are returned as (fn, future), interleaved with the edit batches:
+        after a task, a ready batch goes next, and tasks fill the time a batch is still waiting.
+        """
+        with self._cond:
+            while True:
+                while not self._pending and not self._tasks:
+                    self._cond.wait()
+                if self._tasks and (not self._pending or not self._task_ran):
+                    self._task_ran = True
+                    return self._tasks.pop(0)
+                head = self._pending[0]
+                group = [p for p in self._pending if p["key"] == head["key"]]
+                remaining = head["enqueued_at"] + self.max_wait - time.monotonic()
+                if len(self._pending) == 1 and self._last_batch_size <= 1:
+                    remaining = 0
+                if len(group) >= self.max_batch_size or remaining <= 0:
+                    batch = group[:self.max_batch_size]
+                    taken = {id(p) for p in batch}
+                    self._pending = [p for p in self._pending if id(p) not in taken]
+                    self._task_ran = False
+                    self._last_batch_size = len(batch)
+                    return batch
+                if self._tasks:
+                    return self._tasks.pop(0)
+                self._cond.wait(remaining)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if isinstance(batch, tuple):
+                fn, future = batch
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+            self._execute(batch)
+
+    @staticmethod
+    def _make_step_callback(batch):
+        """Fan the pipeline's step-end callback out to each request in the batch"""
+        head = batch[0]
+        # img2img only runs the last `strength` fraction of the schedule
+        total_steps = min(int(int(head["num_inference_steps"]) * float(head["strength"])),
+                          int(head["num_inference_steps"]))
+        
+        def on_step_end(pipe, step_index, timestep, callback_kwargs):
+            latents = callback_kwargs.get("latents")
+            for index, item in enumerate(batch):
+                if item["callback"] is None:
+                    continue
+                try:
+                    item["callback"](step_index + 1, total_steps,
+                                     latents[index:index + 1] if latents is not None else None)
+                except Exception as e:
+                    log.warning(f"⚠️ [LOCAL] Step callback failed: {e}")
+            # Rows cannot leave a running batch, so stop only once nobody is waiting for it
+            if all(item["cancel"] is not None and item["cancel"].cancelled for item in batch):
+                raise RequestCancelled(head["cancel"].reason)
+            return callback_kwargs
+        
+        return on_step_end
+
+    def _execute(self, batch):
+        # Requests cancelled while queued never reach the pipeline
+        live = []
+        for item in batch:
+            if item["cancel"] is not None and item["cancel"].cancelled:
+                self._cancel(item, "queued")
+            else:
+                live.append(item)
+        if not live:
+            return
+        batch = live
+        head = batch[0]
+        log.debug(f"🔄 [LOCAL] Running batch of {len(batch)} request(s) "
+                  f"(steps={head['num_inference_steps']}, strength={head['strength']}, size={head['image'].size})")
+        start = time.time()
+        try:
+            generator = None
+            if any(item["seed"] is not None for item in batch):
+                # One generator per image so seeded requests stay reproducible inside a batch
+                generator = [
+                    torch.Generator(device=head["pipe"].device).manual_seed(
+                        int(item["seed"]) if item["seed"] is not None else torch.seed()
+                    )
+                    for item in batch
+                ]
+            extra_kwargs = {}
+            if any(item["callback"] is not None or item["cancel"] is not None for item in batch):
+                extra_kwargs["callback_on_step_end"] = self._make_step_callback(batch)
+            # Safe to swap here: this worker thread is the only caller of the pipeline
+            head["pipe"].scheduler = tier_scheduler(head["pipe"], head["scheduler_name"])
+            # Text-encoder outputs come from the prompt-embedding cache
+            embeddings = [prompt_cache.get_or_encode(item["pipe"], item["model"], item["prompt"],
+                                                     item["negative_prompt"])
+                          for item in batch]
+            if head["session"] is not None:
+                # Try-on sessions: VAE-encode each view once, later edits start from the cached latents
+                images = torch.cat([
+                    session_store.latents(item["session"], item["model"], item["view"],
+                                          lambda item=item: encode_latents(item["pipe"], item["image"]))
+                    for item in batch
+                ])
+            else:
+                images = [item["image"] for item in batch]
+            denoise_start = time.perf_counter()
+            images = head["pipe"](
+                prompt_embeds=torch.cat([e[0] for e in embeddings]),
+                negative_prompt_embeds=torch.cat([e[1] for e in embeddings]),
+                image=images,
+                strength=head["strength"],
+                guidance_scale=head["guidance_scale"],
+                num_inference_steps=head["num_inference_steps"],
+                generator=generator,
+                **extra_kwargs
+            ).images
+        except RequestCancelled:
+            for item in batch:
+                self._cancel(item, "denoising")
+            return
+        except Exception as e:
+            metrics.inc("failures_total", len(batch), path="batch")
+            for item in batch:
+                item["future"].set_exception(e)
+            return
+        metrics.observe("stage_seconds", time.perf_counter() - denoise_start, stage="denoise")
+        duration = time.time() - start
+        with self._stats_lock:
+            self._batches += 1
+            self._images += len(batch)
+            self._busy_seconds += duration
+        metrics.inc("images_total", len(batch))
+        prefork.record_units(len(batch))
+        metrics.set("images_per_second", round(len(batch) / duration, 3) if duration > 0 else 0.0)
+        log.info(f"✅ [LOCAL] Batch of {len(batch)} finished in {duration:.2f}s "
+                 f"({len(batch) / duration if duration > 0 else 0:.3f} images/sec)")
+        for item, image in zip(batch, images):
+            # A row whose request was cancelled mid-batch is not delivered (nor cached)
+            if item["cancel"] is not None and item["cancel"].reason is not None:
+                self._cancel(item, "denoising")
+            else:
+                item["future"].set_result((image, len(batch)))
+
+
+scheduler = BatchScheduler(max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, max_queue=MAX_QUEUE)
+
+
+class ResultCache:
+    """
+    Content-addressed cache of edited images.
+
+    Entries are keyed on a hash of the decoded input image bytes plus every
+    parameter that influences the output. The memory tier is a bounded LRU of
+    PIL images; the optional disk tier stores PNG files and evicts the least
+    recently used files once the directory exceeds its size budget.
+    """
+
+    def __init__(self, max_entries=64, disk_dir=None, disk_max_mb=512):
+        self.max_entries = max(0, int(max_entries))
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 1024 * 1024)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    @staticmethod
+    def make_key(image_bytes, prompt, strength, guidance_scale, num_inference_steps, seed, model,
+                 negative_prompt=None, region=None, tier=None):
+        """Stable cache key for one edit request"""
+        digest = hashlib.sha256(image_bytes)
+        params = json.dumps([prompt, float(strength), float(guidance_scale), int(num_inference_steps),
+                             seed, model, negative_prompt, region, tier], sort_keys=True)
+        digest.update(params.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self._memory[key]
+        image = self._disk_get(key)
+        with self._lock:
+            if image is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._memory_put(key, image)
+        return image
+
+    def put(self, key, image):
+        with self._lock:
+            self._memory_put(key, image)
+            self.counters["stores"] += 1
+        self._disk_put(key, image)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "disk_dir": self.disk_dir,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _memory_put(self, key, image):
+        if self.max_entries == 0:
+            return
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.png")
+
+    def _disk_files(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.png'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            files.append((name, st.st_size, st.st_mtime))
+        return files
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as cached:
+                image = cached.convert("RGB")
+            os.utime(path)  # Refresh mtime so disk eviction is least-recently-used
+            return image
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, image):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format="PNG")
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning(f"⚠️ [LOCAL] Could not write cache entry to disk: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += size
+            if self._disk_bytes <= self.disk_max_bytes:
+                return
+            # Over budget: drop oldest files until back under the limit
+            files = sorted(self._disk_files(), key=lambda f: f[2])
+            self._disk_bytes = sum(f[1] for f in files)
+            for name, file_size, _ in files:
+                if self._disk_bytes <= self.disk_max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except OSError:
+                    continue
+                self._disk_bytes -= file_size
+                self.counters["evictions"] += 1
+
+
+result_cache = ResultCache(max_entries=CACHE_MAX_ENTRIES, disk_dir=CACHE_DIR, disk_max_mb=CACHE_DISK_MAX_MB)
+
+
+class PromptEmbeddingCache:
+    """
+    Bounded LRU of CLIP text-encoder outputs keyed by (model, prompt, negative prompt).
+    
+    Each entry holds the conditional and unconditional (classifier-free guidance)
+    embeddings, so cached prompts skip the text encoder entirely.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max(0, int(max_entries))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_or_encode(self, pipe, model, prompt, negative_prompt=None):
+        """Return (prompt_embeds, negative_prompt_embeds) for one prompt, encoding on a miss"""
+        key = (model, prompt, negative_prompt or "")
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._entries[key]
+            self.counters["misses"] += 1
+        
+        with torch.no_grad():
+            prompt_embeds, negative_prompt_embeds = pipe.encode_prompt(
+                prompt,
+                pipe.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=negative_prompt
+            )
+        embeddings = (prompt_embeds, negative_prompt_embeds)
+        
+        with self._lock:
+            if self.max_entries > 0:
+                self._entries[key] = embeddings
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.counters["evictions"] += 1
+        return embeddings
+
+    def warm(self, pipe, model, prompts, negative_prompt=None):
+        """
+        Precompute embeddings for a list of prompts; returns how many were newly encoded
+        Each prompt is encoded on the batch scheduler's worker thread, the only caller of the pipeline,
+        so warming never runs the text encoder while a batch is running.
+        """
+        futures = [scheduler.run_on_worker(lambda prompt=prompt: self._encode_counted(pipe, model, prompt,
+                                                                                      negative_prompt))
+                   for prompt in prompts]
+        return sum(future.result() for future in futures)
+
+    def _encode_counted(self, pipe, model, prompt, negative_prompt):
+        """1 if get_or_encode had to encode the prompt, 0 on a hit"""
+        misses = self.counters["misses"]
+        self.get_or_encode(pipe, model, prompt, negative_prompt)
+        return self.counters["misses"] - misses
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+prompt_cache = PromptEmbeddingCache(max_entries=PROMPT_CACHE_MAX_ENTRIES)
+
+
+class JobManager:
+    """
+    Background edit jobs for clients that cannot hold a connection open for a full generation.
+    
+    Jobs run on a small thread pool (they still go through the micro-batching scheduler),
+    report the current denoising step, and are dropped JOB_TTL_SECONDS after finishing.
+    At most max_active jobs are queued or running (further ones are rejected with Overloaded),
+    and only the newest max_finished finished jobs are kept.
+    """
+
+    def __init__(self, workers=2, ttl_seconds=600, max_active=16, max_finished=256):
+        self.workers = max(1, int(workers))
+        self.ttl_seconds = ttl_seconds
+        self.max_active = max(0, int(max_active))
+        self.max_finished = max(0, int(max_finished))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="edit-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._finished = 0
+        self._job_seconds = 0.0
+        self._rejected = 0
+
+    def submit(self, params, run, render):
+        """
+        Create a job and schedule it
+        
+        Args:
+            params: Parsed edit parameters
+            run: callable(params, step_callback) performing the edit
+            render: callable(params, result) building the JSON result body
+        
+        Raises:
+            Overloaded: max_active jobs are already queued or running
+        """
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "step": 0,
+            "total_steps": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        with self._lock:
+            if self.max_active and self._active >= self.max_active:
+                self._rejected += 1
+                avg_job_seconds = self._job_seconds / self._finished if self._finished else None
+                metrics.inc("rejected_total")
+                raise Overloaded(retry_after_seconds(self._active, self.workers, avg_job_seconds))
+            self._active += 1
+            self._jobs[job_id] = job
+        self._executor.submit(self._run_job, job, params, run, render)
+        return job_id
+
+    def get(self, job_id):
+        """Snapshot of a job's state, or None if unknown or expired"""
+        self.purge_expired()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            rejected = self._rejected
+        return {"jobs": counts, "ttl_seconds": self.ttl_seconds, "max_active": self.max_active,
+                "rejected": rejected}
+
+    def _run_job(self, job, params, run, render):
+        def on_step(step, total_steps, latents):
+            job["step"] = step
+            job["total_steps"] = total_steps
+
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        try:
+            result = run(params, step_callback=on_step)
+            job["result"] = render(params, result)
+            job["status"] = "succeeded"
+            log.info(f"✅ [LOCAL] Job {job['id']} finished in {time.time() - job['started_at']:.2f} seconds")
+        except RequestCancelled as e:
+            log.warning(f"⚠️ [LOCAL] Job {job['id']} cancelled: {e}")
+            job["error"] = str(e)
+            job["status"] = "cancelled"
+        except Exception as e:
+            log.error(f"❌ [LOCAL] Job {job['id']} failed: {e}")
+            metrics.inc("failures_total", path="job")
+            job["error"] = str(e)
+            job["status"] = "failed"
+        finally:
+            job["finished_at"] = time.time()
+            with self._lock:
+                self._active -= 1
+                self._finished += 1
+                self._job_seconds += job["finished_at"] - job["started_at"]
+
+
+job_manager = JobManager(workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS, max_active=JOB_MAX_ACTIVE,
+                         max_finished=JOB_MAX_FINISHED)
+
+
+class SessionStore:
+    """
+    Try-on sessions: one uploaded photo reused for many edits.
+    
+    A session keeps the decoded, size-capped photo and a hash of its bytes (for result cache
+    keys), plus VAE latents per (model, view) filled in by the batch scheduler on first use, where
+    a view is the resolution or crop fed to the pipeline. Sessions expire ttl_seconds after their
+    last use; once photos and latents together exceed max_mb, the least recently used are evicted.
+    """
+
+    def __init__(self, ttl_seconds=1800, max_mb=512):
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"created": 0, "latent_hits": 0, "latent_misses": 0, "evictions": 0, "expired": 0}
+
+    def create(self, image_bytes, image, original_size, mask_bytes=None):
+        """Register a decoded photo; returns the new session dict"""
+        now = time.time()
+        session = {
+            "id": uuid.uuid4().hex,
+            "image": image,
+            "original_size": original_size,
+            "image_hash": hashlib.sha256(image_bytes).hexdigest(),
+            "mask_bytes": mask_bytes,
+            "latents": {},
+            "nbytes": image.width * image.height * len(image.getbands()) + len(mask_bytes or b""),
+            "created_at": now,
+            "last_used": now,
+        }
+        with self._lock:
+            self._purge_expired(now)
+            self._sessions[session["id"]] = session
+            self.counters["created"] += 1
+            self._evict_over_budget(keep=session["id"])
+        return session
+
+    def get(self, session_id):
+        """The live session (refreshing its TTL and LRU position), or None if unknown or expired"""
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session["last_used"] = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def latents(self, session, model, view, encode):
+        """Cached latents of one view of a session's photo, from encode() on a miss (batch worker only)"""
+        key = (model, view)
+        with self._lock:
+            latents = session["latents"].get(key)
+            self.counters["latent_hits" if latents is not None else "latent_misses"] += 1
+        metrics.inc("session_latents_total", status="hit" if latents is not None else "miss")
+        if latents is not None:
+            return latents
+        
+        latents = encode()
+        with self._lock:
+            # Not kept if the session was deleted or evicted while encoding
+            if self._sessions.get(session["id"]) is session:
+                session["latents"][key] = latents
+                session["nbytes"] += latents.nelement() * latents.element_size()
+                self._evict_over_budget(keep=session["id"])
+        return latents
+
+    def describe(self, session):
+        return {
+            "session_id": session["id"],
+            "size": list(session["image"].size),
+            "original_size": list(session["original_size"]),
+            "has_mask": session["mask_bytes"] is not None,
+            "latents": [{"model": model, "view": list(view)} for model, view in session["latents"]],
+            "memory_mb": round(session["nbytes"] / (1024 * 1024), 3),
+            "expires_at": session["last_used"] + self.ttl_seconds,
+        }
+
+    def stats(self):
+        with self._lock:
+            used = sum(session["nbytes"] for session in self._sessions.values())
+            return {
+                **self.counters,
+                "sessions": len(self._sessions),
+                "used_mb": round(used / (1024 * 1024), 1),
+                "budget_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+    def _purge_expired(self, now):
+        cutoff = now - self.ttl_seconds
+        expired = [session_id for session_id, session in self._sessions.items() if session["last_used"] < cutoff]
+        for session_id in expired:
+            del self._sessions[session_id]
+        self.counters["expired"] += len(expired)
+
+    def _evict_over_budget(self, keep):
+        used = sum(session["nbytes"] for session in self._sessions.values())
+        for session_id in list(self._sessions):
+            if used <= self.max_bytes:
+                break
+            if session_id == keep:
+                continue
+            used -= self._sessions.pop(session_id)["nbytes"]
+            self.counters["evictions"] += 1
+
+
+session_store = SessionStore(ttl_seconds=SESSION_TTL_SECONDS, max_mb=SESSION_MAX_MB)
+
+
+# Per-pipeline scheduler instances, built once and reused (dropped with the pipeline)
+_tier_schedulers = weakref.WeakKeyDictionary()
+_tier_schedulers_lock = threading.Lock()
+
+def tier_scheduler(pipe, name):
+    """
+    Noise scheduler named by a quality tier for this pipeline
+    'default' is the scheduler the checkpoint shipped with; others are derived from its config
+    the first time they are requested and cached for the lifetime of the pipeline.
+    """
+    with _tier_schedulers_lock:
+        schedulers = _tier_schedulers.get(pipe)
+        if schedulers is None:
+            schedulers = {"default": pipe.scheduler}
+            _tier_schedulers[pipe] = schedulers
+        if name not in schedulers:
+            from diffusers import DPMSolverMultistepScheduler, EulerAncestralDiscreteScheduler
+            base_config = schedulers["default"].config
+            if name == "dpm_multistep":
+                # DPM-Solver++ (2M, Karras sigmas) converges in few steps, which suits previews
+                schedulers[name] = DPMSolverMultistepScheduler.from_config(
+                    base_config, algorithm_type="dpmsolver++", use_karras_sigmas=True
+                )
+            elif name == "euler_a":
+                schedulers[name] = EulerAncestralDiscreteScheduler.from_config(base_config)
+            else:
+                raise ValueError(f"Unknown scheduler: {name}")
+            log.debug(f"🔧 [LOCAL] Built {name} scheduler for {type(pipe).__name__}")
+        return schedulers[name]
+
+def module_nbytes(module):
+    """Bytes held by a torch module's parameters and buffers"""
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+def weight_file_identities(directory):
+    """
+    Cheap identities of the weight files in a component directory, without reading them
+    Hub cache blobs are named after their content hash, so that name alone identifies the file across
+    repositories; other files are identified by resolved path, size and mtime.
+    """
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    identities = []
+    for name in names:
+        if not name.endswith(('.safetensors', '.bin', '.pt', '.ckpt')):
+            continue
+        path = os.path.realpath(os.path.join(directory, name))
+        if os.path.basename(os.path.dirname(path)) == 'blobs':
+            identities.append(os.path.basename(path))
+        else:
+            stat = os.stat(path)
+            identities.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+    return identities
+
+def component_fingerprint(component):
+    """
+    Identity of a pipeline component, used to detect components shared between checkpoints
+    Torch modules are identified by config, tensor shapes/dtypes and the weight files they were loaded
+    from (hashing the weights would read every page); tokenizers by their vocab. Modules that were
+    not loaded from weight files get no fingerprint and are never shared.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(type(component).__name__.encode('utf-8'))
+    if isinstance(component, torch.nn.Module):
+        config = getattr(component, 'config', None)
+        if config is None:
+            return None
+        config_dict = config.to_dict() if hasattr(config, 'to_dict') else dict(config)
+        weight_files = weight_file_identities(config_dict.get('_name_or_path') or '')
+        if not weight_files:
+            return None
+        config_dict = {k: v for k, v in config_dict.items() if not k.startswith('_')}
+        digest.update(json.dumps(config_dict, sort_keys=True, default=str).encode('utf-8'))
+        for name, tensor in component.state_dict().items():
+            digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode('utf-8'))
+        digest.update("\n".join(weight_files).encode('utf-8'))
+    elif hasattr(component, 'get_vocab'):
+        digest.update(json.dumps(component.get_vocab(), sort_keys=True).encode('utf-8'))
+    else:
+        return None
+    return digest.hexdigest()
+
+
+class ModelPool:
+    """
+    Keeps several loaded pipelines within a memory budget.
+    
+    - Least recently used pipelines are evicted once the budget is exceeded (the most
+      recently loaded one always stays).
+    - Components with identical content across checkpoints (VAE, text encoder, tokenizer)
+      are deduplicated so each is held in memory once.
+    - Loads are single-flight: concurrent requests for a model that is not loaded yet
+      wait on one load instead of each starting their own.
+    """
+
+    def __init__(self, budget_mb=8192):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._pipelines = OrderedDict()
+        self._loading = {}
+        self._shared = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "loads": 0, "evictions": 0, "shared_components": 0}
+
+    def get(self, model_path, loader, cancel=None):
+        """
+        Return the pipeline for model_path, calling loader() at most once concurrently
+        A request waiting on another request's load gives up with RequestCancelled once its
+        Cancellation (cancel) fires.
+        """
+        with self._lock:
+            if model_path in self._pipelines:
+                self._pipelines.move_to_end(model_path)
+                self.counters["hits"] += 1
+                return self._pipelines[model_path]
+            pending = self._loading.get(model_path)
+            if pending is None:
+                pending = Future()
+                self._loading[model_path] = pending
+                owner = True
+            else:
+                owner = False
+        
+        if not owner:
+            log.info(f"⏳ [LOCAL] Waiting for in-flight load of {model_path}")
+            return wait_result(pending, cancel)
+        
+        try:
+            pipe = loader()
+            self._share_components(pipe)
+            with self._lock:
+                self._pipelines[model_path] = pipe
+                self.counters["loads"] += 1
+                self._evict_over_budget()
+            pending.set_result(pipe)
+            return pipe
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(model_path, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counters,
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 1),
+                "used_mb": round(self._used_bytes() / (1024 * 1024), 1),
+                "loaded": list(self._pipelines.keys()),
+                "loading": list(self._loading.keys()),
+            }
+
+    def _share_components(self, pipe):
+        """Swap in already-loaded copies of identical shareable components"""
+        for name in SHAREABLE_COMPONENTS:
+            component = getattr(pipe, name, None)
+            if component is None:
+                continue
+            fingerprint = component_fingerprint(component)
+            if fingerprint is None:
+                continue
+            with self._lock:
+                existing = self._shared.get(fingerprint)
+                if existing is None:
+                    self._shared[fingerprint] = component
+                    continue
+                self.counters["shared_components"] += 1
+            if existing is not component:
+                pipe.register_modules(**{name: existing})
+                log.info(f"♻️ [LOCAL] Sharing {name} with an already loaded model")
+
+    def _used_bytes(self):
+        seen = set()
+        total = 0
+        for pipe in self._pipelines.values():
+            for component in pipe.components.values():
+                if isinstance(component, torch.nn.Module) and id(component) not in seen:
+                    seen.add(id(component))
+                    total += module_nbytes(component)
+        return total
+
+    def _evict_over_budget(self):
+        evicted = False
+        while len(self._pipelines) > 1 and self._used_bytes() > self.budget_bytes:
+            model_path, _ = self._pipelines.popitem(last=False)
+            self.counters["evictions"] += 1
+            evicted = True
+            log.info(f"🗑️ [LOCAL] Evicted {model_path} from model pool (over {self.budget_bytes // (1024 * 1024)}MB budget)")
+        if evicted:
+            live = {id(c) for pipe in self._pipelines.values() for c in pipe.components.values()}
+            self._shared = {fp: c for fp, c in self._shared.items() if id(c) in live}
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+model_pool = ModelPool(budget_mb=MODEL_POOL_BUDGET_MB)
+
+
+def resolve_model_path(model_path=None):
+    """Model identifier a request will use (default: EDIT_SNAPSHOT_DIR, else MODEL_PATH)"""
+    return model_path or SNAPSHOT_DIR or os.environ.get('MODEL_PATH', 'runwayml/stable-diffusion-v1-5')
+
+def load_model(model_path=None, github_token=None, cancel=None):
     """
     Load Stable Diffusion img2img model from Hugging Face or GitHub
     
@@ -31,8 +1092,9 @@ def load_model(model_path=None, github_token=None):
         model_path: Model identifier. Can be:
             - Hugging Face model ID (e.g., "runwayml/stable-diffusion-v1-5")
             - GitHub repo (e.g., "username/repo-name")
-            - Local path
+            - Local path (e.g., a snapshot written by save_snapshot()); defaults to EDIT_SNAPSHOT_DIR
         github_token: GitHub personal access token (for private repos)
+        cancel: Optional Cancellation of the request, ending a wait on another request's load
     
     Returns:
         StableDiffusionImg2ImgPipeline instance
@@ -40,259 +1102,1144 @@ def load_model(model_path=None, github_token=None):
     global pipeline, model_source
     
     # Use provided model or default to Stable Diffusion v1.5 (most popular, open source)
-    if not model_path:
-        model_path = os.environ.get('MODEL_PATH', 'runwayml/stable-diffusion-v1-5')
-    
-    # If same model already loaded, return it
-    if pipeline is not None and model_source == model_path:
-        print(f"✅ [LOCAL] Model already loaded: {model_path}")
-        return pipeline
+    model_path = resolve_model_path(model_path)
     
+    # Pooled: returns an already loaded pipeline, or loads it once even if requested concurrently
+    pipe = model_pool.get(model_path, lambda: _timed_load_pipeline(model_path, github_token), cancel=cancel)
+    pipeline, model_source = pipe, model_path
+    return pipe
+
+def _timed_load_pipeline(model_path, github_token=None):
+    with metrics.time("stage_seconds", stage="model_load"):
+        return _load_pipeline(model_path, github_token)
+
+def _load_pipeline(model_path, github_token=None):
+    """Load one StableDiffusionImg2ImgPipeline from the hub, a GitHub repo or a local path"""
     try:
-        print("=" * 60)
-        print(f"🔄 [LOCAL] Loading Stable Diffusion img2img model from: {model_path}")
-        print("🔄 [LOCAL] This may take a few minutes on first run (downloading model)...")
-        print("=" * 60)
+        log.info("=" * 60)
+        log.info(f"🔄 [LOCAL] Loading Stable Diffusion img2img model from: {model_path}")
+        log.info("🔄 [LOCAL] This may take a few minutes on first run (downloading model)...")
+        log.info("=" * 60)
         
         # Check if GPU is available
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"🔄 [LOCAL] Using device: {device}")
+        log.info(f"🔄 [LOCAL] Using device: {device}")
         
         # Determine if it's a GitHub repo
         is_github = 'github.com' in model_path
         
         if is_github:
-            print(f"🔄 [LOCAL] Detected GitHub repository: {model_path}")
+            log.info(f"🔄 [LOCAL] Detected GitHub repository: {model_path}")
             # Convert GitHub URL to repo format if needed
             if 'github.com' in model_path:
                 # Extract username/repo from URL
                 parts = model_path.replace('https://github.com/', '').replace('http://github.com/', '').split('/')
                 if len(parts) >= 2:
                     model_path = f"{parts[0]}/{parts[1]}"
-                print(f"🔄 [LOCAL] Using GitHub repo: {model_path}")
+                log.info(f"🔄 [LOCAL] Using GitHub repo: {model_path}")
             
             if github_token:
-                print(f"🔑 [LOCAL] Using GitHub token for authentication")
+                log.info(f"🔑 [LOCAL] Using GitHub token for authentication")
         
         # Load Stable Diffusion img2img pipeline
         from diffusers import StableDiffusionImg2ImgPipeline
         
-        print("🔄 [LOCAL] Loading StableDiffusionImg2ImgPipeline (image-to-image)...")
-        print("🔄 [LOCAL] This is the standard Stable Diffusion img2img pipeline")
+        log.info("🔄 [LOCAL] Loading StableDiffusionImg2ImgPipeline (image-to-image)...")
+        log.info("🔄 [LOCAL] This is the standard Stable Diffusion img2img pipeline")
+        
+        local_kwargs = local_snapshot_kwargs(model_path, SNAPSHOT_DIR)
+        if local_kwargs:
+            log.info(f"🔄 [LOCAL] Loading from local directory (no hub lookups): {model_path}")
         
         if device == "cuda":
-            print("🔄 [LOCAL] Loading with CUDA (GPU) support...")
-            pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
+            log.info("🔄 [LOCAL] Loading with CUDA (GPU) support...")
+            pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
                 model_path,
                 torch_dtype=torch.float16,
                 safety_checker=None,  # Disable for faster processing
                 requires_safety_checker=False,
-                token=github_token if github_token and not is_github else None
+                token=github_token if github_token and not is_github else None,
+                **local_kwargs
             ).to(device)
         else:
-            print("🔄 [LOCAL] Loading with CPU support (slower but works)...")
-            pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
+            log.info("🔄 [LOCAL] Loading with CPU support (slower but works)...")
+            pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
                 model_path,
                 torch_dtype=torch.float32,
                 safety_checker=None,
                 requires_safety_checker=False,
-                token=github_token if github_token and not is_github else None
+                token=github_token if github_token and not is_github else None,
+                **local_kwargs
             ).to(device)
         
-        model_source = model_path
-        print("=" * 60)
-        print(f"✅ [LOCAL] Stable Diffusion img2img model loaded successfully!")
-        print(f"✅ [LOCAL] Model: {model_path}")
-        print(f"✅ [LOCAL] Device: {device}")
-        print("=" * 60)
-        return pipeline
+        log.info("=" * 60)
+        log.info(f"✅ [LOCAL] Stable Diffusion img2img model loaded successfully!")
+        log.info(f"✅ [LOCAL] Model: {model_path}")
+        log.info(f"✅ [LOCAL] Device: {device}")
+        log.info("=" * 60)
+        return pipe
         
     except Exception as e:
-        print(f"❌ [LOCAL] Error loading model: {e}")
-        print("💡 [LOCAL] Make sure you have installed: pip install diffusers transformers torch torchvision")
-        print("💡 [LOCAL] For GitHub models, make sure the repo is public or you have proper access")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ [LOCAL] Error loading model: {e}")
+        log.warning("💡 [LOCAL] Make sure you have installed: pip install diffusers transformers torch torchvision")
+        log.warning("💡 [LOCAL] For GitHub models, make sure the repo is public or you have proper access")
         raise
 
-def base64_to_image(base64_string):
-    """Convert base64 string to PIL Image"""
+def save_snapshot(snapshot_dir, model_path=None, github_token=None):
+    """Write the pipeline to a local directory as safetensors, for EDIT_SNAPSHOT_DIR"""
+    pipe = load_model(model_path, github_token)
+    log.info(f"💾 [LOCAL] Writing snapshot of {model_source} to {snapshot_dir}...")
+    pipe.save_pretrained(snapshot_dir, safe_serialization=True)
+    log.info(f"✅ [LOCAL] Snapshot written; start the service with EDIT_SNAPSHOT_DIR={snapshot_dir}")
+
+def base64_to_bytes(base64_string):
+    """Decode base64 string (optionally a data URL) to raw image bytes"""
     # Remove data URL prefix if present
     if ',' in base64_string:
         base64_string = base64_string.split(',')[1]
     
-    image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
-    return image
+    return base64.b64decode(base64_string)
 
-def image_to_base64(image):
-    """Convert PIL Image to base64 string"""
+def bytes_to_image(image_data):
+    """Convert raw image bytes to PIL Image"""
+    return Image.open(io.BytesIO(image_data)).convert("RGB")
+
+def base64_to_image(base64_string):
+    """Convert base64 string to PIL Image"""
+    return bytes_to_image(base64_to_bytes(base64_string))
+
+def encode_image(image, image_format="png", quality=None):
+    """
+    Encode PIL Image to bytes in one of OUTPUT_FORMATS
+    
+    Returns:
+        (image_bytes, mimetype)
+    """
+    pil_format, mimetype = OUTPUT_FORMATS[image_format]
+    save_kwargs = {}
+    if pil_format in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = int(quality) if quality is not None else DEFAULT_OUTPUT_QUALITY
     buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    image_bytes = buffer.getvalue()
+    image.save(buffer, format=pil_format, **save_kwargs)
+    return buffer.getvalue(), mimetype
+
+def image_to_base64(image, image_format="png", quality=None):
+    """Convert PIL Image to base64 data URL (PNG unless another format is requested)"""
+    image_bytes, mimetype = encode_image(image, image_format, quality)
     base64_string = base64.b64encode(image_bytes).decode('utf-8')
-    return f"data:image/png;base64,{base64_string}"
+    return f"data:{mimetype};base64,{base64_string}"
+
+def parse_region(region):
+    """
+    Normalize a client-supplied hair/face region
+    Accepts 'auto', {'x', 'y', 'width', 'height'}, [x, y, width, height] or a JSON string of either.
+    
+    Returns:
+        None, 'auto', or (left, top, right, bottom) in input-image pixels
+    """
+    if region in (None, '', False):
+        return None
+    if isinstance(region, str):
+        if region.lower() == 'auto':
+            return 'auto'
+        region = json.loads(region)
+    if isinstance(region, dict):
+        x, y = float(region['x']), float(region['y'])
+        width, height = float(region['width']), float(region['height'])
+    else:
+        x, y, width, height = (float(v) for v in region)
+    if width <= 0 or height <= 0:
+        raise ValueError("region width and height must be positive")
+    return (x, y, x + width, y + height)
+
+def auto_hair_region(size):
+    """
+    Heuristic head-and-hair box for a kiosk selfie: centred horizontally, upper part of the frame.
+    Used when the client asks for region 'auto' without sending a box or mask.
+    """
+    width, height = size
+    return (width * 0.2, 0.0, width * 0.8, height * 0.65)
+
+def padded_crop_box(box, size, padding):
+    """Expand box by padding (fraction of its size) and clamp it to the image"""
+    left, top, right, bottom = box
+    pad_x = (right - left) * padding
+    pad_y = (bottom - top) * padding
+    width, height = size
+    return (
+        max(0, int(left - pad_x)),
+        max(0, int(top - pad_y)),
+        min(width, int(round(right + pad_x))),
+        min(height, int(round(bottom + pad_y)))
+    )
+
+def bucket_size(width, height, bucket):
+    """Scale (width, height) so the long side is bucket, snapping both sides to multiples of 64"""
+    scale = bucket / max(width, height)
+    return (
+        max(64, int(round(width * scale / 64)) * 64),
+        max(64, int(round(height * scale / 64)) * 64)
+    )
+
+def prepare_region_crop(image, region, mask_image=None, bucket_long_side=CROP_BUCKET):
+    """
+    Cut the padded hair region out of image and resize it to the UNet bucket
+    
+    Args:
+        image: Full (already size-capped) input image
+        region: (left, top, right, bottom) in image pixels, 'auto', or None when a mask is given
+        mask_image: Optional L-mode mask (white = editable), same size as image
+    
+    Returns:
+        Dict with the bucketed crop, its box in image pixels and the blend mask for compositing
+    """
+    if mask_image is not None:
+        box = mask_image.getbbox()
+        if box is None:
+            raise ValueError("mask is empty")
+    elif region == 'auto':
+        box = auto_hair_region(image.size)
+    else:
+        box = region
+    
+    crop_box = padded_crop_box(box, image.size, CROP_PADDING)
+    crop_width, crop_height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+    if crop_width < 8 or crop_height < 8:
+        raise ValueError("region is too small")
+    bucket = bucket_size(crop_width, crop_height, bucket_long_side)
+    crop = image.crop(crop_box).resize(bucket, Image.Resampling.LANCZOS)
+    
+    # Feathered blend mask: the region (or client mask) with soft edges that fade out inside the crop
+    feather = max(1, int(min(crop_width, crop_height) * CROP_FEATHER))
+    if mask_image is not None:
+        blend = mask_image.crop(crop_box)
+    else:
+        blend = Image.new("L", (crop_width, crop_height), 0)
+        ImageDraw.Draw(blend).rectangle(
+            (feather, feather, crop_width - 1 - feather, crop_height - 1 - feather), fill=255
+        )
+    blend = blend.filter(ImageFilter.GaussianBlur(feather / 2))
+    
+    return {"image": crop, "box": crop_box, "bucket": bucket, "blend": blend}
+
+def composite_region(image, edited_crop, crop):
+    """Blend the diffused crop back into the original; pixels outside the crop stay identical"""
+    result = image.copy()
+    patch = edited_crop.resize((crop["box"][2] - crop["box"][0], crop["box"][3] - crop["box"][1]),
+                               Image.Resampling.LANCZOS)
+    result.paste(patch, crop["box"][:2], crop["blend"])
+    return result
+
+def encode_latents(pipe, image):
+    """
+    img2img starting latents of a PIL image: preprocess, VAE-encode and scale
+    Uses the posterior mean rather than a seeded sample, so one cached result serves every seed.
+    """
+    with torch.no_grad():
+        pixels = pipe.image_processor.preprocess(image).to(device=pipe.device, dtype=pipe.vae.dtype)
+        latents = pipe.vae.encode(pixels).latent_dist.mode()
+    return latents * pipe.vae.config.scaling_factor
+
+def latents_to_preview(latents):
+    """
+    Cheap low-resolution RGB preview of in-progress latents
+    Uses a fixed linear latent-to-RGB projection instead of the VAE decoder,
+    so the preview is 1/8 of the output resolution and costs a tiny matmul.
+    Returns None for latent spaces the projection does not cover.
+    """
+    if latents is None or latents.shape[1] != len(LATENT_RGB_FACTORS):
+        return None
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum('chw,cr->hwr', latents[0].float(), factors)
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    return Image.fromarray(rgb)
+
+def preview_to_base64(image, quality=70):
+    """Encode a small preview frame as a JPEG data URL (fast, small payload)"""
+    return image_to_base64(image, "jpeg", quality)
+
+startup_state = StartupState()
+
+def warm_up(pipe):
+    """
+    Run one short dummy edit through the batch scheduler so the first real request does not pay
+    for kernel selection, allocator growth and the text encoder's first pass
+    """
+    image = Image.new("RGB", (WARMUP_SIZE, WARMUP_SIZE), (128, 128, 128))
+    scheduler.submit(pipe, prompt="a person with a modern haircut", image=image, strength=0.5,
+                     guidance_scale=7.5, num_inference_steps=WARMUP_STEPS, seed=0,
+                     model=resolve_model_path(), bounded=False).result()
+
+def warm_start():
+    """Load the default pipeline, precompute warm-up prompts and run a dummy edit, tracking startup_state"""
+    try:
+        startup_state.enter("loading")
+        startup_pipe = load_model()
+        startup_state.enter("warming")
+        if PROMPT_WARMUP_FILE:
+            with open(PROMPT_WARMUP_FILE) as f:
+                warmup_prompts = json.load(f)
+            warmed = prompt_cache.warm(startup_pipe, resolve_model_path(), warmup_prompts)
+            log.info(f"🔥 [LOCAL] Precomputed {warmed} prompt embeddings from {PROMPT_WARMUP_FILE}")
+        warm_up(startup_pipe)
+        startup_state.enter("ready")
+        timings = startup_state.stats()
+        log.info(f"⏱️ [LOCAL] Ready in {timings['time_to_ready_seconds']:.1f}s "
+                 f"(load {timings['loading_seconds']:.1f}s, warm-up {timings['warming_seconds']:.1f}s)")
+    except Exception as e:
+        startup_state.fail(e)
+        log.warning(f"⚠️ [LOCAL] Model will be loaded on first request: {e}")
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    print("🏥 [LOCAL] Health check requested")
+    log.debug("🏥 [LOCAL] Health check requested")
     status = {
-        "status": "ok",
+        "status": "ok" if startup_state.ready else startup_state.phase,
         "service": "Stable Diffusion img2img Editor",
         "model": model_source or "Not loaded yet",
         "device": "cuda" if torch.cuda.is_available() else "cpu",
         "pipeline_loaded": pipeline is not None,
-        "model_type": "StableDiffusionImg2ImgPipeline"
+        "startup": startup_state.stats(),
+        "model_pool": model_pool.stats(),
+        "model_type": "StableDiffusionImg2ImgPipeline",
+        "batching": scheduler.stats(),
+        "cache": result_cache.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "quality_tiers": QUALITY_TIERS,
+        "jobs": job_manager.stats(),
+        "sessions": session_store.stats(),
+        "workers": prefork.stats(units="images")
     }
-    print(f"🏥 [LOCAL] Health status: {json.dumps(status, indent=2)}")
     return jsonify(status)
 
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness probe: the process is up and serving HTTP (the model may still be loading)"""
+    return jsonify({"status": "alive"})
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness probe: 200 once the default pipeline is loaded and warmed up, 503 before"""
+    state = startup_state.stats()
+    return jsonify(state), 200 if state["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: requests, errors, queue depth, stage latencies, throughput"""
+    # Pre-fork mode: pool-wide series from shared memory; the rest are this worker's (labelled worker=N)
+    return Response(metrics.render() + prefork.render_metrics(metrics.namespace, units="images"),
+                    content_type=CONTENT_TYPE)
+
+def read_upload():
+    """
+    Read the image, optional mask and parameters of a request in any supported transport
+    
+    Accepts:
+        - application/json with a base64 'image' field (original API)
+        - multipart/form-data with an 'image' file part and the other parameters as form fields
+        - a raw image/* body with the parameters in the query string
+    
+    Returns:
+        (fields, image_bytes, mask_bytes) - raises ValueError on undecodable base64
+    """
+    if request.mimetype == 'multipart/form-data':
+        fields = request.form.to_dict()
+        upload = request.files.get('image')
+        mask_upload = request.files.get('mask')
+        return fields, upload.read() if upload else None, mask_upload.read() if mask_upload else None
+    if request.mimetype.startswith('image/'):
+        return request.args.to_dict(), request.get_data() or None, None
+    fields = request.get_json(silent=True) or {}
+    image_base64 = fields.get('image')
+    mask_base64 = fields.get('mask')
+    return (fields, base64_to_bytes(image_base64) if image_base64 else None,
+            base64_to_bytes(mask_base64) if mask_base64 else None)
+
+def read_edit_request():
+    """
+    Read an edit request in any supported transport (see read_upload())
+    
+    Returns:
+        (params, fields, error) - see parse_edit_params(); fields is the raw parameter mapping
+    """
+    decode_start = time.perf_counter()
+    try:
+        fields, image_bytes, mask_bytes = read_upload()
+    except ValueError as e:
+        return None, {}, f"Invalid image data: {e}"
+    decode_ms = (time.perf_counter() - decode_start) * 1000
+    
+    params, error = parse_edit_params(fields, image_bytes, mask_bytes)
+    if params is not None:
+        params["timing"]["transport_decode_ms"] = round(decode_ms, 3)
+        metrics.observe("stage_seconds", decode_ms / 1000, stage="transport")
+    return params, fields, error
+
+def negotiate_output(fields):
+    """
+    Pick the output encoding from the 'format'/'quality'/'response' parameters and the Accept header
+    Raw bytes are returned when 'response' is 'binary' or the client prefers an image/* type over JSON.
+    """
+    best = request.accept_mimetypes.best_match(
+        ['application/json', 'image/webp', 'image/jpeg', 'image/png']
+    ) or 'application/json'
+    image_format = str(fields.get('format') or '').lower()
+    if not image_format:
+        image_format = best.split('/')[1] if best.startswith('image/') else 'png'
+    binary = str(fields.get('response') or '').lower() == 'binary' or best.startswith('image/')
+    quality = fields.get('quality')
+    return {
+        "format": image_format,
+        "quality": int(quality) if quality not in (None, '') else None,
+        "binary": binary
+    }
+
+def parse_edit_params(fields, image_bytes, mask_bytes=None):
+    """
+    Validate edit request fields
+    
+    Returns:
+        (params, error) - params dict on success, otherwise an error message for a 400 response
+    """
+    if not fields and not image_bytes:
+        return None, "No data provided"
+    
+    try:
+        seed = fields.get('seed')
+        tier = fields.get('tier') or None
+        if tier is not None and tier not in QUALITY_TIERS:
+            return None, f"Unknown tier: {tier} (expected one of {', '.join(QUALITY_TIERS)})"
+        default_steps = QUALITY_TIERS[tier]["steps"] if tier else 30
+        params = {
+            "prompt": fields.get('prompt'),
+            "negative_prompt": fields.get('negative_prompt') or None,  # Optional: what to steer away from
+            "image_bytes": image_bytes,
+            "model_path": fields.get('model_path'),  # Optional: specify model
+            "github_token": fields.get('github_token'),  # Optional: GitHub token
+            # Optional parameters for Stable Diffusion img2img
+            "strength": float(fields.get('strength', 0.6)),  # How much to change (0.0-1.0)
+            "guidance_scale": float(fields.get('guidance_scale', 7.5)),  # How closely to follow prompt
+            "num_inference_steps": int(fields.get('num_inference_steps', default_steps)),  # Quality vs speed
+            # Optional: 'preview' / 'standard' / 'final' - picks scheduler, default steps and resolution bucket
+            "tier": tier,
+            # Optional: fixed seed for reproducible (and cacheable) results
+            "seed": int(seed) if seed not in (None, '') else None,
+            # Optional: hair region mode - box/'auto' or a mask; only that crop goes through the UNet
+            "region": parse_region(fields.get('region')),
+            "mask_bytes": mask_bytes,
+            # Optional: try-on session from POST /sessions, replacing the image (and its mask)
+            "session_id": fields.get('session_id') or None,
+            "session": None,
+            "output": negotiate_output(fields),
+            # Optional (/edit-image/stream): denoising steps between latent previews, 0 = none
+            "preview_every": int(fields.get('preview_every', STREAM_PREVIEW_EVERY)),
+            # Optional: deadline in milliseconds, after which the edit is abandoned (504)
+            "timeout": float(fields['timeout_ms']) / 1000.0 if fields.get('timeout_ms') not in (None, '')
+            else REQUEST_TIMEOUT_SECONDS,
+            "cancel": None,
+            "bounded": True,
+            "timing": {},
+        }
+    except (TypeError, ValueError, KeyError) as e:
+        return None, f"Invalid parameter: {e}"
+    
+    if not params["prompt"]:
+        return None, "Prompt is required"
+    
+    if params["session_id"]:
+        if params["image_bytes"]:
+            return None, "Send either an image or a session_id, not both"
+        params["session"] = session_store.get(params["session_id"])
+        if params["session"] is None:
+            return None, f"Unknown or expired session: {params['session_id']}"
+        params["mask_bytes"] = params["mask_bytes"] or params["session"]["mask_bytes"]
+    elif not params["image_bytes"]:
+        return None, "Image is required"
+    
+    if params["output"]["format"] not in OUTPUT_FORMATS:
+        return None, f"Unsupported output format: {params['output']['format']}"
+    
+    return params, None
+
+def decode_input_image(image_bytes, timing):
+    """
+    Decode an uploaded photo and cap its long side at 1024px (to save memory and speed up processing)
+    
+    Returns:
+        (image, original_size)
+    """
+    log.debug("🔄 [LOCAL] Decoding input image...")
+    decode_start = time.perf_counter()
+    input_image = bytes_to_image(image_bytes)
+    metrics.observe("stage_seconds", time.perf_counter() - decode_start, stage="decode")
+    timing["image_decode_ms"] = round((time.perf_counter() - decode_start) * 1000, 3)
+    log.debug(f"✅ [LOCAL] Input image size: {input_image.size}")
+    
+    max_size = 1024
+    original_size = input_image.size
+    if max(input_image.size) > max_size:
+        input_image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        log.debug(f"🔄 [LOCAL] Resized image from {original_size} to {input_image.size}")
+    return input_image, original_size
+
+def run_edit(params, step_callback=None):
+    """
+    Run one img2img edit: cache lookup, model load, decode/resize and batched generation
+    
+    Args:
+        params: Dict returned by parse_edit_params()
+        step_callback: Optional callable(step, total_steps, latents) invoked after each denoising step
+    
+    Returns:
+        Dict with the edited PIL image, model, cached flag and batch size
+    
+    Raises:
+        Overloaded if the inference queue is full, RequestCancelled if params["cancel"] fires
+    """
+    prompt = params["prompt"]
+    model_path = params["model_path"]
+    strength = params["strength"]
+    guidance_scale = params["guidance_scale"]
+    num_inference_steps = params["num_inference_steps"]
+    seed = params["seed"]
+    
+    log.debug(f"✅ [LOCAL] Prompt: {prompt[:100]}...")
+    log.debug(f"✅ [LOCAL] Parameters: strength={strength}, guidance_scale={guidance_scale}, steps={num_inference_steps}")
+    
+    if model_path:
+        log.debug(f"🔄 [LOCAL] Using custom model: {model_path}")
+    
+    # Serve repeated edits from the result cache before touching the model
+    session = params["session"]
+    # Session edits start from posterior-mean latents (see encode_latents), so their results are
+    # keyed on the session photo's hash rather than shared with edits of the uploaded bytes
+    image_bytes = f"session:{session['image_hash']}".encode() if session is not None else params["image_bytes"]
+    region_mode = params["region"] is not None or params["mask_bytes"] is not None
+    region_key = None
+    if region_mode:
+        region_key = [params["region"], CROP_BUCKET, CROP_PADDING, CROP_FEATHER,
+                      hashlib.sha256(params["mask_bytes"]).hexdigest() if params["mask_bytes"] else None]
+    cache_key = ResultCache.make_key(image_bytes, prompt, strength, guidance_scale,
+                                     num_inference_steps, seed, resolve_model_path(model_path),
+                                     params["negative_prompt"], region_key, params["tier"])
+    cached_image = result_cache.get(cache_key)
+    metrics.inc("result_cache_total", status="hit" if cached_image is not None else "miss")
+    if cached_image is not None:
+        log.debug(f"✅ [LOCAL] Cache hit ({cache_key[:12]}), skipping generation")
+        return {"image": cached_image, "model": resolve_model_path(model_path), "cached": True, "batch_size": None}
+    
+    # Reject before decoding when the queue is already full
+    if params["bounded"]:
+        scheduler.check_capacity()
+    
+    # Load model if not already loaded
+    log.debug("🔄 [LOCAL] Loading/checking Stable Diffusion model...")
+    pipe = load_model(model_path=model_path, github_token=params["github_token"], cancel=params["cancel"])
+    
+    if pipe is None:
+        raise RuntimeError("Failed to load model")
+    
+    if session is not None:
+        # Try-on session: decoded and size-capped once at upload
+        input_image, original_size = session["image"], session["original_size"]
+        log.debug(f"✅ [LOCAL] Using session {session['id']} ({input_image.size})")
+    else:
+        input_image, original_size = decode_input_image(image_bytes, params["timing"])
+    
+    # Quality tier: long side capped at the tier's bucket, both sides snapped to the nearest multiple of 64
+    tier = QUALITY_TIERS[params["tier"]] if params["tier"] else None
+    if tier and not region_mode:
+        target_size = bucket_size(*input_image.size, min(tier["bucket"], max(input_image.size)))
+        if target_size != input_image.size:
+            input_image = input_image.resize(target_size, Image.Resampling.LANCZOS)
+            log.debug(f"🔄 [LOCAL] Tier '{params['tier']}': snapped image to {target_size}")
+    
+    # Hair-region mode: only a padded crop around the head is diffused
+    crop = None
+    if region_mode:
+        region = params["region"]
+        if isinstance(region, tuple) and input_image.size != original_size:
+            scale = input_image.size[0] / original_size[0]
+            region = tuple(v * scale for v in region)
+        mask_image = None
+        if params["mask_bytes"]:
+            mask_image = Image.open(io.BytesIO(params["mask_bytes"])).convert("L").resize(input_image.size)
+        crop = prepare_region_crop(input_image, region, mask_image,
+                                   min(tier["bucket"], CROP_BUCKET) if tier else CROP_BUCKET)
+        log.debug(f"✂️ [LOCAL] Region mode: crop {crop['box']} -> bucket {crop['bucket']}")
+    
+    # Generate edited image using Stable Diffusion img2img
+    log.debug("🔄 [LOCAL] Generating edited image with Stable Diffusion img2img...")
+    log.debug(f"🔄 [LOCAL] This may take {num_inference_steps * 2}-{num_inference_steps * 3} seconds...")
+    log.debug("🔄 [LOCAL] ⏳ Processing...")
+    
+    generation_start = time.time()
+    
+    # Stable Diffusion img2img pipeline, batched with compatible concurrent requests
+    pipeline_image = crop["image"] if crop else input_image
+    edited_image, batch_size = wait_result(scheduler.submit(
+        pipe,
+        prompt=prompt,
+        image=pipeline_image,
+        strength=strength,  # How much to change (0.0 = no change, 1.0 = full change)
+        guidance_scale=guidance_scale,  # How closely to follow prompt
+        num_inference_steps=num_inference_steps,  # More steps = better quality but slower
+        seed=seed,
+        callback=step_callback,
+        negative_prompt=params["negative_prompt"],
+        model=resolve_model_path(model_path),
+        scheduler_name=tier["scheduler"] if tier else "default",
+        cancel=params["cancel"],
+        bounded=params["bounded"],
+        session=session,
+        view=("crop",) + tuple(crop["box"]) + tuple(crop["bucket"]) if crop else pipeline_image.size
+    ), params["cancel"])
+    if crop:
+        edited_image = composite_region(input_image, edited_image, crop)
+    result_cache.put(cache_key, edited_image)
+    
+    generation_duration = time.time() - generation_start
+    params["timing"]["generate_ms"] = round(generation_duration * 1000, 3)
+    log.debug(f"✅ [LOCAL] Generation complete in {generation_duration:.2f} seconds (batch size {batch_size})")
+    
+    result = {"image": edited_image, "model": resolve_model_path(model_path), "cached": False, "batch_size": batch_size}
+    if crop:
+        result["region"] = {"crop_box": list(crop["box"]), "bucket": list(crop["bucket"])}
+    if tier:
+        result["tier"] = {
+            "name": params["tier"],
+            "scheduler": tier["scheduler"],
+            "steps": num_inference_steps,
+            "bucket": list(crop["bucket"] if crop else input_image.size)
+        }
+    return result
+
+def edit_result_metadata(params, result):
+    """Metadata describing a finished edit (JSON body minus the image)"""
+    metadata = {
+        "success": True,
+        "model": result["model"],
+        "parameters": {
+            "strength": params["strength"],
+            "guidance_scale": params["guidance_scale"],
+            "num_inference_steps": params["num_inference_steps"],
+            "seed": params["seed"]
+        },
+        "cached": result["cached"],
+        "format": params["output"]["format"],
+        "timing": params["timing"]
+    }
+    if result["batch_size"] is not None:
+        metadata["batch_size"] = result["batch_size"]
+    if result.get("region"):
+        metadata["region"] = result["region"]
+    if result.get("tier"):
+        metadata["tier"] = result["tier"]
+    return metadata
+
+def edit_response_body(params, result):
+    """JSON body for a finished edit (shared by /edit-image and /edit-jobs)"""
+    # Convert back to base64
+    log.debug(f"🔄 [LOCAL] Encoding result as base64 {params['output']['format']}...")
+    encode_start = time.perf_counter()
+    image_base64 = image_to_base64(result["image"], params["output"]["format"], params["output"]["quality"])
+    metrics.observe("stage_seconds", time.perf_counter() - encode_start, stage="encode")
+    params["timing"]["encode_ms"] = round((time.perf_counter() - encode_start) * 1000, 3)
+    body = edit_result_metadata(params, result)
+    body["image"] = image_base64
+    return body
+
+def edit_binary_response(params, result):
+    """Raw image bytes for a finished edit, metadata in headers"""
+    encode_start = time.perf_counter()
+    image_bytes, mimetype = encode_image(result["image"], params["output"]["format"], params["output"]["quality"])
+    metrics.observe("stage_seconds", time.perf_counter() - encode_start, stage="encode")
+    params["timing"]["encode_ms"] = round((time.perf_counter() - encode_start) * 1000, 3)
+    headers = {
+        "X-Model": str(result["model"]),
+        "X-Cached": "true" if result["cached"] else "false",
+        "Server-Timing": ", ".join(f"{name.replace('_ms', '')};dur={value}"
+                                   for name, value in params["timing"].items()),
+    }
+    if result["batch_size"] is not None:
+        headers["X-Batch-Size"] = str(result["batch_size"])
+    if params["seed"] is not None:
+        headers["X-Seed"] = str(params["seed"])
+    return Response(image_bytes, mimetype=mimetype, headers=headers)
+
 @app.route('/edit-image', methods=['POST'])
 def edit_image():
     """
     REST endpoint for Stable Diffusion img2img
-    Takes: image (base64) + prompt + optional parameters
-    Returns: transformed image (base64)
+    Takes: image (base64 JSON, multipart file or raw image/* body) or a 'session_id' from POST /sessions
+    + prompt + optional parameters
+    Returns: transformed image (base64 JSON, or raw bytes when negotiated via Accept/'response')
     """
     try:
-        print("=" * 60)
-        print("🎨 [LOCAL] ===== IMAGE EDIT REQUEST RECEIVED =====")
-        print("=" * 60)
-        
-        data = request.json
-        
-        if not data:
-            print("❌ [LOCAL] ERROR: No data provided")
-            return jsonify({"error": "No data provided"}), 400
-        
-        prompt = data.get('prompt')
-        image_base64 = data.get('image')
-        model_path = data.get('model_path')  # Optional: specify model
-        github_token = data.get('github_token')  # Optional: GitHub token
-        
-        # Optional parameters for Stable Diffusion img2img
-        strength = data.get('strength', 0.6)  # How much to change (0.0-1.0)
-        guidance_scale = data.get('guidance_scale', 7.5)  # How closely to follow prompt
-        num_inference_steps = data.get('num_inference_steps', 30)  # Quality vs speed
-        
-        if not prompt:
-            print("❌ [LOCAL] ERROR: Prompt is required")
-            return jsonify({"error": "Prompt is required"}), 400
-        
-        if not image_base64:
-            print("❌ [LOCAL] ERROR: Image is required")
-            return jsonify({"error": "Image is required"}), 400
-        
-        print(f"✅ [LOCAL] Prompt: {prompt[:100]}...")
-        print(f"✅ [LOCAL] Parameters: strength={strength}, guidance_scale={guidance_scale}, steps={num_inference_steps}")
+        log.debug("🎨 [LOCAL] ===== IMAGE EDIT REQUEST RECEIVED =====")
         
-        if model_path:
-            print(f"🔄 [LOCAL] Using custom model: {model_path}")
+        params, fields, error = read_edit_request()
+        if error:
+            log.error(f"❌ [LOCAL] ERROR: {error}")
+            return jsonify({"error": error}), 400
         
-        # Load model if not already loaded
-        print("🔄 [LOCAL] Loading/checking Stable Diffusion model...")
-        pipe = load_model(model_path=model_path, github_token=github_token)
-        
-        if pipe is None:
-            print("❌ [LOCAL] ERROR: Failed to load model")
-            return jsonify({
-                "error": "Failed to load model",
-                "details": "Model could not be loaded. Check logs for details."
-            }), 500
-        
-        # Convert base64 to image
-        print("🔄 [LOCAL] Converting base64 to image...")
-        input_image = base64_to_image(image_base64)
-        print(f"✅ [LOCAL] Input image size: {input_image.size}")
-        
-        # Resize image if too large (to save memory and speed up processing)
-        max_size = 1024
-        if max(input_image.size) > max_size:
-            original_size = input_image.size
-            input_image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            print(f"🔄 [LOCAL] Resized image from {original_size} to {input_image.size}")
-        
-        # Generate edited image using Stable Diffusion img2img
-        print("🔄 [LOCAL] Generating edited image with Stable Diffusion img2img...")
-        print(f"🔄 [LOCAL] This may take {num_inference_steps * 2}-{num_inference_steps * 3} seconds...")
-        print("🔄 [LOCAL] ⏳ Processing...")
-        
-        import time
-        generation_start = time.time()
-        
-        # Stable Diffusion img2img pipeline
-        edited_image = pipe(
-            prompt=prompt,
-            image=input_image,
-            strength=strength,  # How much to change (0.0 = no change, 1.0 = full change)
-            guidance_scale=guidance_scale,  # How closely to follow prompt
-            num_inference_steps=num_inference_steps  # More steps = better quality but slower
-        ).images[0]
-        
-        generation_duration = time.time() - generation_start
-        print(f"✅ [LOCAL] Generation complete in {generation_duration:.2f} seconds")
-        
-        # Convert back to base64
-        print("🔄 [LOCAL] Converting result to base64...")
-        result_base64 = image_to_base64(edited_image)
+        params["cancel"] = Cancellation.for_request(request.environ, params["timeout"])
+        result = run_edit(params)
+        if params["output"]["binary"]:
+            response = edit_binary_response(params, result)
+        else:
+            response = jsonify(edit_response_body(params, result))
         
-        print("=" * 60)
-        print("✅ [LOCAL] ✅✅✅ IMAGE EDITED SUCCESSFULLY! ✅✅✅")
-        print("=" * 60)
+        log.debug("✅ [LOCAL] ✅✅✅ IMAGE EDITED SUCCESSFULLY! ✅✅✅")
+        log.debug(f"✅ [LOCAL] Transport timing (ms): {params['timing']}")
         
-        return jsonify({
-            "success": True,
-            "image": result_base64,
-            "model": model_source,
-            "parameters": {
-                "strength": strength,
-                "guidance_scale": guidance_scale,
-                "num_inference_steps": num_inference_steps
-            }
-        })
+        return response
         
+    except (Overloaded, RequestCancelled) as e:
+        log.warning(f"⚠️ [LOCAL] {e}")
+        return error_response(e)
     except Exception as e:
-        print(f"❌ [LOCAL] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ [LOCAL] ERROR: {e}")
         return jsonify({
             "error": str(e),
             "details": "Failed to edit image. Make sure the model is loaded correctly."
         }), 500
 
-if __name__ == '__main__':
-    print("=" * 60)
-    print("🚀 [LOCAL] Starting Stable Diffusion img2img Service...")
-    print("🚀 [LOCAL] Open source, self-hosted - 100% FREE!")
-    print("🚀 [LOCAL] No API credits needed, no vendor lock-in!")
-    print("=" * 60)
+@app.route('/edit-image/stream', methods=['POST'])
+def edit_image_stream():
+    """
+    Streaming variant of /edit-image (Server-Sent Events)
+    Takes: same body as /edit-image, plus optional 'preview_every' (steps between previews, 0 = none)
+    Emits: 'progress' events with step and a low-res latent preview, then a final 'result'
+    event carrying the /edit-image response plus timing of the preview path
+    """
+    params, fields, error = read_edit_request()
+    if error:
+        log.error(f"❌ [LOCAL] ERROR: {error}")
+        return jsonify({"error": error}), 400
     
-    # Load model on startup (optional - can also lazy load)
+    preview_every = params["preview_every"]
+    # Closing the event stream (client gone) also cancels the edit
+    cancel = params["cancel"] = Cancellation.for_request(request.environ, params["timeout"])
     try:
-        print("🔄 [LOCAL] Pre-loading model on startup...")
-        load_model()
+        scheduler.check_capacity()
+    except Overloaded as e:
+        log.warning(f"⚠️ [LOCAL] {e}")
+        return error_response(e)
+    events = queue.Queue()
+    preview_seconds = [0.0]
+    
+    def on_step(step, total_steps, latents):
+        payload = {"step": step, "total_steps": total_steps}
+        if preview_every > 0 and (step % preview_every == 0) and step < total_steps:
+            preview_start = time.perf_counter()
+            preview = latents_to_preview(latents)
+            if preview is not None:
+                payload["preview"] = preview_to_base64(preview)
+                payload["preview_size"] = list(preview.size)
+            preview_seconds[0] += time.perf_counter() - preview_start
+        events.put(("progress", payload))
+    
+    def worker():
+        start = time.perf_counter()
+        try:
+            result = run_edit(params, step_callback=on_step)
+            body = edit_response_body(params, result)
+            total = time.perf_counter() - start
+            body["timing"] = {
+                "total_seconds": round(total, 4),
+                "preview_seconds": round(preview_seconds[0], 4),
+                "preview_overhead_pct": round(100.0 * preview_seconds[0] / total, 3) if total > 0 else 0.0
+            }
+            log.info(f"✅ [LOCAL] Stream finished in {total:.2f}s, previews took {preview_seconds[0] * 1000:.1f}ms "
+                     f"({body['timing']['preview_overhead_pct']}% overhead)")
+            events.put(("result", body))
+        except (Overloaded, RequestCancelled) as e:
+            log.warning(f"⚠️ [LOCAL] {e}")
+            events.put(("error", {"error": str(e), "cancelled": getattr(e, "reason", None),
+                                  "retry_after": getattr(e, "retry_after", None)}))
+        except Exception as e:
+            log.exception(f"❌ [LOCAL] ERROR: {e}")
+            metrics.inc("failures_total", path="stream")
+            events.put(("error", {"error": str(e), "details": "Failed to edit image."}))
+    
+    def stream():
+        threading.Thread(target=worker, name="edit-stream", daemon=True).start()
+        try:
+            while True:
+                event, payload = events.get()
+                yield sse_event(event, payload)
+                if event in ("result", "error"):
+                    break
+        finally:
+            # Runs on GeneratorExit when the client disconnects mid-stream
+            cancel.cancel()
+    
+    log.debug("🎨 [LOCAL] ===== STREAMING IMAGE EDIT REQUEST RECEIVED =====")
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+fanout_executor = ThreadPoolExecutor(max_workers=max(1, FANOUT_WORKERS), thread_name_prefix="edit-fanout")
+
+def parse_fanout_prompts(fields):
+    """
+    Validate the 'prompts' list of a fan-out request
+    Entries are prompt strings or {'prompt', 'seed', 'negative_prompt'} objects; items without a seed
+    get the request's 'seed' plus their index (so the grid is reproducible), or none.
+    
+    Returns:
+        (items, error) - items are dicts with prompt, seed and negative_prompt
+    """
+    prompts = fields.get('prompts')
+    if isinstance(prompts, str):
+        # Multipart and query-string requests send the list as JSON text
+        try:
+            prompts = json.loads(prompts)
+        except ValueError:
+            return None, "prompts must be a JSON list"
+    if not isinstance(prompts, list) or not prompts:
+        return None, "prompts must be a non-empty list"
+    if len(prompts) > FANOUT_MAX_PROMPTS:
+        return None, f"At most {FANOUT_MAX_PROMPTS} prompts per request"
+    
+    base_seed = fields.get('seed')
+    items = []
+    try:
+        for index, entry in enumerate(prompts):
+            entry = {"prompt": entry} if isinstance(entry, str) else entry
+            if not isinstance(entry, dict) or not entry.get('prompt'):
+                return None, f"prompts[{index}] needs a prompt"
+            seed = entry.get('seed')
+            if seed in (None, '') and base_seed not in (None, ''):
+                seed = int(base_seed) + index
+            items.append({
+                "prompt": entry['prompt'],
+                "seed": int(seed) if seed not in (None, '') else None,
+                "negative_prompt": entry.get('negative_prompt') or fields.get('negative_prompt') or None,
+            })
+    except (TypeError, ValueError) as e:
+        return None, f"Invalid seed: {e}"
+    return items, None
+
+@app.route('/edit-image/batch', methods=['POST'])
+def edit_image_batch():
+    """
+    Fan one photo out to several hairstyles (Server-Sent Events)
+    Takes: image (any /edit-image transport) or 'session_id', 'prompts' (strings or {prompt, seed,
+    negative_prompt}), optional 'chunk_size' and the shared /edit-image parameters
+    Emits: an 'item' event per prompt as soon as its chunk produces it (image plus timing), then a
+    'result' summary with the session id for further try-ons of the same photo
+    """
+    start = time.perf_counter()
+    try:
+        fields, image_bytes, mask_bytes = read_upload()
+    except ValueError as e:
+        return jsonify({"error": f"Invalid image data: {e}"}), 400
+    transport_ms = (time.perf_counter() - start) * 1000
+    
+    items, error = parse_fanout_prompts(fields)
+    if error is None:
+        # Shared parameters are validated like a single edit of the first prompt
+        params, error = parse_edit_params(dict(fields, prompt=items[0]["prompt"]), image_bytes, mask_bytes)
+    if error is None:
+        try:
+            chunk_size = max(1, int(fields.get('chunk_size') or FANOUT_CHUNK_SIZE))
+        except (TypeError, ValueError):
+            error = "chunk_size must be an integer"
+    if error:
+        log.error(f"❌ [LOCAL] ERROR: {error}")
+        return jsonify({"error": error}), 400
+    
+    try:
+        scheduler.check_capacity()
+    except Overloaded as e:
+        log.warning(f"⚠️ [LOCAL] {e}")
+        return error_response(e)
+    
+    # Decode and size-cap the photo once; its session then caches the VAE latents for every prompt
+    timing = {"transport_decode_ms": round(transport_ms, 3)}
+    if params["session"] is None:
+        try:
+            image, original_size = decode_input_image(image_bytes, timing)
+        except Exception as e:
+            return jsonify({"error": f"Invalid image data: {e}"}), 400
+        params["session"] = session_store.create(image_bytes, image, original_size, mask_bytes)
+        params["image_bytes"] = None
+    session = params["session"]
+    cancel = params["cancel"] = Cancellation.for_request(request.environ, params["timeout"])
+    # The whole fan-out was admitted above; its chunks are throttled by running one after another
+    params["bounded"] = False
+    events = queue.Queue()
+    
+    def run_item(index, item):
+        item_params = dict(params, timing={}, **item)
+        item_start = time.perf_counter()
+        result = run_edit(item_params)
+        body = edit_response_body(item_params, result)
+        body["index"] = index
+        body["prompt"] = item["prompt"]
+        body["timing"]["total_ms"] = round((time.perf_counter() - item_start) * 1000, 3)
+        return body
+    
+    def worker():
+        first_item_ms = None
+        succeeded = failed = 0
+        try:
+            for chunk_start in range(0, len(items), chunk_size):
+                cancel.check()
+                chunk_begin = time.perf_counter()
+                futures = {fanout_executor.submit(run_item, index, items[index]): index
+                           for index in range(chunk_start, min(chunk_start + chunk_size, len(items)))}
+                for future in as_completed(futures):
+                    try:
+                        body = future.result()
+                    except RequestCancelled:
+                        raise
+                    except Exception as e:
+                        log.error(f"❌ [LOCAL] Fan-out item {futures[future]} failed: {e}")
+                        metrics.inc("failures_total", path="fanout")
+                        failed += 1
+                        events.put(("item", {"index": futures[future], "success": False, "error": str(e)}))
+                        continue
+                    body["timing"]["chunk_ms"] = round((time.perf_counter() - chunk_begin) * 1000, 3)
+                    if first_item_ms is None:
+                        first_item_ms = round((time.perf_counter() - start) * 1000, 3)
+                    succeeded += 1
+                    events.put(("item", body))
+            total_ms = (time.perf_counter() - start) * 1000
+            log.info(f"✅ [LOCAL] Fan-out of {len(items)} prompts finished in {total_ms / 1000:.2f}s "
+                     f"(chunks of {chunk_size}, first image after {first_item_ms}ms)")
+            events.put(("result", {
+                "success": failed == 0,
+                "session_id": session["id"],
+                "count": len(items),
+                "succeeded": succeeded,
+                "failed": failed,
+                "chunk_size": chunk_size,
+                "timing": {**timing, "time_to_first_item_ms": first_item_ms, "total_ms": round(total_ms, 3)}
+            }))
+        except (Overloaded, RequestCancelled) as e:
+            log.warning(f"⚠️ [LOCAL] {e}")
+            events.put(("error", {"error": str(e), "cancelled": getattr(e, "reason", None),
+                                  "retry_after": getattr(e, "retry_after", None), "session_id": session["id"]}))
+        except Exception as e:
+            log.exception(f"❌ [LOCAL] ERROR: {e}")
+            metrics.inc("failures_total", path="fanout")
+            events.put(("error", {"error": str(e), "details": "Failed to edit image."}))
+    
+    def stream():
+        threading.Thread(target=worker, name="edit-fanout", daemon=True).start()
+        try:
+            while True:
+                event, payload = events.get()
+                yield sse_event(event, payload)
+                if event in ("result", "error"):
+                    break
+        finally:
+            # Runs on GeneratorExit when the client disconnects mid-stream
+            cancel.cancel()
+    
+    log.debug(f"🎨 [LOCAL] ===== FAN-OUT EDIT REQUEST RECEIVED ({len(items)} prompts) =====")
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/prompt-cache/warm', methods=['POST'])
+def warm_prompt_cache():
+    """
+    Precompute text embeddings for a hairstyle catalog
+    Takes: {'prompts': [...], 'negative_prompt': optional, 'model_path': optional, 'github_token': optional}
+    """
+    data = request.get_json(silent=True) or {}
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+        return jsonify({"error": "prompts must be a non-empty list of strings"}), 400
+    
+    try:
+        model = resolve_model_path(data.get('model_path'))
+        pipe = load_model(model_path=data.get('model_path'), github_token=data.get('github_token'))
+        start = time.time()
+        encoded = prompt_cache.warm(pipe, model, prompts, data.get('negative_prompt') or None)
+        duration = time.time() - start
+        log.info(f"🔥 [LOCAL] Warmed prompt cache: {encoded} new of {len(prompts)} prompts in {duration:.2f}s")
+        return jsonify({
+            "success": True,
+            "model": model,
+            "prompts": len(prompts),
+            "encoded": encoded,
+            "duration_seconds": round(duration, 3),
+            "prompt_cache": prompt_cache.stats()
+        })
     except Exception as e:
-        print(f"⚠️ [LOCAL] Model will be loaded on first request: {e}")
+        log.error(f"❌ [LOCAL] ERROR: {e}")
+        return jsonify({"error": str(e), "details": "Failed to warm prompt cache."}), 500
+
+@app.route('/edit-jobs', methods=['POST'])
+def create_edit_job():
+    """
+    Start an img2img edit in the background
+    Takes: same body as /edit-image
+    Returns: job id (202) - poll GET /edit-jobs/<id> for progress and the result
+    """
+    params, fields, error = read_edit_request()
+    if error:
+        log.error(f"❌ [LOCAL] ERROR: {error}")
+        return jsonify({"error": error}), 400
+    
+    # Jobs outlive the request, so only the deadline applies; admission is bounded by the job
+    # manager's active-job limit (their scheduler submissions then skip the queue limit)
+    params["cancel"] = Cancellation(params["timeout"])
+    params["bounded"] = False
+    try:
+        job_id = job_manager.submit(params, run_edit, edit_response_body)
+    except Overloaded as e:
+        log.warning(f"⚠️ [LOCAL] {e}")
+        return error_response(e)
+    log.debug(f"🧾 [LOCAL] Queued edit job {job_id}")
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/edit-jobs/{job_id}"
+    }), 202
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """
+    Start a try-on session: upload the photo once, then edit it by 'session_id' with only prompt and parameters
+    Takes: image (+ optional mask) in any /edit-image transport
+    Returns: session id (201) - the session expires EDIT_SESSION_TTL_SECONDS after its last use
+    """
+    start = time.perf_counter()
+    try:
+        fields, image_bytes, mask_bytes = read_upload()
+    except ValueError as e:
+        return jsonify({"error": f"Invalid image data: {e}"}), 400
+    if not image_bytes:
+        return jsonify({"error": "Image is required"}), 400
+    
+    timing = {"transport_decode_ms": round((time.perf_counter() - start) * 1000, 3)}
+    try:
+        image, original_size = decode_input_image(image_bytes, timing)
+    except Exception as e:
+        return jsonify({"error": f"Invalid image data: {e}"}), 400
+    session = session_store.create(image_bytes, image, original_size, mask_bytes)
+    log.info(f"🪞 [LOCAL] Started session {session['id']} ({image.size[0]}x{image.size[1]})")
+    return jsonify({"success": True, **session_store.describe(session), "timing": timing}), 201
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Metadata of a try-on session (image size, cached latents, memory, expiry)"""
+    session = session_store.get(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found or expired"}), 404
+    return jsonify(session_store.describe(session))
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    """End a try-on session and free its memory"""
+    if not session_store.delete(session_id):
+        return jsonify({"error": "Session not found or expired"}), 404
+    return jsonify({"success": True, "session_id": session_id})
+
+@app.route('/edit-jobs/<job_id>', methods=['GET'])
+def get_edit_job(job_id):
+    """Status, denoising progress and (when finished) the result of an edit job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    
+    body = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "step": job["step"],
+        "total_steps": job["total_steps"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"]
+    }
+    if job["status"] == "succeeded":
+        body["result"] = job["result"]
+    elif job["status"] in ("failed", "cancelled"):
+        body["error"] = job["error"]
+    return jsonify(body)
+
+if __name__ == '__main__':
+    log.info("=" * 60)
+    log.info("🚀 [LOCAL] Starting Stable Diffusion img2img Service...")
+    log.info("🚀 [LOCAL] Open source, self-hosted - 100% FREE!")
+    log.info("🚀 [LOCAL] No API credits needed, no vendor lock-in!")
+    log.info("=" * 60)
+    
+    if len(sys.argv) == 3 and sys.argv[1] == '--save-snapshot':
+        save_snapshot(sys.argv[2])
+        sys.exit(0)
+    
+    prefork_mode = WORKERS > 1 and not torch.cuda.is_available()
+    if WORKERS > 1 and not prefork_mode:
+        log.warning("⚠️ [LOCAL] EDIT_WORKERS ignored: CUDA cannot be shared across forked workers")
+    
+    # Load and warm up the model on startup: in the background while the server already answers
+    # /health/live, or before serving with EDIT_BACKGROUND_LOAD=0
+    log.info("🔄 [LOCAL] Pre-loading model on startup...")
+    if prefork_mode:
+        # Load once before forking so every worker shares the weights; each worker warms up itself
+        try:
+            startup_state.enter("loading")
+            load_model()
+        except Exception as e:
+            log.warning(f"⚠️ [LOCAL] Pre-fork load failed, each worker will load its own copy: {e}")
+    elif BACKGROUND_LOAD:
+        threading.Thread(target=warm_start, name="warm-start", daemon=True).start()
+    else:
+        warm_start()
     
     # Run on port 5000 (or PORT env variable)
     port = int(os.environ.get('PORT', 5000))
-    print("=" * 60)
-    print(f"🌐 [LOCAL] Server starting on http://localhost:{port}")
-    print(f"🌐 [LOCAL] Health check: http://localhost:{port}/health")
-    print(f"🌐 [LOCAL] Edit endpoint: http://localhost:{port}/edit-image")
-    print("=" * 60)
-    print("📝 [LOCAL] REST API Usage:")
-    print("   POST /edit-image")
-    print("   Body: {")
-    print("     'prompt': 'your prompt',")
-    print("     'image': 'base64_image_data',")
-    print("     'strength': 0.6,  // optional (0.0-1.0)")
-    print("     'guidance_scale': 7.5,  // optional")
-    print("     'num_inference_steps': 30  // optional")
-    print("   }")
-    print("=" * 60)
-    
-    app.run(host='0.0.0.0', port=port, debug=False)
+    log.info("=" * 60)
+    log.info(f"🌐 [LOCAL] Server starting on http://localhost:{port}")
+    log.info(f"🌐 [LOCAL] Health check: http://localhost:{port}/health")
+    log.info(f"🌐 [LOCAL] Probes: http://localhost:{port}/health/live, http://localhost:{port}/health/ready")
+    log.info(f"🌐 [LOCAL] Edit endpoint: http://localhost:{port}/edit-image")
+    log.info(f"🌐 [LOCAL] Streaming edit (SSE): http://localhost:{port}/edit-image/stream")
+    log.info(f"🌐 [LOCAL] Multi-style fan-out (SSE): http://localhost:{port}/edit-image/batch "
+             f"(up to {FANOUT_MAX_PROMPTS} prompts, chunks of {FANOUT_CHUNK_SIZE})")
+    log.info(f"🌐 [LOCAL] Async jobs: POST http://localhost:{port}/edit-jobs, GET /edit-jobs/<id>")
+    log.info(f"🌐 [LOCAL] Try-on sessions: POST http://localhost:{port}/sessions, then edit with 'session_id'")
+    log.info(f"🌐 [LOCAL] Metrics: http://localhost:{port}/metrics (log level: {os.environ.get('EDIT_LOG_LEVEL', 'INFO')})")
+    log.info("=" * 60)
+    log.info("📝 [LOCAL] REST API Usage:")
+    log.info("   POST /edit-image")
+    log.info("   Body: {")
+    log.info("     'prompt': 'your prompt',")
+    log.info("     'image': 'base64_image_data',")
+    log.info("     'strength': 0.6,  // optional (0.0-1.0)")
+    log.info("     'guidance_scale': 7.5,  // optional")
+    log.info("     'num_inference_steps': 30,  // optional")
+    log.info("     'seed': 42,  // optional")
+    log.info("     'timeout_ms': 60000,  // optional deadline; 504 once it passes")
+    log.info("     'negative_prompt': 'blurry, distorted',  // optional")
+    log.info("     'tier': 'preview',  // optional: preview / standard / final")
+    log.info("     'region': {'x': 120, 'y': 0, 'width': 400, 'height': 420},  // optional, or 'auto' / 'mask'")
+    log.info("     'format': 'webp', 'quality': 90  // optional output encoding (png/jpeg/webp)")
+    log.info("   }")
+    log.info("   Also accepts multipart/form-data (file part 'image') or a raw image/* body;")
+    log.info("   send 'Accept: image/webp' (or 'response': 'binary') to get raw image bytes back")
+    log.info("   or upload the photo once with POST /sessions and send 'session_id' instead of 'image'")
+    log.info(f"📦 [LOCAL] Micro-batching: max batch {BATCH_MAX_SIZE}, max wait {BATCH_MAX_WAIT_MS:.0f}ms "
+             "(EDIT_BATCH_MAX_SIZE / EDIT_BATCH_MAX_WAIT_MS)")
+    log.info(f"🚦 [LOCAL] Admission control: max queue {MAX_QUEUE or 'unbounded'}, default deadline "
+             f"{f'{REQUEST_TIMEOUT_SECONDS:g}s' if REQUEST_TIMEOUT_SECONDS else 'none'} "
+             "(EDIT_MAX_QUEUE / EDIT_REQUEST_TIMEOUT_SECONDS)")
+    log.info(f"🗄️ [LOCAL] Result cache: {CACHE_MAX_ENTRIES} in memory, "
+             f"disk: {CACHE_DIR + f' (max {CACHE_DISK_MAX_MB:.0f}MB)' if CACHE_DIR else 'disabled'} "
+             "(EDIT_CACHE_MAX_ENTRIES / EDIT_CACHE_DIR / EDIT_CACHE_DISK_MAX_MB)")
+    log.info("=" * 60)
+    
+    if prefork_mode:
+        prefork.serve(app, '0.0.0.0', port, WORKERS, WORKER_THREADS, log=log, tag="[LOCAL]",
+                      on_worker_start=warm_start, units="images", metrics=metrics)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
 
 
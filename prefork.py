@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Pre-fork serving shared by the local AI services
+The parent process loads the model once, then forks N HTTP workers on one listening socket. The
+workers share the weight pages copy-on-write instead of each calling from_pretrained, each runs
+torch with its own slice of the cores, and their request counts live in shared memory so any
+worker (and the parent's periodic report) can show per-worker memory and aggregate throughput.
+
+A scrape of /metrics reaches whichever worker accepts it. The pool_* series (render_metrics())
+come from the shared counters and cover every worker. The service's other series stay
+per-process and carry a worker label.
+"""
+
+import os
+import gc
+import time
+import signal
+import socket
+import threading
+import multiprocessing
+
+# Per-worker slots in the shared counters array
+_FIELDS = ("pid", "started_at", "requests", "errors", "busy_seconds", "units")
+
+_stats = None  # WorkerStats of the pool, created in the parent before forking
+_slot = None   # Index of this process's slot (set in each worker)
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_threads(workers):
+    """Torch intra-op threads per worker so that workers x threads does not exceed the cores"""
+    return max(1, available_cores() // max(1, workers))
+
+
+def process_memory_mb(pid="self"):
+    """
+    Memory of a process in MB: rss, pss (shared pages split between the processes mapping them),
+    shared and private. Empty dict where /proc/<pid>/smaps_rollup is unavailable.
+    """
+    fields = {"Rss": "rss_mb", "Pss": "pss_mb", "Shared_Clean": "shared_mb", "Shared_Dirty": "shared_mb",
+              "Private_Clean": "private_mb", "Private_Dirty": "private_mb"}
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    key = fields[name]
+                    memory[key] = memory.get(key, 0.0) + int(value.split()[0]) / 1024
+    except (OSError, ValueError, IndexError):
+        return {}
+    return {key: round(value, 1) for key, value in memory.items()}
+
+
+class WorkerStats:
+    """
+    Request and work-unit counters of every worker, in a shared-memory array inherited across fork.
+
+    Each worker only writes its own slot; readers take the array lock for a consistent snapshot.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.started_at = time.time()
+        self._values = multiprocessing.Array('d', workers * len(_FIELDS))
+
+    def reset(self, slot, pid):
+        with self._values.get_lock():
+            base = slot * len(_FIELDS)
+            for offset in range(len(_FIELDS)):
+                self._values[base + offset] = 0.0
+            self._values[base + _FIELDS.index("pid")] = pid
+            self._values[base + _FIELDS.index("started_at")] = time.time()
+
+    def add(self, slot, **increments):
+        with self._values.get_lock():
+            base = slot * len(_FIELDS)
+            for name, value in increments.items():
+                self._values[base + _FIELDS.index(name)] += value
+
+    def snapshot(self, units="units"):
+        """Per-worker counters and memory plus pool totals (requests/sec and units/sec since start)"""
+        with self._values.get_lock():
+            values = list(self._values)
+        now = time.time()
+        workers = []
+        for slot in range(self.workers):
+            row = dict(zip(_FIELDS, values[slot * len(_FIELDS):(slot + 1) * len(_FIELDS)]))
+            pid = int(row["pid"])
+            if not pid:
+                continue
+            uptime = now - row["started_at"]
+            workers.append({
+                "worker": slot,
+                "pid": pid,
+                "requests": int(row["requests"]),
+                "errors": int(row["errors"]),
+                units: int(row["units"]),
+                "busy_seconds": round(row["busy_seconds"], 3),
+                "busy_pct": round(100.0 * row["busy_seconds"] / uptime, 1) if uptime > 0 else 0.0,
+                **process_memory_mb(pid),
+            })
+        elapsed = now - self.started_at
+        requests = sum(w["requests"] for w in workers)
+        total_units = sum(w[units] for w in workers)
+        return {
+            "workers": workers,
+            "total": {
+                "workers": len(workers),
+                "requests": requests,
+                units: total_units,
+                "requests_per_sec": round(requests / elapsed, 3) if elapsed > 0 else 0.0,
+                f"{units}_per_sec": round(total_units / elapsed, 3) if elapsed > 0 else 0.0,
+                "rss_mb": round(sum(w.get("rss_mb", 0.0) for w in workers), 1),
+                "pss_mb": round(sum(w.get("pss_mb", 0.0) for w in workers), 1),
+            },
+        }
+
+
+def record_units(count):
+    """Count finished work units (images, tokens) for this worker; no-op outside pre-fork mode"""
+    if _slot is not None:
+        _stats.add(_slot, units=count)
+
+
+def stats(units="units"):
+    """Pool snapshot for /health, or None when the service runs as a single process"""
+    return _stats.snapshot(units) if _stats is not None else None
+
+
+def render_metrics(namespace, units="units"):
+    """
+    Pool-wide Prometheus series from the shared counters, the same whichever worker answers the
+    scrape ("" when the service runs as a single process)
+    """
+    if _stats is None:
+        return ""
+    from service_metrics import Metrics
+
+    pool = Metrics(namespace)
+    pool.gauge("pool_workers", "Live pre-forked workers")
+    pool.counter("pool_requests_total", "HTTP requests served, by pre-forked worker")
+    pool.counter("pool_errors_total", "HTTP requests that failed with a 5xx status, by pre-forked worker")
+    pool.counter(f"pool_{units}_total", f"Finished {units}, by pre-forked worker")
+    pool.counter("pool_busy_seconds_total", "Time spent serving requests, by pre-forked worker")
+    pool.gauge("pool_memory_bytes", "Memory of each pre-forked worker (pss splits shared pages between processes)")
+    snapshot = _stats.snapshot(units)
+    pool.set("pool_workers", snapshot["total"]["workers"])
+    for worker in snapshot["workers"]:
+        slot = str(worker["worker"])
+        pool.set("pool_requests_total", worker["requests"], worker=slot)
+        pool.set("pool_errors_total", worker["errors"], worker=slot)
+        pool.set(f"pool_{units}_total", worker[units], worker=slot)
+        pool.set("pool_busy_seconds_total", worker["busy_seconds"], worker=slot)
+        for kind in ("rss", "pss"):
+            if f"{kind}_mb" in worker:
+                pool.set("pool_memory_bytes", int(worker[f"{kind}_mb"] * 1024 * 1024), worker=slot, kind=kind)
+    return pool.render()
+
+
+def _instrument(app):
+    """Count requests and busy time of the serving worker"""
+    from flask import g
+
+    @app.before_request
+    def start_worker_timer():
+        g.prefork_start = time.perf_counter()
+
+    @app.after_request
+    def record_worker_request(response):
+        start = g.get("prefork_start")
+        if _slot is not None and start is not None:
+            _stats.add(_slot, requests=1, errors=1 if response.status_code >= 500 else 0,
+                       busy_seconds=time.perf_counter() - start)
+        return response
+
+
+def _run_worker(app, sock, slot, threads, log, tag, on_worker_start, metrics):
+    global _slot
+    from werkzeug.serving import make_server
+    import torch
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    _slot = slot
+    if metrics is not None:
+        metrics.constant_labels = (("worker", str(slot)),)
+    _stats.reset(slot, os.getpid())
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Already fixed by earlier inter-op work in the parent
+    log.info(f"👷 {tag} Worker {slot} (pid {os.getpid()}) serving with {threads} torch thread(s)")
+    if on_worker_start is not None:
+        threading.Thread(target=on_worker_start, name="worker-start", daemon=True).start()
+    server = make_server(*sock.getsockname()[:2], app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+
+def serve(app, host, port, workers, threads=0, log=None, tag="", on_worker_start=None, units="units",
+          report_seconds=60, metrics=None):
+    """
+    Serve app from `workers` forked processes sharing everything loaded so far
+
+    Call after the model is loaded (and before any inference, so no torch thread pools exist yet).
+    Each worker sets `threads` torch intra-op threads (0 = cores // workers), runs on_worker_start
+    in the background (e.g. a warm-up) and serves on the shared socket. The parent restarts
+    workers that die, logs per-worker memory and throughput every report_seconds, and stops the
+    pool on SIGTERM / SIGINT. The service's Metrics registry (metrics), if given, gets a worker
+    label in each worker.
+    """
+    global _stats
+    threads = threads or default_threads(workers)
+    if workers * threads > available_cores():
+        log.warning(f"⚠️ {tag} {workers} workers x {threads} threads oversubscribe {available_cores()} cores")
+    _instrument(app)
+    _stats = WorkerStats(workers)
+
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    # Keep the objects loaded so far out of the collector, so it never writes to (and so copies)
+    # their pages in the workers
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, sock, slot, threads, log, tag, on_worker_start, metrics)
+            finally:
+                os._exit(1)
+        children[pid] = slot
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for slot in range(workers):
+        spawn(slot)
+    log.info(f"🍴 {tag} Pre-forked {workers} workers x {threads} torch thread(s) on {host}:{port} "
+             f"(parent pid {os.getpid()}, {process_memory_mb().get('rss_mb', '?')}MB loaded)")
+
+    next_report = time.monotonic() + report_seconds
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in children:
+            slot = children.pop(pid)
+            log.warning(f"⚠️ {tag} Worker {slot} (pid {pid}) exited with status {status}, restarting")
+            spawn(slot)
+            continue
+        if report_seconds and time.monotonic() >= next_report:
+            next_report = time.monotonic() + report_seconds
+            _log_report(log, tag, units)
+        time.sleep(0.5)
+
+    log.info(f"🛑 {tag} Stopping {len(children)} workers")
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def _log_report(log, tag, units):
+    snapshot = _stats.snapshot(units)
+    total = snapshot["total"]
+    per_worker = ", ".join(f"#{w['worker']} {w.get('rss_mb', '?')}/{w.get('pss_mb', '?')}MB {w['requests']} req"
+                           for w in snapshot["workers"])
+    log.info(f"📊 {tag} {total['workers']} workers: {total['requests_per_sec']} req/s, "
+             f"{total[f'{units}_per_sec']} {units}/s, PSS {total['pss_mb']}MB (RSS {total['rss_mb']}MB) "
+             f"- rss/pss: {per_worker}")
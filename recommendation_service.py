@@ -8,19 +8,218 @@ Uses language models from GitHub/Hugging Face for hairstyle recommendations
 import os
 import sys
 import json
-from flask import Flask, request, jsonify
+import time
+import hashlib
+import copy
+import pickle
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+import numpy as np
 import torch
+from service_metrics import CONTENT_TYPE, Metrics, create_logger, instrument_app
+from admission_control import (Cancellation, Overloaded, RequestCancelled, error_response, retry_after_seconds,
+                               wait_result)
+import prefork
+from service_runtime import StartupState, local_snapshot_kwargs, sse_event
 
 app = Flask(__name__)
 CORS(app)  # Allow CORS for frontend
 
+# Logging: RECOMMEND_LOG_LEVEL=DEBUG traces every request stage, INFO (default) keeps model lifecycle
+# and one summary per generation, WARNING or ERROR silences the hot path in production
+log = create_logger("recommendation_service", os.environ.get('RECOMMEND_LOG_LEVEL', 'INFO'))
+
+# Prometheus metrics, served on GET /metrics
+metrics = Metrics("recommend")
+instrument_app(app, metrics)
+metrics.histogram("stage_seconds", "Latency per stage (model_load, prerank, tokenize, generate, decode, parse)")
+metrics.counter("fallbacks_total", "Responses telling the kiosk to fall back to rule-based recommendations")
+metrics.counter("generation_retries_total", "Generations retried without the KV cache after a cache failure")
+metrics.counter("response_cache_total", "Recommendation requests by response cache outcome (hit, coalesced, miss)")
+metrics.counter("generated_tokens_total", "Tokens generated by the model")
+metrics.counter("rejected_total", "Generations rejected with 429 because the generation queue was full")
+metrics.counter("cancelled_total", "Generations stopped early, by reason (deadline, disconnected) and stage (queued, decoding)")
+metrics.gauge("tokens_per_second", "Decode throughput of the most recent generate batch")
+metrics.gauge("queue_depth", "Prompts waiting for the generation scheduler",
+              lambda: generation_scheduler.queue_depth())
+metrics.gauge("ready", "1 once the default model is loaded and warmed up", lambda: startup_state.ready)
+
 # Global variable to store the model (loaded once)
 model = None
 tokenizer = None
 model_source = None
+model_precision = None
+_model_lock = threading.Lock()  # One load at a time; requests during the startup load wait for it
+
+# CPU weight precision, chosen at load time: "float32", "bfloat16", "int8" (dynamic quantization of
+# the Linear layers) or "auto" (bfloat16 where the CPU supports it, otherwise int8). GPUs use float16.
+CPU_PRECISION = os.environ.get('RECOMMEND_CPU_PRECISION', 'float32').lower()
+CPU_PRECISIONS = ("float32", "bfloat16", "int8", "auto")
+
+# Candidate pre-ranking: only the top-K catalog styles (by rule-based score) go into the prompt
+PRERANK_TOP_K = int(os.environ.get('RECOMMEND_TOP_K', 20))
+PRERANK_INDEX_CACHE_SIZE = int(os.environ.get('RECOMMEND_INDEX_CACHE_SIZE', 8))
+
+# Response cache for identical (profile, catalog, model) requests
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RECOMMEND_CACHE_MAX_ENTRIES', 256))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RECOMMEND_CACHE_TTL_SECONDS', 24 * 3600))
+RESPONSE_CACHE_FILE = os.environ.get('RECOMMEND_CACHE_FILE')  # Optional: persist the cache across restarts
+
+# Registered catalogs (PUT /catalogs/<id>): versions kept per catalog id
+CATALOG_MAX_VERSIONS = int(os.environ.get('CATALOG_MAX_VERSIONS', 3))
+
+# Scoring rules, mirroring the kiosk's rule-based fallback (ARHairTryOn.jsx)
+LENGTH_LEVELS = {"short": 1, "medium": 2, "long": 3}
+COMPATIBLE_HAIR_TYPES = {
+    "straight": ["straight"],
+    "wavy": ["wavy", "curly"],
+    "curly": ["curly", "wavy", "coily"],
+    "coily": ["coily", "curly"],
+}
+PRERANK_WEIGHTS = {"faceShape": 0.35, "skinTone": 0.20, "hairLength": 0.25, "hairType": 0.10, "stylePreferences": 0.10}
+
+# KV caching for generation: "prefix" (reuse the instruction prefix's KV cache across requests),
+# "on" (incremental decoding only) or "off" (recompute the full prompt every token)
+KV_CACHE_MODE = os.environ.get('RECOMMEND_KV_CACHE', 'prefix').lower()
+MAX_PROMPT_TOKENS = 2048
+
+# Constrained decoding: only a JSON array of 3 recommendations with catalog ids can be generated
+CONSTRAINED_DECODING = os.environ.get('RECOMMEND_CONSTRAINED', '1') != '0'
+EXPLANATION_MAX_TOKENS = int(os.environ.get('RECOMMEND_EXPLANATION_MAX_TOKENS', 80))
+RECOMMENDATION_COUNT = 3
+
+# Ranking-only mode: deterministic picks, with short explanations generated separately and cached
+SHORT_EXPLANATION_MAX_TOKENS = int(os.environ.get('RECOMMEND_SHORT_EXPLANATION_TOKENS', 48))
+EXPLANATION_CACHE_MAX_ENTRIES = int(os.environ.get('RECOMMEND_EXPLANATION_CACHE_MAX_ENTRIES', 4096))
+EXPLANATION_CACHE_TTL_SECONDS = float(os.environ.get('RECOMMEND_EXPLANATION_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+EXPLANATION_CACHE_FILE = os.environ.get('RECOMMEND_EXPLANATION_CACHE_FILE')  # Optional: persist across restarts
+EXPLANATION_WORKERS = int(os.environ.get('RECOMMEND_EXPLANATION_WORKERS', 8))
+
+# Cross-request batching of model.generate
+GENERATION_BATCH_MAX_SIZE = int(os.environ.get('RECOMMEND_BATCH_MAX_SIZE', 4))
+GENERATION_BATCH_MAX_WAIT_MS = float(os.environ.get('RECOMMEND_BATCH_MAX_WAIT_MS', 50))
+
+# Admission control: the batch size above is the number of prompts decoded at once, at most RECOMMEND_MAX_QUEUE
+# more may wait (0 = unbounded) and further requests get 429 + Retry-After. Generations stop at the next token
+# once their client disconnects or their deadline ('timeoutMs', default below) passes.
+MAX_QUEUE = int(os.environ.get('RECOMMEND_MAX_QUEUE', 16))
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('RECOMMEND_REQUEST_TIMEOUT_SECONDS', 0))  # 0 = no deadline
+
+# Cold start: optional local snapshot of safetensors weights (memory-mapped, no hub lookups), loaded in a
+# background thread while the HTTP server is already up, then warmed with a dummy generation before
+# /health/ready reports ready. Create one with: python recommendation_service.py --save-snapshot DIR
+SNAPSHOT_DIR = os.environ.get('RECOMMEND_SNAPSHOT_DIR')
+BACKGROUND_LOAD = os.environ.get('RECOMMEND_BACKGROUND_LOAD', '1') != '0'
+WARMUP_MAX_NEW_TOKENS = int(os.environ.get('RECOMMEND_WARMUP_TOKENS', 16))
+
+# Pre-fork serving (CPU only): with RECOMMEND_WORKERS > 1 the model is loaded once and that many HTTP workers
+# are forked, sharing its weights copy-on-write; each runs RECOMMEND_WORKER_THREADS torch threads
+# (0 = cores / workers)
+WORKERS = int(os.environ.get('RECOMMEND_WORKERS', 1))
+WORKER_THREADS = int(os.environ.get('RECOMMEND_WORKER_THREADS', 0))
+
+# Static instructions shared by every request; the user-specific part is appended after it
+RECOMMENDATION_PROMPT_PREFIX = """You are a professional hairstylist AI. Analyze the user profile and recommend exactly 3 best matching hairstyles.
+
+Based on the user's facial structure, face shape, skin tone, and preferences, recommend EXACTLY 3 hairstyles from the available options listed after these instructions.
+
+For each recommendation, provide:
+1. The exact hairstyle ID and name from the available options
+2. A match score (0-100)
+3. A detailed explanation (2-3 sentences) explaining WHY this hairstyle is recommended
+
+Return ONLY valid JSON in this exact format (no additional text):
+[
+  {
+    "id": 1,
+    "name": "Exact Name from Available Options",
+    "matchScore": 95,
+    "whyRecommendation": "Detailed 2-3 sentence explanation of why this hairstyle is perfect for this user."
+  },
+  {
+    "id": 2,
+    "name": "Another Hairstyle Name",
+    "matchScore": 88,
+    "whyRecommendation": "Explanation here."
+  },
+  {
+    "id": 3,
+    "name": "Third Hairstyle Name",
+    "matchScore": 85,
+    "whyRecommendation": "Explanation here."
+  }
+]
+"""
+
+# Static instructions for the short per-style explanations of the ranking-only mode
+EXPLANATION_PROMPT_PREFIX = """You are a professional hairstylist AI. In one or two short sentences, explain why the given hairstyle suits the user. Refer to their face shape and at least one other trait from their profile. Reply with the explanation only, on a single line.
+"""
+
+# Per-tokenizer mask of tokens that may appear inside a JSON string (no quote, backslash or control chars)
+_text_token_masks = {}
+
+# Prefilled KV caches of the static prompt prefixes for the loaded model (prefix text -> entry)
+_prefix_cache = {}
+_prefix_lock = threading.Lock()
+
+# Aggregate generation counters, reported by /health
+generation_totals = {"requests": 0, "prompt_tokens": 0, "prefix_tokens_reused": 0, "new_tokens": 0, "seconds": 0.0}
+_generation_totals_lock = threading.Lock()
+
+def cpu_supports_bf16():
+    """True if this CPU has native bfloat16 matmul support (AVX512-BF16 / AMX)"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        try:
+            with open('/proc/cpuinfo') as f:
+                flags = f.read()
+            return 'avx512_bf16' in flags or 'amx_bf16' in flags
+        except OSError:
+            return False
+
+def resolve_cpu_precision(precision=None):
+    """Concrete CPU precision for a requested one (resolves "auto")"""
+    precision = (precision or CPU_PRECISION).lower()
+    if precision not in CPU_PRECISIONS:
+        log.warning(f"⚠️ [REC] Unknown CPU precision '{precision}', using float32")
+        return "float32"
+    if precision == "auto":
+        return "bfloat16" if cpu_supports_bf16() else "int8"
+    if precision == "bfloat16" and not cpu_supports_bf16():
+        log.warning("⚠️ [REC] This CPU has no native bfloat16 support; bfloat16 will save memory but may run slower")
+    return precision
+
+def apply_cpu_precision(loaded_model, precision):
+    """Convert a float32 CPU model to the given precision (returns the converted model)"""
+    if precision == "bfloat16":
+        return loaded_model.to(torch.bfloat16)
+    if precision == "int8":
+        # Weights of every Linear layer stored as int8; activations are quantized on the fly
+        return torch.ao.quantization.quantize_dynamic(loaded_model, {torch.nn.Linear}, dtype=torch.qint8)
+    return loaded_model
+
+def process_rss_mb():
+    """Resident memory of this process in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return round(resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Peak rather than current RSS; KB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
 
-def load_model(model_path=None, github_token=None):
+def model_identity():
+    """Loaded model plus its precision, used in cache keys (precision changes the outputs)"""
+    return f"{model_source}@{model_precision}"
+
+def load_model(model_path=None, github_token=None, precision=None):
     """
     Load a language model from Hugging Face or GitHub
     
@@ -28,113 +227,489 @@ def load_model(model_path=None, github_token=None):
         model_path: Model identifier. Can be:
             - Hugging Face model ID (e.g., "mistralai/Mistral-7B-Instruct-v0.2")
             - GitHub repo (e.g., "username/repo-name")
+            - Local directory (e.g., a snapshot written by save_snapshot()); defaults to RECOMMEND_SNAPSHOT_DIR
         github_token: GitHub personal access token (for private repos)
+        precision: CPU weight precision (see CPU_PRECISION); defaults to RECOMMEND_CPU_PRECISION
     """
-    global model, tokenizer, model_source
-    
-    # Use provided model or default to a small, fast model
+    # Use provided model, the local snapshot, or default to a small, fast model
     if not model_path:
         # Default to a small, fast model that works well for recommendations
-        model_path = os.environ.get('RECOMMENDATION_MODEL', 'microsoft/Phi-3-mini-4k-instruct')
+        model_path = SNAPSHOT_DIR or os.environ.get('RECOMMENDATION_MODEL', 'microsoft/Phi-3-mini-4k-instruct')
     
     # Check if it's a GitHub model
     is_github_model = 'github.com' in model_path
     
     if is_github_model:
-        print(f"🔄 [REC] ✅✅✅ GITHUB MODEL DETECTED: {model_path}")
+        log.info(f"🔄 [REC] ✅✅✅ GITHUB MODEL DETECTED: {model_path}")
         if github_token:
-            print(f"🔄 [REC] Using GitHub personal access token: {github_token[:20]}...")
+            log.info(f"🔄 [REC] Using GitHub personal access token: {github_token[:20]}...")
         else:
-            print(f"⚠️ [REC] No GitHub token provided for GitHub model!")
+            log.warning(f"⚠️ [REC] No GitHub token provided for GitHub model!")
     
     # If same model already loaded, return it
     if model is not None and model_source == model_path:
         return model, tokenizer
     
+    with _model_lock:
+        if model is not None and model_source == model_path:
+            return model, tokenizer
+        with metrics.time("stage_seconds", stage="model_load"):
+            return _load_model(model_path, github_token, precision, is_github_model)
+
+def _load_model(model_path, github_token, precision, is_github_model):
+    """Load the tokenizer and model for load_model() (called with _model_lock held)"""
+    global model, tokenizer, model_source, model_precision
+    
     try:
-        print(f"🔄 [REC] Loading recommendation model from: {model_path}")
-        print("🔄 [REC] This may take a few minutes on first run (downloading model)...")
+        log.info(f"🔄 [REC] Loading recommendation model from: {model_path}")
+        log.info("🔄 [REC] This may take a few minutes on first run (downloading model)...")
+        
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
         
-        from transformers import AutoModelForCausalLM, AutoTokenizer
+        local_kwargs = local_snapshot_kwargs(model_path, SNAPSHOT_DIR)
+        if local_kwargs:
+            log.info(f"🔄 [REC] Loading from local directory (no hub lookups): {model_path}")
         
         # Check if GPU is available
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"🔄 [REC] Using device: {device}")
+        log.info(f"🔄 [REC] Using device: {device}")
         
         # Load tokenizer
-        print("🔄 [REC] Loading tokenizer...")
+        log.info("🔄 [REC] Loading tokenizer...")
         # Use GitHub token if it's a GitHub model, otherwise None
         auth_token = github_token if (is_github_model and github_token) else None
         if auth_token:
-            print(f"🔄 [REC] Using authentication token: {auth_token[:20]}...")
+            log.info(f"🔄 [REC] Using authentication token: {auth_token[:20]}...")
         
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
             token=auth_token,
-            trust_remote_code=True
+            trust_remote_code=True,
+            local_files_only=local_kwargs.get("local_files_only", False)
         )
         
+        # Prefer the built-in transformers implementation (e.g. Phi-3) over the repo's remote code:
+        # the built-in one supports the KV cache used for incremental decoding
+        try:
+            AutoConfig.from_pretrained(model_path, token=auth_token, trust_remote_code=False,
+                                       local_files_only=local_kwargs.get("local_files_only", False))
+            trust_remote_code = False
+        except Exception:
+            trust_remote_code = True
+        log.info(f"🔄 [REC] Model implementation: {'remote code' if trust_remote_code else 'transformers built-in'}")
+        
         # Load model
-        print("🔄 [REC] Loading model (this may take a while)...")
+        log.info("🔄 [REC] Loading model (this may take a while)...")
         if device == "cuda":
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
                 torch_dtype=torch.float16,
                 device_map="auto",
                 token=auth_token,
-                trust_remote_code=True
+                trust_remote_code=trust_remote_code,
+                **local_kwargs
             )
+            model_precision = "float16"
         else:
-            # CPU mode - use a smaller model or quantized version
+            # CPU mode - float32, or a low-memory precision chosen at load time
+            precision = resolve_cpu_precision(precision)
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
-                torch_dtype=torch.float32,
+                # Load bfloat16 weights directly so float32 copies never have to fit in memory
+                torch_dtype=torch.bfloat16 if precision == "bfloat16" else torch.float32,
                 token=auth_token,
-                trust_remote_code=True
+                trust_remote_code=trust_remote_code,
+                **local_kwargs
             ).to(device)
+            if precision == "int8":
+                log.info("🔄 [REC] Quantizing Linear layers to int8...")
+                model = apply_cpu_precision(model, precision)
+            model_precision = precision
         
         model_source = model_path
-        print(f"✅ [REC] Model loaded successfully from: {model_path}!")
+        log.info(f"✅ [REC] Model loaded successfully from: {model_path} ({model_precision}, RSS {process_rss_mb()} MB)!")
         return model, tokenizer
         
     except Exception as e:
-        print(f"❌ [REC] Error loading model: {e}")
-        print("💡 [REC] Make sure you have installed: pip install transformers torch")
-        print("💡 [REC] For GitHub models, make sure the repo is public or you have proper access")
+        log.error(f"❌ [REC] Error loading model: {e}")
+        log.warning("💡 [REC] Make sure you have installed: pip install transformers torch")
+        log.warning("💡 [REC] For GitHub models, make sure the repo is public or you have proper access")
         raise
 
-def generate_recommendations(user_data, hairstyle_options, model, tokenizer):
-    """Generate hairstyle recommendations using the language model"""
+def save_snapshot(snapshot_dir, model_path=None, github_token=None):
+    """
+    Write the model and tokenizer to a local directory as safetensors, for RECOMMEND_SNAPSHOT_DIR
     
-    print("🔄 [REC] Preparing user profile data...")
+    int8 quantization is applied at load time, so that precision is snapshotted as float32.
+    """
+    precision = "float32" if resolve_cpu_precision() == "int8" else None
+    snapshot_model, snapshot_tokenizer = load_model(model_path, github_token, precision=precision)
+    log.info(f"💾 [REC] Writing snapshot of {model_source} to {snapshot_dir}...")
+    snapshot_model.save_pretrained(snapshot_dir, safe_serialization=True)
+    snapshot_tokenizer.save_pretrained(snapshot_dir)
+    log.info(f"✅ [REC] Snapshot written; start the service with RECOMMEND_SNAPSHOT_DIR={snapshot_dir}")
+
+def catalog_fingerprint(hairstyle_options):
+    """
+    Content hash of a hairstyle catalog
+    Pickle of the parsed JSON is several times faster than a sorted json.dumps on 10k-style
+    catalogs; it is key-order sensitive, which only costs a cache miss, never a wrong hit.
+    """
+    payload = pickle.dumps(hairstyle_options, protocol=4)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def _normalize(value):
+    return str(value).strip().lower() if value not in (None, '') else ''
+
+
+def skin_tone_of(user_data, default=None):
+    """The profile's skin tone: a plain value, or a {"label", "value"} dict's label (value as fallback)"""
+    skin_tone = user_data.get('skinTone')
+    if isinstance(skin_tone, dict):
+        skin_tone = skin_tone.get('label', skin_tone.get('value'))
+    return skin_tone if skin_tone not in (None, '') else default
+
+
+def style_preferences_of(user_data):
+    """The profile's style preferences, normalized and sorted (a single string counts as one preference)"""
+    preferences = user_data.get('stylePreferences') or []
+    if isinstance(preferences, str):
+        preferences = [preferences]
+    return sorted({_normalize(p) for p in preferences} - {''})
+
+
+class CatalogIndex:
+    """
+    Inverted indexes and per-style attribute arrays over a hairstyle catalog.
+    
+    Built once per catalog so a profile can be scored against every style with a
+    handful of vectorized NumPy operations instead of a Python loop.
+    """
+
+    def __init__(self, hairstyle_options):
+        self.styles = list(hairstyle_options)
+        size = len(self.styles)
+        self.category = {}
+        self.hair_type = {}
+        self.tags = {}
+        self.length_level = np.full(size, LENGTH_LEVELS["medium"], dtype=np.int8)
+        face_compat = {}
+        skin_compat = {}
+        
+        for i, style in enumerate(self.styles):
+            category = _normalize(style.get('category'))
+            self.category.setdefault(category, []).append(i)
+            self.length_level[i] = LENGTH_LEVELS.get(category, LENGTH_LEVELS["medium"])
+            self.hair_type.setdefault(_normalize(style.get('hairType')), []).append(i)
+            for tag in set(_normalize(t) for t in (style.get('styleTags') or [])):
+                self.tags.setdefault(tag, []).append(i)
+            for shape, score in (style.get('faceShapeCompatibility') or {}).items():
+                face_compat.setdefault(_normalize(shape), {})[i] = score
+            for tone, score in (style.get('skinToneCompatibility') or {}).items():
+                skin_compat.setdefault(_normalize(tone), {})[i] = score
+        
+        to_arrays = lambda index: {k: np.asarray(v, dtype=np.int64) for k, v in index.items()}
+        self.category = to_arrays(self.category)
+        self.hair_type = to_arrays(self.hair_type)
+        self.tags = to_arrays(self.tags)
+        # Compatibility tables become dense score columns; missing entries use the rule-based defaults
+        self.face_compat = {k: self._dense(v, 70.0) for k, v in face_compat.items()}
+        self.skin_compat = {k: self._dense(v, 75.0) for k, v in skin_compat.items()}
+
+    def _dense(self, sparse, default):
+        column = np.full(len(self.styles), default, dtype=np.float32)
+        for i, score in sparse.items():
+            try:
+                column[i] = float(score)
+            except (TypeError, ValueError):
+                pass
+        return column
+
+    def score(self, user_data):
+        """Rule-based match score (0-100) of every style for one user profile"""
+        size = len(self.styles)
+        weights = PRERANK_WEIGHTS
+        
+        face_shape = _normalize(user_data.get('faceShape'))
+        face = self.face_compat.get(face_shape)
+        scores = (face if face is not None else np.full(size, 70.0, dtype=np.float32)) * weights["faceShape"]
+        
+        skin = self.skin_compat.get(_normalize(skin_tone_of(user_data)))
+        scores = scores + (skin if skin is not None else 75.0) * weights["skinTone"]
+        
+        hair_length = _normalize(user_data.get('hairLength'))
+        if hair_length and hair_length != 'any':
+            preferred = LENGTH_LEVELS.get(hair_length, LENGTH_LEVELS["medium"])
+            length = 100.0 - 20.0 * np.abs(self.length_level.astype(np.float32) - preferred)
+            exact = self.category.get(hair_length)
+            if exact is not None:
+                length[exact] = 100.0
+        else:
+            length = 80.0
+        scores = scores + length * weights["hairLength"]
+        
+        hair_type = _normalize(user_data.get('hairType'))
+        if hair_type and hair_type != 'any':
+            type_score = np.full(size, 40.0, dtype=np.float32)
+            for compatible in COMPATIBLE_HAIR_TYPES.get(hair_type, []):
+                if compatible in self.hair_type:
+                    type_score[self.hair_type[compatible]] = 70.0
+            if hair_type in self.hair_type:
+                type_score[self.hair_type[hair_type]] = 100.0
+        else:
+            type_score = 75.0
+        scores = scores + type_score * weights["hairType"]
+        
+        preferences = style_preferences_of(user_data)
+        if preferences:
+            matches = np.zeros(size, dtype=np.float32)
+            for preference in preferences:
+                if preference in self.tags:
+                    matches[self.tags[preference]] += 1.0
+            preference_score = np.where(matches > 0, np.minimum(100.0, 60.0 + 15.0 * matches), 50.0)
+        else:
+            preference_score = 70.0
+        scores = scores + preference_score * weights["stylePreferences"]
+        
+        return np.clip(scores, 0.0, 100.0)
+
+    def top_k(self, user_data, k):
+        """Indices and scores of the k best styles, best first (ties keep catalog order)"""
+        scores = self.score(user_data)
+        k = max(0, min(k, len(scores)))
+        # Stable descending sort: equal scores keep catalog order, so results are deterministic
+        chosen = np.lexsort((np.arange(len(scores)), -scores))[:k]
+        return chosen, scores[chosen]
+
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+def get_catalog_index(hairstyle_options, fingerprint=None):
+    """CatalogIndex for a catalog, reused across requests sending the same catalog"""
+    fingerprint = fingerprint or catalog_fingerprint(hairstyle_options)
+    with _index_cache_lock:
+        index = _index_cache.get(fingerprint)
+        if index is not None:
+            _index_cache.move_to_end(fingerprint)
+            return index
+    index = CatalogIndex(hairstyle_options)
+    with _index_cache_lock:
+        _index_cache[fingerprint] = index
+        while len(_index_cache) > PRERANK_INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+def prerank_catalog(user_data, hairstyle_options, top_k=PRERANK_TOP_K, fingerprint=None, index=None):
+    """
+    Score the full catalog against the user profile and keep the top-K candidates for the prompt
+    
+    Returns:
+        (candidates, prerank) - the chosen style dicts (best first) and a summary with their scores
+    """
+    start = time.perf_counter()
+    index = index or get_catalog_index(hairstyle_options, fingerprint)
+    index_ms = (time.perf_counter() - start) * 1000
+    chosen, scores = index.top_k(user_data, top_k)
+    total_ms = (time.perf_counter() - start) * 1000
+    score_ms = total_ms - index_ms
+    candidates = [index.styles[i] for i in chosen]
+    prerank = {
+        "catalog_size": len(index.styles),
+        "top_k": len(candidates),
+        "index_ms": round(index_ms, 3),
+        "score_ms": round(score_ms, 3),
+        "duration_ms": round(total_ms, 3),
+        "scores": [{"id": style.get('id'), "score": round(float(score), 2)}
+                   for style, score in zip(candidates, scores)]
+    }
+    metrics.observe("stage_seconds", total_ms / 1000, stage="prerank")
+    log.debug(f"🔄 [REC] Pre-ranked {len(index.styles)} styles -> top {len(candidates)} in {total_ms:.2f}ms "
+              f"(index lookup {index_ms:.2f}ms, scoring {score_ms:.2f}ms)")
+    return candidates, prerank
+
+def canonical_user_data(user_data):
+    """Normalized profile used for response caching (case, whitespace and preference order don't matter)"""
+    return {
+        "faceShape": _normalize(user_data.get('faceShape')),
+        "skinTone": _normalize(skin_tone_of(user_data)),
+        "hairLength": _normalize(user_data.get('hairLength')),
+        "hairType": _normalize(user_data.get('hairType')),
+        "stylePreferences": style_preferences_of(user_data),
+    }
+
+def recommendation_cache_key(user_data, fingerprint, model_path):
+    """Cache key for one /recommend request"""
+    payload = json.dumps([canonical_user_data(user_data), fingerprint, model_path], sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RecommendationCache:
+    """
+    LRU + TTL cache of /recommend responses.
+    
+    - Concurrent requests for the same key are coalesced: one computes, the others wait for it.
+    - With persist_path set, entries are written to a JSON file and reloaded on startup.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=86400, persist_path=None):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.persist_path = persist_path
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "stores": 0, "evictions": 0, "expired": 0}
+        if self.persist_path:
+            self._load()
+
+    def get_or_compute(self, key, compute, cacheable=None, cancel=None):
+        """
+        Return (value, status) where status is "hit", "coalesced" or "miss"
+        
+        Args:
+            compute: Called at most once concurrently per key on a miss
+            cacheable: Optional predicate; values it rejects are returned but not stored
+            cancel: Optional Cancellation of the calling request; a coalesced wait gives up
+                with RequestCancelled once it fires
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return entry[1], "hit"
+                del self._entries[key]
+                self.counters["expired"] += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = Future()
+                self._pending[key] = pending
+                owner = True
+                self.counters["misses"] += 1
+            else:
+                owner = False
+                self.counters["coalesced"] += 1
+        
+        if not owner:
+            log.debug(f"⏳ [REC] Waiting for in-flight recommendation {key[:8]}")
+            try:
+                return wait_result(pending, cancel), "coalesced"
+            except RequestCancelled:
+                if cancel is not None and cancel.reason is not None:
+                    raise
+                # The owner's client went away; this request is still wanted, so compute it here
+                return self.get_or_compute(key, compute, cacheable, cancel)
+        
+        try:
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.put(key, value)
+            pending.set_result(value)
+            return value, "miss"
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get(self, key):
+        """Cached value if present and fresh, else None (does not count as a miss)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+        self._save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"] + self.counters["coalesced"]
+            return {
+                **self.counters,
+                "hit_rate": round((self.counters["hits"] + self.counters["coalesced"]) / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "in_flight": len(self._pending),
+                "persist_path": self.persist_path,
+            }
+
+    def _load(self):
+        try:
+            with open(self.persist_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"⚠️ [REC] Ignoring unreadable recommendation cache {self.persist_path}: {e}")
+            return
+        now = time.time()
+        for key, expires_at, value in saved.get("entries", []):
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        log.info(f"✅ [REC] Loaded {len(self._entries)} cached recommendations from {self.persist_path}")
+
+    def _save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()]
+        with self._persist_lock:
+            tmp_path = f"{self.persist_path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump({"entries": entries}, f)
+                os.replace(tmp_path, self.persist_path)
+            except OSError as e:
+                log.warning(f"⚠️ [REC] Could not write recommendation cache {self.persist_path}: {e}")
+
+
+response_cache = RecommendationCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_FILE)
+
+def build_recommendation_prompt(user_data, hairstyle_options):
+    """Build the full hairstylist prompt (shared prefix + user-specific suffix)"""
+    return RECOMMENDATION_PROMPT_PREFIX + build_recommendation_suffix(user_data, hairstyle_options)
+
+def format_style_line(style):
+    """One hairstyle's line in the prompt's 'Available Hairstyles' list"""
+    return (f"- ID: {style.get('id')}, Name: {style.get('name')}, Category: {style.get('category', 'N/A')}, "
+            f"Hair Type: {style.get('hairType', 'N/A')}, Tags: {', '.join(style.get('styleTags', []))}")
+
+def build_profile_text(user_data):
+    """Start of the user-specific prompt part: the profile and the hairstyles list heading"""
+    
+    log.debug("🔄 [REC] Preparing user profile data...")
     
     # Prepare user profile text
     face_shape = user_data.get('faceShape', 'unknown')
-    skin_tone = user_data.get('skinTone', {})
-    if isinstance(skin_tone, dict):
-        skin_tone = skin_tone.get('label', skin_tone.get('value', 'unknown'))
-    else:
-        skin_tone = str(skin_tone) if skin_tone else 'unknown'
+    skin_tone = str(skin_tone_of(user_data, 'unknown'))
     
     hair_length = user_data.get('hairLength', 'any')
     hair_type = user_data.get('hairType', 'any')
     style_preferences = user_data.get('stylePreferences', [])
     
-    print(f"🔄 [REC] User profile: Face={face_shape}, Skin={skin_tone}, Hair={hair_type}, Length={hair_length}")
-    
-    # Prepare hairstyles list
-    print(f"🔄 [REC] Processing {len(hairstyle_options)} hairstyle options...")
-    hairstyles_text = "\n".join([
-        f"- ID: {s.get('id')}, Name: {s.get('name')}, Category: {s.get('category', 'N/A')}, "
-        f"Hair Type: {s.get('hairType', 'N/A')}, Tags: {', '.join(s.get('styleTags', []))}"
-        for s in hairstyle_options[:20]  # Limit to first 20 for token efficiency
-    ])
-    
-    print(f"🔄 [REC] Prepared {min(len(hairstyle_options), 20)} hairstyles for model")
+    log.debug(f"🔄 [REC] User profile: Face={face_shape}, Skin={skin_tone}, Hair={hair_type}, Length={hair_length}")
     
-    # Create prompt
-    prompt = f"""You are a professional hairstylist AI. Analyze the user profile and recommend exactly 3 best matching hairstyles.
-
+    return f"""
 User Profile:
 - Face Shape: {face_shape}
 - Skin Tone: {skin_tone}
@@ -143,235 +718,1573 @@ User Profile:
 - Style Preferences: {', '.join(style_preferences) if style_preferences else 'None specified'}
 
 Available Hairstyles:
-{hairstyles_text}
+"""
 
-Based on the user's facial structure, face shape, skin tone, and preferences, recommend EXACTLY 3 hairstyles from the available options above.
+# Closing cue after the hairstyles list
+RECOMMENDATION_PROMPT_TAIL = """
+Recommendations (JSON only):
+"""
 
-For each recommendation, provide:
-1. The exact hairstyle ID and name from the available options
-2. A match score (0-100)
-3. A detailed explanation (2-3 sentences) explaining WHY this hairstyle is recommended
+def build_recommendation_suffix(user_data, hairstyle_options):
+    """Build the user-specific part of the prompt: profile, candidate hairstyles and the answer cue"""
+    profile_text = build_profile_text(user_data)
+    
+    # Prepare hairstyles list
+    log.debug(f"🔄 [REC] Processing {len(hairstyle_options)} hairstyle options...")
+    # Callers pass the pre-ranked top-K candidates, which keeps the prompt short
+    hairstyles_text = "".join(format_style_line(s) + "\n" for s in hairstyle_options)
+    
+    log.debug(f"🔄 [REC] Prepared {len(hairstyle_options)} hairstyles for model")
+    
+    return profile_text + hairstyles_text + RECOMMENDATION_PROMPT_TAIL
 
-Return ONLY valid JSON in this exact format (no additional text):
-[
-  {{
-    "id": 1,
-    "name": "Exact Name from Available Options",
-    "matchScore": 95,
-    "whyRecommendation": "Detailed 2-3 sentence explanation of why this hairstyle is perfect for this user."
-  }},
-  {{
-    "id": 2,
-    "name": "Another Hairstyle Name",
-    "matchScore": 88,
-    "whyRecommendation": "Explanation here."
-  }},
-  {{
-    "id": 3,
-    "name": "Third Hairstyle Name",
-    "matchScore": 85,
-    "whyRecommendation": "Explanation here."
-  }}
-]"""
 
-    try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"🔄 [REC] Using device: {device}")
+def encode_after_line(tokenizer, text):
+    """
+    Token ids of text as it is tokenized after a newline inside a longer prompt: encoded behind a
+    newline whose own ids are then dropped (None if the context does not survive as a prefix)
+    """
+    context = tokenizer("\n", add_special_tokens=False).input_ids
+    ids = tokenizer("\n" + text, add_special_tokens=False).input_ids
+    return ids[len(context):] if ids[:len(context)] == context else None
+
+
+class CatalogEntry:
+    """
+    One registered catalog version, with everything /recommend would otherwise
+    recompute per request: fingerprint, pre-ranking index, formatted prompt lines
+    and (per tokenizer) the token ids of each line.
+    """
+
+    def __init__(self, catalog_id, version, styles):
+        self.catalog_id = catalog_id
+        self.version = version
+        self.styles = styles
+        self.fingerprint = catalog_fingerprint(styles)
+        self.index = CatalogIndex(styles)
+        self.lines = [format_style_line(style) + "\n" for style in styles]
+        self._positions = {id(style): position for position, style in enumerate(styles)}
+        self._line_token_ids = {}
+        self._lock = threading.Lock()
+        self.created_at = time.time()
+
+    def describe(self):
+        return {
+            "catalogId": self.catalog_id,
+            "version": self.version,
+            "size": len(self.styles),
+            "fingerprint": self.fingerprint,
+            "created_at": self.created_at,
+        }
+
+    def line_token_ids(self, tokenizer):
+        """
+        Token ids of every line for this tokenizer, or None when tokenizing line by line
+        would not give the same ids as tokenizing the whole prompt
+
+        Each line is tokenized behind a fixed context (the newline ending the previous line) whose
+        ids are then stripped, so SentencePiece / Metaspace tokenizers do not add the word-boundary
+        marker they put at the start of a text. If the pieces still differ from the whole prompt
+        (merges across line boundaries), a warning is logged once per catalog and tokenizer and
+        the prompt is tokenized per request.
+        """
+        key = id(tokenizer)
+        with self._lock:
+            if key not in self._line_token_ids:
+                self._line_token_ids[key] = self._tokenize_lines(tokenizer)
+            return self._line_token_ids[key]
+
+    def _tokenize_lines(self, tokenizer):
+        def encode(text):
+            return tokenizer(text, add_special_tokens=False).input_ids
         
-        # Tokenize input
-        print("🔄 [REC] Tokenizing prompt...")
-        inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048).to(device)
-        print(f"🔄 [REC] ✅ Tokenization complete. Input tokens: {inputs['input_ids'].shape[1]}")
+        profile_text = build_profile_text({})
+        sample = self.lines[:3]
+        joined = encode(profile_text + "".join(sample) + RECOMMENDATION_PROMPT_TAIL)
+        sample_ids = [encode_after_line(tokenizer, text) for text in sample + [RECOMMENDATION_PROMPT_TAIL]]
+        start = time.time()
+        line_ids = [encode_after_line(tokenizer, line) for line in self.lines]
+        if (any(ids is None for ids in sample_ids + line_ids)
+                or joined != encode(profile_text) + [t for ids in sample_ids for t in ids]):
+            log.warning(f"⚠️ [REC] Catalog {self.catalog_id}@{self.version}: tokenizer is context-sensitive, "
+                        f"prompt lines will be tokenized per request")
+            return None
+        log.debug(f"✅ [REC] Tokenized {len(line_ids)} catalog lines for {self.catalog_id}@{self.version} "
+                  f"in {time.time() - start:.2f}s")
+        return line_ids
+
+    def prompt_suffix(self, user_data, candidates, tokenizer):
+        """
+        The user-specific prompt part for pre-ranked candidates from this catalog:
+        token ids assembled from the precomputed lines when possible, otherwise text
+        """
+        profile_text = build_profile_text(user_data)
+        positions = [self._positions[id(style)] for style in candidates]
+        line_ids = self.line_token_ids(tokenizer)
+        if line_ids is None:
+            return profile_text + "".join(self.lines[p] for p in positions) + RECOMMENDATION_PROMPT_TAIL
+        return (tokenizer(profile_text, add_special_tokens=False).input_ids
+                + [t for p in positions for t in line_ids[p]]
+                + encode_after_line(tokenizer, RECOMMENDATION_PROMPT_TAIL))
+
+
+class CatalogRegistry:
+    """Registered catalogs by id and version (the newest max_versions versions of each id are kept)"""
+
+    def __init__(self, max_versions=3):
+        self.max_versions = max(1, int(max_versions))
+        self._catalogs = {}  # catalog_id -> OrderedDict(version -> CatalogEntry), oldest first
+        self._lock = threading.Lock()
+
+    def put(self, catalog_id, styles, version=None):
+        """
+        Register a catalog version; returns (entry, created)
         
-        # Generate response
-        print("🔄 [REC] Generating recommendations (this may take 30-60 seconds)...")
-        print("🔄 [REC] ⏳ Please wait, model is processing...")
-        generation_start = __import__('time').time()
+        Raises:
+            ValueError: the styles are invalid, or the version exists with different content
+        """
+        validate_catalog(styles)
+        fingerprint = catalog_fingerprint(styles)
+        with self._lock:
+            versions = self._catalogs.get(catalog_id, OrderedDict())
+            if version is None:
+                version = str(max((int(v) for v in versions if str(v).isdigit()), default=0) + 1)
+            version = str(version)
+            existing = versions.get(version)
+        if existing is not None:
+            if existing.fingerprint != fingerprint:
+                raise ValueError(f"version {version} of catalog {catalog_id} already exists with different content")
+            return existing, False
         
+        entry = CatalogEntry(catalog_id, version, styles)
+        with self._lock:
+            versions = self._catalogs.setdefault(catalog_id, OrderedDict())
+            versions[version] = entry
+            while len(versions) > self.max_versions:
+                versions.popitem(last=False)
+        return entry, True
+
+    def get(self, catalog_id, version=None):
+        """The requested version, or the newest one when version is None"""
+        with self._lock:
+            versions = self._catalogs.get(catalog_id)
+            if not versions:
+                return None
+            if version is None:
+                return next(reversed(versions.values()))
+            return versions.get(str(version))
+
+    def describe(self, catalog_id=None):
+        with self._lock:
+            catalog_ids = [catalog_id] if catalog_id is not None else list(self._catalogs)
+            return {
+                cid: [entry.describe() for entry in self._catalogs.get(cid, {}).values()]
+                for cid in catalog_ids
+            }
+
+
+def validate_catalog(styles):
+    """Raise ValueError unless styles is a non-empty list of hairstyle dicts with unique ids"""
+    if not isinstance(styles, list) or not styles:
+        raise ValueError("hairstyles must be a non-empty list")
+    seen = set()
+    for position, style in enumerate(styles):
+        if not isinstance(style, dict) or style.get('id') is None or not style.get('name'):
+            raise ValueError(f"hairstyle at position {position} needs an id and a name")
+        key = json.dumps(style['id'])
+        if key in seen:
+            raise ValueError(f"duplicate hairstyle id {style['id']}")
+        seen.add(key)
+
+
+catalog_registry = CatalogRegistry(CATALOG_MAX_VERSIONS)
+
+def resolve_catalog(data):
+    """
+    Hairstyles for a /recommend body: a registered catalog ('catalogId' + optional 'version')
+    or the inline 'hairstyleOptions' list
+    
+    Returns:
+        (catalog_entry or None, hairstyle_options, (error, status) or None)
+    """
+    catalog_id = data.get('catalogId')
+    if catalog_id is None:
+        hairstyle_options = data.get('hairstyleOptions') or []
+        if not hairstyle_options:
+            return None, [], ("hairstyleOptions or catalogId is required", 400)
+        return None, hairstyle_options, None
+    entry = catalog_registry.get(str(catalog_id), data.get('version'))
+    if entry is None:
+        return None, [], (f"Unknown catalog {catalog_id} (version {data.get('version', 'latest')})", 404)
+    return entry, entry.styles, None
+
+def extract_recommendations_json(response_text):
+    """
+    Extract the recommendations JSON array from the model's response text
+    
+    Returns:
+        List of up to 3 recommendation dicts, or None if no valid array was found
+    """
+    # Extract JSON from response
+    # Try to find JSON array in the response
+    json_start = response_text.find('[')
+    json_end = response_text.rfind(']') + 1
+    
+    if json_start != -1 and json_end > json_start:
+        log.debug(f"🔄 [REC] Found JSON array at positions {json_start}-{json_end}")
+        json_text = response_text[json_start:json_end]
+        log.debug(f"🔄 [REC] Parsing JSON...")
+        recommendations = json.loads(json_text)
+        
+        # Validate and limit to 3
+        if isinstance(recommendations, list) and len(recommendations) > 0:
+            log.debug(f"✅ [REC] Successfully parsed {len(recommendations)} recommendations")
+            return recommendations[:3]
+        else:
+            log.warning(f"⚠️ [REC] Parsed JSON but got empty or invalid list")
+    else:
+        log.warning(f"⚠️ [REC] Could not find JSON array in response")
+    
+    return None
+
+class RecommendationStreamParser:
+    """
+    Incremental parser for the model's JSON array: feed() text as it is generated and
+    get back each top-level object as soon as its closing brace arrives
+    """
+    
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+        self.closed = False
+    
+    def feed(self, text):
+        """Returns the recommendation dicts completed by this chunk"""
+        completed = []
+        for char in text:
+            if self.closed:
+                break
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif self.depth == 0:
+                # Skip anything the model writes before the array
+                if char == '[':
+                    self.depth = 1
+                    self.buffer = ['[']
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+                if self.depth == 2:
+                    self.object_start = len(self.buffer) - 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 1 and char == '}' and self.object_start is not None:
+                    try:
+                        value = json.loads(''.join(self.buffer[self.object_start:]))
+                        if isinstance(value, dict):
+                            completed.append(value)
+                    except ValueError:
+                        pass
+                    self.object_start = None
+                elif self.depth == 0:
+                    self.closed = True
+        return completed
+
+
+class TokenTextStream:
+    """Per-request token callback: detokenizes incrementally and feeds a RecommendationStreamParser"""
+    
+    def __init__(self, tokenizer, on_recommendation):
+        self.tokenizer = tokenizer
+        self.on_recommendation = on_recommendation
+        self.parser = RecommendationStreamParser()
+        self.token_ids = []
+        self.emitted = 0
+        self.sent = set()
+    
+    def restart(self):
+        """Start over for a retried generation; objects already sent are not sent again"""
+        self.parser = RecommendationStreamParser()
+        self.token_ids = []
+        self.emitted = 0
+    
+    def __call__(self, token_id):
+        self.token_ids.append(token_id)
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        # Hold back an incomplete multi-byte character until its remaining tokens arrive
+        if text.endswith('\ufffd') or len(text) <= self.emitted:
+            return
+        chunk, self.emitted = text[self.emitted:], len(text)
+        for recommendation in self.parser.feed(chunk):
+            key = (str(recommendation.get('id')) if isinstance(recommendation, dict) and 'id' in recommendation
+                   else json.dumps(recommendation, sort_keys=True))
+            if key not in self.sent:
+                self.sent.add(key)
+                self.on_recommendation(recommendation)
+
+
+class RowStreamer:
+    """model.generate streamer that hands each batch row's new tokens to that row's callback"""
+    
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+        self.prompt_seen = False
+    
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True  # The first put is the prompt itself
+            return
+        rows = value.reshape(len(self.callbacks), -1)
+        for callback, tokens in zip(self.callbacks, rows):
+            if callback is None:
+                continue
+            for token_id in tokens.tolist():
+                try:
+                    callback(token_id)
+                except Exception as e:
+                    log.warning(f"⚠️ [REC] Token streamer failed: {e}")
+    
+    def end(self):
+        pass
+
+def text_token_mask(tokenizer):
+    """Boolean tensor over the vocabulary: True for tokens that are safe inside a JSON string"""
+    key = id(tokenizer)
+    if key not in _text_token_masks:
+        texts = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+        special = set(tokenizer.all_special_ids)
+        _text_token_masks[key] = torch.tensor([
+            i not in special and all(c not in '"\\' and c >= ' ' for c in text)
+            for i, text in enumerate(texts)
+        ], dtype=torch.bool)
+    return _text_token_masks[key]
+
+def build_token_trie(tokenizer, segments):
+    """
+    Token trie over the tokenized text of each segment
+    
+    Args:
+        segments: Dict of value -> text; the value is stored at the segment's terminal node
+    """
+    root = {}
+    for value, text in segments.items():
+        node = root
+        for token_id in tokenizer(text, add_special_tokens=False).input_ids:
+            node = node.setdefault(token_id, {})
+        node[None] = value
+    return root
+
+class RecommendationConstraint:
+    """
+    Logits processor + stopping criterion that only lets the model write
+    [{"id": ..., "name": ..., "matchScore": ..., "whyRecommendation": "..."}, ...]
+    with exactly `count` distinct ids from the candidates. Ids, names, keys and
+    punctuation are forced; the model picks the id, the score and the explanation text.
+    Generation stops as soon as the array closes.
+    """
+    
+    def __init__(self, tokenizer, hairstyle_options, count=RECOMMENDATION_COUNT, max_text_tokens=EXPLANATION_MAX_TOKENS):
+        candidates = {}
+        for style in hairstyle_options:
+            candidates.setdefault(json.dumps(style.get('id')), style.get('name'))
+        self.tokenizer = tokenizer
+        self.count = min(count, len(candidates))
+        self.max_text_tokens = max_text_tokens
+        self.text_mask = text_token_mask(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        # Each id segment also forces the catalog name, so names can't drift from ids
+        self.id_segments = {
+            key: f'{key}, "name": {json.dumps(name, ensure_ascii=False)}, "matchScore": '
+            for key, name in candidates.items()
+        }
+        self.open_trie = build_token_trie(tokenizer, {"open": '[\n  {"id": '})
+        self.score_trie = build_token_trie(tokenizer, {score: f'{score}, "whyRecommendation": "' for score in range(101)})
+        self.next_trie = build_token_trie(tokenizer, {"next": '"},\n  {"id": '})
+        self.close_trie = build_token_trie(tokenizer, {"close": '"}\n]'})
+        self.reset()
+    
+    def reset(self):
+        """Forget per-row progress (call before reusing the constraint for another generate)"""
+        self.rows = None
+        self.prompt_len = None
+    
+    def _new_row(self):
+        return {"node": self.open_trie, "phase": "open", "chosen": [], "text_tokens": 0, "done": False}
+    
+    def _id_trie(self, row):
+        remaining = {key: text for key, text in self.id_segments.items() if key not in row["chosen"]}
+        return build_token_trie(self.tokenizer, remaining)
+    
+    def _end_trie(self, row):
+        return self.close_trie if len(row["chosen"]) >= self.count else self.next_trie
+    
+    def _advance(self, row, token_id):
+        """Feed one generated token into a row's state machine"""
+        if row["done"]:
+            return
+        if row["phase"] == "text":
+            end_trie = self._end_trie(row)
+            if token_id in end_trie:
+                row["phase"], row["node"] = "end", end_trie[token_id]
+            else:
+                row["text_tokens"] += 1
+                return
+        else:
+            if token_id not in row["node"]:
+                # Should not happen with the mask applied; give up on this row
+                row["done"] = True
+                return
+            row["node"] = row["node"][token_id]
+        
+        if None not in row["node"]:
+            return
+        # Segment finished - move to the next part of the object
+        value = row["node"][None]
+        if row["phase"] in ("open", "end") and value != "close":
+            row["phase"], row["node"] = "id", self._id_trie(row)
+        elif row["phase"] == "id":
+            row["chosen"].append(value)
+            row["phase"], row["node"] = "score", self.score_trie
+        elif row["phase"] == "score":
+            row["phase"], row["node"], row["text_tokens"] = "text", None, 0
+        else:
+            row["done"] = True
+    
+    def _sync(self, input_ids):
+        """Advance every row with the tokens generated since the last call"""
+        if self.rows is None:
+            self.prompt_len = input_ids.shape[1]
+            self.rows = [dict(self._new_row(), consumed=0) for _ in range(input_ids.shape[0])]
+        generated = input_ids.shape[1] - self.prompt_len
+        for index, row in enumerate(self.rows):
+            for position in range(self.prompt_len + row["consumed"], self.prompt_len + generated):
+                self._advance(row, int(input_ids[index, position]))
+            row["consumed"] = generated
+    
+    def __call__(self, input_ids, scores):
+        self._sync(input_ids)
+        vocab_size = scores.shape[-1]
+        allowed = torch.zeros_like(scores, dtype=torch.bool)
+        for index, row in enumerate(self.rows):
+            if row["done"]:
+                if self.eos_token_id is not None:
+                    allowed[index, self.eos_token_id] = True
+                continue
+            if row["phase"] == "text":
+                if row["text_tokens"] < self.max_text_tokens:
+                    mask = self.text_mask[:vocab_size]
+                    allowed[index, :mask.shape[0]] = mask
+                if row["text_tokens"] > 0:
+                    allowed[index, list(self._end_trie(row))] = True
+            else:
+                allowed[index, [token_id for token_id in row["node"] if token_id is not None]] = True
+        return scores.masked_fill(~allowed, float('-inf'))
+    
+    def stopping_criteria(self):
+        """Stopping criterion that ends generation once every row has closed its array"""
+        def is_done(input_ids, scores, **kwargs):
+            self._sync(input_ids)
+            return torch.tensor([row["done"] for row in self.rows], dtype=torch.bool, device=input_ids.device)
+        return is_done
+
+def get_prefix_cache(model, tokenizer, device, prefix_text=RECOMMENDATION_PROMPT_PREFIX):
+    """
+    Return the prefilled KV cache of a static prompt prefix for this model,
+    computing it on first use. Must be called with _prefix_lock held.
+    """
+    key = (model_source, id(model))
+    entry = _prefix_cache.get(prefix_text)
+    if entry is None or entry["key"] != key:
+        from transformers import DynamicCache
+        
+        start = time.time()
+        prefix_ids = tokenizer(prefix_text, return_tensors="pt").input_ids.to(device)
+        with torch.no_grad():
+            outputs = model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+        entry = {"key": key, "input_ids": prefix_ids, "past_key_values": outputs.past_key_values}
+        _prefix_cache[prefix_text] = entry
+        log.info(f"✅ [REC] Prefilled prompt prefix ({prefix_ids.shape[1]} tokens) in {time.time() - start:.2f}s")
+    return entry
+
+class BatchConstraint:
+    """Applies each request's RecommendationConstraint (or none) to its own row of a batch"""
+    
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self._stops = [c.stopping_criteria() if c is not None else None for c in constraints]
+    
+    def __call__(self, input_ids, scores):
+        return torch.cat([
+            c(input_ids[i:i + 1], scores[i:i + 1]) if c is not None else scores[i:i + 1]
+            for i, c in enumerate(self.constraints)
+        ])
+    
+    def stopping_criteria(self):
+        """Per-row stop flags; unconstrained rows stop on EOS as usual"""
+        def is_done(input_ids, scores, **kwargs):
+            return torch.cat([
+                stop(input_ids[i:i + 1], scores) if stop is not None
+                else torch.zeros(1, dtype=torch.bool, device=input_ids.device)
+                for i, stop in enumerate(self._stops)
+            ])
+        return is_done
+
+def pad_prompts(prefix_ids, suffix_ids, pad_token_id, device, pad_after_prefix=False):
+    """
+    Pad prefix + suffix rows to one length
+    
+    Args:
+        pad_after_prefix: Put the padding between prefix and suffix instead of in front,
+            so every row shares the prefix positions (needed to reuse the prefix KV cache)
+    
+    Returns:
+        (input_ids, attention_mask) tensors
+    """
+    width = max(len(suffix) for suffix in suffix_ids)
+    rows, masks = [], []
+    for suffix in suffix_ids:
+        padding = [pad_token_id] * (width - len(suffix))
+        if pad_after_prefix:
+            rows.append(prefix_ids + padding + suffix)
+            masks.append([1] * len(prefix_ids) + [0] * len(padding) + [1] * len(suffix))
+        else:
+            rows.append(padding + prefix_ids + suffix)
+            masks.append([0] * len(padding) + [1] * (len(prefix_ids) + len(suffix)))
+    return torch.tensor(rows, device=device), torch.tensor(masks, device=device)
+
+def generate_tokens_batch(model, tokenizer, prompt_suffixes, device, kv_cache=None, constraints=None, streamers=None,
+                          cancels=None, prefix_text=RECOMMENDATION_PROMPT_PREFIX, **generate_kwargs):
+    """
+    Run one model.generate over prefix_text + each prompt suffix
+    
+    Args:
+        kv_cache: "prefix", "on" or "off" (defaults to KV_CACHE_MODE)
+        constraints: Optional list with a RecommendationConstraint (or other logits processor
+            with stopping_criteria(), or None) per prompt
+        streamers: Optional list with a callback(token_id) (or None) per prompt, called as tokens are generated
+        cancels: Optional list with a Cancellation (or None) per prompt; a cancelled row stops decoding
+        generate_kwargs: Sampling options passed through to model.generate
+    
+    Returns:
+        List of (new_token_ids, stats) per prompt - stats has token counts, seconds and tokens_per_sec
+    """
+    kv_cache = kv_cache or KV_CACHE_MODE
+    batch_size = len(prompt_suffixes)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    # Suffixes are text, or token ids already assembled from a registered catalog
+    with metrics.time("stage_seconds", stage="tokenize"):
+        suffix_ids = [
+            tokenizer(suffix, add_special_tokens=False).input_ids if isinstance(suffix, str) else list(suffix)
+            for suffix in prompt_suffixes
+        ]
+    if constraints is not None and any(c is not None for c in constraints):
+        from transformers import LogitsProcessorList, StoppingCriteriaList
+        
+        combined = BatchConstraint(constraints)
+        generate_kwargs["logits_processor"] = LogitsProcessorList([combined])
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([combined.stopping_criteria()])
+    if cancels is not None and any(c is not None for c in cancels):
+        from transformers import StoppingCriteriaList
+        
+        def is_cancelled(input_ids, scores, **kwargs):
+            return torch.tensor([c is not None and c.cancelled for c in cancels], dtype=torch.bool,
+                                device=input_ids.device)
+        
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+            list(generate_kwargs.get("stopping_criteria") or []) + [is_cancelled])
+    if streamers is not None and any(s is not None for s in streamers):
+        generate_kwargs["streamer"] = RowStreamer(streamers)
+    start = time.time()
+    
+    if kv_cache == "prefix":
+        with _prefix_lock:
+            prefix = get_prefix_cache(model, tokenizer, device, prefix_text)
+            prefix_ids = prefix["input_ids"][0].tolist()
+            suffix_ids = [suffix[:MAX_PROMPT_TOKENS - len(prefix_ids)] for suffix in suffix_ids]
+            input_ids, attention_mask = pad_prompts(prefix_ids, suffix_ids, pad_token_id, device, pad_after_prefix=True)
+            if batch_size == 1:
+                past_key_values = prefix["past_key_values"]
+            else:
+                # Every row needs its own copy of the prefix keys/values to extend
+                past_key_values = copy.deepcopy(prefix["past_key_values"])
+                past_key_values.batch_repeat_interleave(batch_size)
+            try:
+                with torch.no_grad():
+                    outputs = model.generate(
+                        input_ids=input_ids,
+                        attention_mask=attention_mask,
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                        **generate_kwargs
+                    )
+            except Exception:
+                if batch_size == 1:
+                    # The cache may hold a partial suffix now; rebuild it next time
+                    _prefix_cache.pop(prefix_text, None)
+                raise
+            if batch_size == 1:
+                # Drop this request's suffix and generated tokens, keeping the shared prefix
+                if past_key_values.get_seq_length() > len(prefix_ids):
+                    past_key_values.crop(len(prefix_ids) - past_key_values.get_seq_length())
+        prefix_reused = len(prefix_ids)
+    else:
+        prefix_ids = tokenizer(prefix_text).input_ids
+        suffix_ids = [suffix[:MAX_PROMPT_TOKENS - len(prefix_ids)] for suffix in suffix_ids]
+        input_ids, attention_mask = pad_prompts(prefix_ids, suffix_ids, pad_token_id, device)
         with torch.no_grad():
             outputs = model.generate(
-                **inputs,
-                max_new_tokens=500,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                use_cache=False  # Fix for Phi-3 compatibility issue with DynamicCache
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                use_cache=(kv_cache == "on"),
+                **generate_kwargs
             )
+        prefix_reused = 0
+    
+    seconds = time.time() - start
+    results = []
+    for index, suffix in enumerate(suffix_ids):
+        new_tokens = outputs[index, input_ids.shape[1]:]
+        # Rows that finished early are filled with EOS/padding up to the longest row
+        finished = ((new_tokens == tokenizer.eos_token_id) | (new_tokens == pad_token_id)).nonzero()
+        if len(finished):
+            new_tokens = new_tokens[:int(finished[0, 0])]
+        results.append((new_tokens, {
+            "kv_cache": kv_cache,
+            "batch_size": batch_size,
+            "prompt_tokens": len(prefix_ids) + len(suffix),
+            "prefix_tokens_reused": prefix_reused,
+            "new_tokens": int(new_tokens.shape[0]),
+            "seconds": round(seconds, 3),
+            "tokens_per_sec": round(new_tokens.shape[0] / seconds, 2) if seconds > 0 else 0.0,
+        }))
+    batch_tokens = sum(stats["new_tokens"] for _, stats in results)
+    metrics.observe("stage_seconds", seconds, stage="generate")
+    metrics.inc("generated_tokens_total", batch_tokens)
+    prefork.record_units(batch_tokens)
+    metrics.set("tokens_per_second", round(batch_tokens / seconds, 2) if seconds > 0 else 0.0)
+    with _generation_totals_lock:
+        generation_totals["requests"] += batch_size
+        generation_totals["seconds"] += seconds
+        for _, stats in results:
+            generation_totals["prompt_tokens"] += stats["prompt_tokens"]
+            generation_totals["prefix_tokens_reused"] += stats["prefix_tokens_reused"]
+            generation_totals["new_tokens"] += stats["new_tokens"]
+    return results
+
+def generate_tokens(model, tokenizer, prompt_suffix, device, kv_cache=None, **generate_kwargs):
+    """Single-prompt generate_tokens_batch; returns (new_token_ids, stats)"""
+    return generate_tokens_batch(model, tokenizer, [prompt_suffix], device, kv_cache=kv_cache, **generate_kwargs)[0]
+
+
+class GenerationScheduler:
+    """
+    Cross-request batching scheduler in front of model.generate.
+    
+    Prompts are queued and grouped by model, KV cache mode and sampling options.
+    Prompts sharing a prompt prefix are batched together.
+    A group is dispatched as one padded generate call once it reaches
+    max_batch_size or its oldest prompt has waited max_wait_ms. A single worker
+    thread owns all generate calls, so the model and the prefix KV cache are
+    never used concurrently.
+    
+    The queue is bounded by max_queue: further prompts are rejected with Overloaded.
+    Cancelled prompts are dropped before their batch starts, and a cancelled row
+    stops decoding at the next token.
+    """
+
+    def __init__(self, max_batch_size=4, max_wait_ms=50, max_queue=0):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = max(0, int(max_queue))
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._prompts = 0
+        self._new_tokens = 0
+        self._busy_seconds = 0.0
+        self._rejected = 0
+        self._cancelled = 0
+
+    def submit(self, model, tokenizer, prompt_suffix, device, constraint=None, kv_cache=None, streamer=None,
+               prefix_text=RECOMMENDATION_PROMPT_PREFIX, cancel=None, bounded=True, **generate_kwargs):
+        """
+        Queue one prompt; returns a Future resolving to (new_token_ids, stats)
         
-        generation_duration = __import__('time').time() - generation_start
-        print(f"🔄 [REC] ✅ Generation complete in {generation_duration:.2f} seconds")
-        
-        # Decode response
-        print("🔄 [REC] Decoding model response...")
-        response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        print(f"🔄 [REC] Response length: {len(response_text)} characters")
-        print(f"🔄 [REC] Response preview: {response_text[:200]}...")
-        
-        # Extract JSON from response
-        # Try to find JSON array in the response
-        json_start = response_text.find('[')
-        json_end = response_text.rfind(']') + 1
-        
-        if json_start != -1 and json_end > json_start:
-            print(f"🔄 [REC] Found JSON array at positions {json_start}-{json_end}")
-            json_text = response_text[json_start:json_end]
-            print(f"🔄 [REC] Parsing JSON...")
-            recommendations = json.loads(json_text)
-            
-            # Validate and limit to 3
-            if isinstance(recommendations, list) and len(recommendations) > 0:
-                print(f"✅ [REC] Successfully parsed {len(recommendations)} recommendations")
-                return recommendations[:3]
+        streamer, if given, is called as streamer(token_id) for each token generated for this prompt.
+        cancel is the request's Cancellation; the Future fails with RequestCancelled once it fires.
+        bounded=False skips the queue limit (for internal work such as the warm-up).
+        Raises Overloaded if the queue is full.
+        """
+        kv_cache = kv_cache or KV_CACHE_MODE
+        item = {
+            "model": model,
+            "tokenizer": tokenizer,
+            "prompt_suffix": prompt_suffix,
+            "device": device,
+            "constraint": constraint,
+            "streamer": streamer,
+            "cancel": cancel,
+            "prefix_text": prefix_text,
+            "kv_cache": kv_cache,
+            "generate_kwargs": generate_kwargs,
+            "key": (id(model), device, kv_cache, prefix_text, tuple(sorted(generate_kwargs.items()))),
+            "enqueued_at": time.monotonic(),
+            "future": Future(),
+        }
+        with self._cond:
+            if bounded:
+                self._reject_if_full()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="generate-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(item)
+            self._cond.notify()
+        return item["future"]
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        """Snapshot of batching counters for /health"""
+        with self._stats_lock:
+            batches, prompts, tokens, busy = self._batches, self._prompts, self._new_tokens, self._busy_seconds
+            rejected, cancelled = self._rejected, self._cancelled
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queue_depth(),
+            "batches": batches,
+            "prompts": prompts,
+            "rejected": rejected,
+            "cancelled": cancelled,
+            "avg_batch_size": round(prompts / batches, 2) if batches else 0.0,
+            "tokens_per_sec": round(tokens / busy, 2) if busy > 0 else 0.0,
+        }
+
+    def _reject_if_full(self):
+        """Raise Overloaded if max_queue prompts are already waiting (call with _cond held)"""
+        queued = len(self._pending)
+        if not self.max_queue or queued < self.max_queue:
+            return
+        with self._stats_lock:
+            self._rejected += 1
+            avg_batch_seconds = self._busy_seconds / self._batches if self._batches else None
+        metrics.inc("rejected_total")
+        raise Overloaded(retry_after_seconds(queued, self.max_batch_size, avg_batch_seconds))
+
+    def _cancel(self, item, stage):
+        reason = item["cancel"].reason
+        with self._stats_lock:
+            self._cancelled += 1
+        metrics.inc("cancelled_total", reason=reason, stage=stage)
+        item["future"].set_exception(RequestCancelled(reason))
+
+    def _next_batch(self):
+        """Block until a group is full or its oldest prompt's wait window has expired"""
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+                head = self._pending[0]
+                group = [p for p in self._pending if p["key"] == head["key"]]
+                remaining = head["enqueued_at"] + self.max_wait - time.monotonic()
+                if len(group) >= self.max_batch_size or remaining <= 0:
+                    batch = group[:self.max_batch_size]
+                    taken = {id(p) for p in batch}
+                    self._pending = [p for p in self._pending if id(p) not in taken]
+                    return batch
+                self._cond.wait(remaining)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self._execute(batch)
+
+    def _execute(self, batch):
+        # Prompts cancelled while queued never reach the model
+        live = []
+        for item in batch:
+            if item["cancel"] is not None and item["cancel"].cancelled:
+                self._cancel(item, "queued")
             else:
-                print(f"⚠️ [REC] Parsed JSON but got empty or invalid list")
-        else:
-            print(f"⚠️ [REC] Could not find JSON array in response")
+                live.append(item)
+        if not live:
+            return
+        batch = live
+        head = batch[0]
+        log.debug(f"🔄 [REC] Generating batch of {len(batch)} prompt(s) (KV cache: {head['kv_cache']})")
+        start = time.time()
+        try:
+            results = generate_tokens_batch(
+                head["model"], head["tokenizer"], [item["prompt_suffix"] for item in batch], head["device"],
+                kv_cache=head["kv_cache"],
+                constraints=[item["constraint"] for item in batch],
+                streamers=[item["streamer"] for item in batch],
+                cancels=[item["cancel"] for item in batch],
+                prefix_text=head["prefix_text"],
+                **head["generate_kwargs"]
+            )
+        except Exception as e:
+            for item in batch:
+                item["future"].set_exception(e)
+            return
+        with self._stats_lock:
+            self._batches += 1
+            self._prompts += len(batch)
+            self._new_tokens += sum(stats["new_tokens"] for _, stats in results)
+            self._busy_seconds += time.time() - start
+        for item, result in zip(batch, results):
+            # A row cut short by its cancellation holds a truncated answer
+            if item["cancel"] is not None and item["cancel"].reason is not None:
+                self._cancel(item, "decoding")
+            else:
+                item["future"].set_result(result)
+
+
+generation_scheduler = GenerationScheduler(GENERATION_BATCH_MAX_SIZE, GENERATION_BATCH_MAX_WAIT_MS, MAX_QUEUE)
+
+def generate_recommendations(user_data, hairstyle_options, model, tokenizer, stats=None, on_token=None, catalog=None,
+                             cancel=None):
+    """
+    Generate hairstyle recommendations using the language model
+    
+    Args:
+        hairstyle_options: Pre-ranked candidate hairstyles
+        stats: Optional dict, filled with the generation stats (tokens, tokens/sec, KV cache mode)
+        on_token: Optional callback(token_id) for streaming
+        catalog: Registered CatalogEntry the options come from (reuses its precomputed prompt lines)
+        cancel: Optional Cancellation of the request
+    
+    Raises:
+        Overloaded if the generation queue is full, RequestCancelled if cancel fires
+    """
+    
+    if catalog is not None:
+        prompt_suffix = catalog.prompt_suffix(user_data, hairstyle_options, tokenizer)
+    else:
+        prompt_suffix = build_recommendation_suffix(user_data, hairstyle_options)
+    generate_kwargs = dict(
+        max_new_tokens=500,
+        temperature=0.7,
+        do_sample=True,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    constraint = RecommendationConstraint(tokenizer, hairstyle_options) if CONSTRAINED_DECODING else None
+
+    try:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        log.debug(f"🔄 [REC] Using device: {device}")
+        
+        # Generate response
+        log.debug(f"🔄 [REC] Generating recommendations (KV cache: {KV_CACHE_MODE})...")
+        try:
+            new_tokens, generation = wait_result(generation_scheduler.submit(
+                model, tokenizer, prompt_suffix, device, constraint=constraint, streamer=on_token, cancel=cancel,
+                **generate_kwargs), cancel)
+        except (Overloaded, RequestCancelled):
+            raise
+        except Exception as e:
+            if KV_CACHE_MODE == "off":
+                raise
+            # Some remote-code models do not support the cache API; fall back to plain decoding
+            log.warning(f"⚠️ [REC] Cached generation failed ({e}), retrying without KV cache")
+            metrics.inc("generation_retries_total")
+            if constraint is not None:
+                constraint.reset()
+            if on_token is not None:
+                on_token.restart()
+            new_tokens, generation = wait_result(generation_scheduler.submit(
+                model, tokenizer, prompt_suffix, device, constraint=constraint, kv_cache="off", streamer=on_token,
+                cancel=cancel, **generate_kwargs), cancel)
+        
+        generation["constrained"] = constraint is not None
+        if stats is not None:
+            stats.update(generation)
+        log.info(f"🔄 [REC] ✅ Generation complete in {generation['seconds']:.2f} seconds "
+                 f"({generation['new_tokens']} tokens, {generation['tokens_per_sec']} tokens/sec, "
+                 f"{generation['prefix_tokens_reused']}/{generation['prompt_tokens']} prompt tokens from cache)")
+        
+        # Decode only the generated tokens (the prompt's JSON example would confuse extraction)
+        log.debug("🔄 [REC] Decoding model response...")
+        with metrics.time("stage_seconds", stage="decode"):
+            response_text = tokenizer.decode(new_tokens, skip_special_tokens=True)
+        log.debug(f"🔄 [REC] Response length: {len(response_text)} characters")
+        log.debug("🔄 [REC] Response preview: %s...", response_text[:200])
+        
+        with metrics.time("stage_seconds", stage="parse"):
+            recommendations = extract_recommendations_json(response_text)
+        if recommendations:
+            return recommendations
         
         # If JSON parsing failed, return None
-        print("⚠️ [REC] Could not parse model response as JSON")
-        print(f"⚠️ [REC] Full response (first 1000 chars): {response_text[:1000]}")
+        log.warning("⚠️ [REC] Could not parse model response as JSON")
+        log.warning(f"⚠️ [REC] Full response (first 1000 chars): {response_text[:1000]}")
         return None
         
+    except (Overloaded, RequestCancelled):
+        raise
     except Exception as e:
-        print(f"❌ [REC] Error generating recommendations: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ [REC] Error generating recommendations: {e}")
         return None
 
+def compute_recommendations(user_data, hairstyle_options, fingerprint, model, tokenizer, on_recommendation=None,
+                            catalog=None, cancel=None):
+    """
+    Pre-rank the catalog and generate recommendations for one request
+    
+    Args:
+        on_recommendation: Optional callback(recommendation) called as each object is generated
+        catalog: Registered CatalogEntry for hairstyle_options, if any
+        cancel: Optional Cancellation of the request
+    
+    Returns:
+        Dict with recommendations (None on failure), prerank and generation stats
+    """
+    # Pre-rank the full catalog, then let the model choose among the top-K
+    candidates, prerank = prerank_catalog(user_data, hairstyle_options, fingerprint=fingerprint,
+                                          index=catalog.index if catalog is not None else None)
+    prerank_scores = {str(entry["id"]): entry["score"] for entry in prerank["scores"]}
+    
+    def add_prerank_score(rec):
+        if isinstance(rec, dict) and str(rec.get('id')) in prerank_scores:
+            rec["prerankScore"] = prerank_scores[str(rec.get('id'))]
+        return rec
+    
+    on_token = None
+    if on_recommendation is not None:
+        on_token = TokenTextStream(tokenizer, lambda rec: on_recommendation(add_prerank_score(rec)))
+    
+    # Generate recommendations
+    generation = {}
+    recommendations = generate_recommendations(user_data, candidates, model, tokenizer, stats=generation, on_token=on_token,
+                                               catalog=catalog, cancel=cancel)
+    if recommendations:
+        for rec in recommendations:
+            add_prerank_score(rec)
+    return {"recommendations": recommendations, "prerank": prerank, "generation": generation}
+
+def build_explanation_suffix(user_data, style):
+    """User-specific part of the explanation prompt: one profile line and one hairstyle"""
+    profile = canonical_user_data(user_data)
+    preferences = ', '.join(profile["stylePreferences"]) or 'none'
+    return (f"\nUser Profile: face shape {profile['faceShape'] or 'unknown'}, skin tone {profile['skinTone'] or 'unknown'}, "
+            f"hair type {profile['hairType'] or 'any'}, preferred length {profile['hairLength'] or 'any'}, "
+            f"style preferences {preferences}\n"
+            f"Hairstyle: {style.get('name')} ({style.get('category', 'N/A')}, {style.get('hairType', 'N/A')} hair, "
+            f"tags: {', '.join(style.get('styleTags', [])) or 'none'})\n"
+            f"Explanation:")
+
+def explanation_cache_key(user_data, style, model_path):
+    """Cache key for one style's explanation: the profile attributes, the style's prompt-relevant fields and the model"""
+    style_fields = [style.get('id'), style.get('name'), style.get('category'), style.get('hairType'),
+                    sorted(style.get('styleTags', []))]
+    payload = json.dumps([canonical_user_data(user_data), style_fields, model_path], sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class StopAtLineEnd:
+    """Pass-through logits processor whose stopping criterion ends a row once it has written a full line"""
+    
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.prompt_len = None
+    
+    def __call__(self, input_ids, scores):
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1]
+        return scores
+    
+    def stopping_criteria(self):
+        def is_done(input_ids, scores, **kwargs):
+            text = self.tokenizer.decode(input_ids[0, self.prompt_len:], skip_special_tokens=True)
+            return torch.tensor([("\n" in text.lstrip())], dtype=torch.bool, device=input_ids.device)
+        return is_done
+
+
+explanation_cache = RecommendationCache(EXPLANATION_CACHE_MAX_ENTRIES, EXPLANATION_CACHE_TTL_SECONDS, EXPLANATION_CACHE_FILE)
+explanation_executor = ThreadPoolExecutor(max_workers=EXPLANATION_WORKERS, thread_name_prefix="explain")
+
+def generate_explanation(user_data, style, model, tokenizer):
+    """Short, length-capped explanation for one style (greedy, so the cached text is reproducible)"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    new_tokens, _ = generation_scheduler.submit(
+        model, tokenizer, build_explanation_suffix(user_data, style), device,
+        constraint=StopAtLineEnd(tokenizer),
+        prefix_text=EXPLANATION_PROMPT_PREFIX,
+        max_new_tokens=SHORT_EXPLANATION_MAX_TOKENS,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+    ).result()
+    text = tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+    return text.split("\n")[0].strip() or None
+
+def explain_styles(user_data, styles, model, tokenizer, wait=True):
+    """
+    Explanations for several styles: cached ones right away, the rest generated concurrently
+    (so the scheduler runs them as one batch)
+    
+    Args:
+        wait: If False, start generating the missing explanations in the background and return
+    
+    Returns:
+        (explanations, counts) - explanations maps str(style id) to text, None while pending or on failure
+    """
+    explanations = {}
+    futures = {}
+    counts = {"cached": 0, "generated": 0, "pending": 0, "failed": 0}
+    for style in styles:
+        style_id = str(style.get('id'))
+        key = explanation_cache_key(user_data, style, model_identity())
+        cached = explanation_cache.get(key)
+        if cached is not None:
+            explanations[style_id] = cached
+            counts["cached"] += 1
+            continue
+        futures[style_id] = explanation_executor.submit(
+            explanation_cache.get_or_compute, key,
+            lambda style=style: generate_explanation(user_data, style, model, tokenizer), bool)
+    
+    for style_id, future in futures.items():
+        if not wait:
+            explanations[style_id] = None
+            counts["pending"] += 1
+            continue
+        try:
+            text, _ = future.result()
+        except Exception as e:
+            log.warning(f"⚠️ [REC] Explanation for style {style_id} failed: {e}")
+            text = None
+        explanations[style_id] = text
+        counts["generated" if text else "failed"] += 1
+    return explanations, counts
+
+def rank_recommendations(user_data, hairstyle_options, catalog=None):
+    """
+    Deterministic top picks from the pre-ranking scorer, without the language model
+    
+    Returns:
+        (recommendations, candidates, prerank) - recommendations have id, name, matchScore and
+        prerankScore; candidates are the matching catalog styles
+    """
+    candidates, prerank = prerank_catalog(
+        user_data, hairstyle_options, top_k=RECOMMENDATION_COUNT,
+        fingerprint=catalog.fingerprint if catalog is not None else None,
+        index=catalog.index if catalog is not None else None)
+    recommendations = [
+        {
+            "id": style.get('id'),
+            "name": style.get('name'),
+            "matchScore": int(round(entry["score"])),
+            "prerankScore": entry["score"],
+            "whyRecommendation": None,
+        }
+        for style, entry in zip(candidates, prerank["scores"])
+    ]
+    return recommendations, candidates, prerank
+
+def recommend_ranked(data, user_data, catalog, hairstyle_options):
+    """
+    /recommend with mode='rank': picks come from the scorer in milliseconds; 'explain' chooses
+    whether to wait for the short explanations ('wait', default), start them in the background
+    ('defer', fetch them later from /recommend/explanations) or skip them ('none')
+    """
+    start = time.perf_counter()
+    explain = data.get('explain', 'wait')
+    if explain not in ('wait', 'defer', 'none'):
+        return jsonify({"error": "explain must be 'wait', 'defer' or 'none'"}), 400
+    
+    recommendations, candidates, prerank = rank_recommendations(user_data, hairstyle_options, catalog)
+    ranking_ms = (time.perf_counter() - start) * 1000
+    log.info(f"✅ [REC] Ranked {len(recommendations)} recommendations in {ranking_ms:.2f}ms (explain={explain})")
+    
+    counts = None
+    if explain == 'wait' or (explain == 'defer' and model is not None):
+        current_model, current_tokenizer = load_model(model_path=data.get('model_path'), github_token=data.get('github_token'))
+        if current_model is not None and current_tokenizer is not None:
+            explanations, counts = explain_styles(user_data, candidates, current_model, current_tokenizer,
+                                                  wait=(explain == 'wait'))
+            for rec in recommendations:
+                rec["whyRecommendation"] = explanations.get(str(rec["id"]))
+    
+    return jsonify({
+        "success": True,
+        "recommendations": recommendations,
+        "source": "ranking",
+        "mode": "rank",
+        "model": model_source if counts is not None else None,
+        "prerank": prerank,
+        "explanations": {"mode": explain, **(counts or {})},
+        "timing": {
+            "ranking_ms": round(ranking_ms, 3),
+            "total_ms": round((time.perf_counter() - start) * 1000, 3)
+        }
+    })
+
+startup_state = StartupState()
+
+# Dummy request for the startup warm-up (never cached or returned)
+WARMUP_USER = {"faceShape": "oval", "skinTone": {"label": "medium"}, "hairLength": "medium", "hairType": "wavy",
+               "stylePreferences": ["modern"]}
+WARMUP_CATALOG = [
+    {"id": i, "name": f"Warm-up Style {i}", "category": "medium", "hairType": "wavy", "styleTags": ["modern"]}
+    for i in range(1, RECOMMENDATION_COUNT + 2)
+]
+
+def request_timeout(data):
+    """Deadline in seconds from the request's optional 'timeoutMs' (default RECOMMEND_REQUEST_TIMEOUT_SECONDS)"""
+    timeout_ms = data.get('timeoutMs')
+    return float(timeout_ms) / 1000.0 if timeout_ms not in (None, '') else REQUEST_TIMEOUT_SECONDS
+
+def warm_up(model, tokenizer):
+    """
+    Run a short dummy generation of each prompt kind through the generation scheduler: this
+    prefills the prefix KV caches, builds the constrained-decoding token masks and warms
+    the kernels and allocator, so the first real request does not pay for any of it
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    constraint = RecommendationConstraint(tokenizer, WARMUP_CATALOG) if CONSTRAINED_DECODING else None
+    kwargs = dict(max_new_tokens=WARMUP_MAX_NEW_TOKENS, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+    futures = [
+        generation_scheduler.submit(model, tokenizer, build_recommendation_suffix(WARMUP_USER, WARMUP_CATALOG), device,
+                                    constraint=constraint, bounded=False, **kwargs),
+        generation_scheduler.submit(model, tokenizer, build_explanation_suffix(WARMUP_USER, WARMUP_CATALOG[0]), device,
+                                    constraint=StopAtLineEnd(tokenizer), prefix_text=EXPLANATION_PROMPT_PREFIX,
+                                    bounded=False, **kwargs),
+    ]
+    for future in futures:
+        future.result()
+
+def warm_start():
+    """Load the default model and warm it up, tracking progress in startup_state"""
+    try:
+        startup_state.enter("loading")
+        startup_model, startup_tokenizer = load_model()
+        startup_state.enter("warming")
+        warm_up(startup_model, startup_tokenizer)
+        startup_state.enter("ready")
+        timings = startup_state.stats()
+        log.info(f"⏱️ [REC] Ready in {timings['time_to_ready_seconds']:.1f}s "
+                 f"(load {timings['loading_seconds']:.1f}s, warm-up {timings['warming_seconds']:.1f}s)")
+    except Exception as e:
+        startup_state.fail(e)
+        log.warning(f"⚠️ [REC] Model will be loaded on first request: {e}")
+
+def generation_health():
+    """Aggregate generation counters for /health"""
+    with _generation_totals_lock:
+        totals = dict(generation_totals)
+    totals["seconds"] = round(totals["seconds"], 3)
+    totals["tokens_per_sec"] = round(totals["new_tokens"] / totals["seconds"], 2) if totals["seconds"] > 0 else 0.0
+    totals["kv_cache"] = KV_CACHE_MODE
+    totals["constrained"] = CONSTRAINED_DECODING
+    totals["prefixes_cached"] = len(_prefix_cache)
+    return totals
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    print("🏥 [REC] Health check requested")
+    log.debug("🏥 [REC] Health check requested")
     status = {
-        "status": "ok",
+        "status": "ok" if startup_state.ready else startup_state.phase,
         "service": "AI Recommendation Service",
         "model": model_source or "Not loaded yet",
         "device": "cuda" if torch.cuda.is_available() else "cpu",
         "model_loaded": model is not None,
-        "tokenizer_loaded": tokenizer is not None
+        "tokenizer_loaded": tokenizer is not None,
+        "precision": model_precision,
+        "rss_mb": process_rss_mb(),
+        "startup": startup_state.stats(),
+        "generation": generation_health(),
+        "batching": generation_scheduler.stats(),
+        "response_cache": response_cache.stats(),
+        "explanation_cache": explanation_cache.stats(),
+        "catalogs": {cid: [v["version"] for v in versions] for cid, versions in catalog_registry.describe().items()},
+        "workers": prefork.stats(units="tokens")
     }
-    print(f"🏥 [REC] Health status: {json.dumps(status, indent=2)}")
     return jsonify(status)
 
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness probe: the process is up and serving HTTP (the model may still be loading)"""
+    return jsonify({"status": "alive"})
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness probe: 200 once the default model is loaded and warmed up, 503 before"""
+    state = startup_state.stats()
+    return jsonify(state), 200 if state["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: requests, errors, fallbacks, queue depth, stage latencies, throughput"""
+    # Pre-fork mode: pool-wide series from shared memory; the rest are this worker's (labelled worker=N)
+    return Response(metrics.render() + prefork.render_metrics(metrics.namespace, units="tokens"),
+                    content_type=CONTENT_TYPE)
+
 @app.route('/recommend', methods=['POST'])
 def recommend():
     """Get AI-powered hairstyle recommendations"""
     try:
-        print("=" * 60)
-        print("🤖 [REC] ===== RECOMMENDATION REQUEST RECEIVED =====")
-        print("=" * 60)
+        log.debug("🤖 [REC] ===== RECOMMENDATION REQUEST RECEIVED =====")
         
         data = request.json
         
         if not data:
-            print("❌ [REC] ERROR: No data provided in request")
+            log.error("❌ [REC] ERROR: No data provided in request")
             return jsonify({"error": "No data provided"}), 400
         
-        print("✅ [REC] Request data received successfully")
+        log.debug("✅ [REC] Request data received successfully")
         
         user_data = data.get('userData')
-        hairstyle_options = data.get('hairstyleOptions', [])
         model_path = data.get('model_path')  # Optional: specify model
         github_token = data.get('github_token')  # Optional: GitHub token
         
         if not user_data:
-            print("❌ [REC] ERROR: userData is missing")
+            log.error("❌ [REC] ERROR: userData is missing")
             return jsonify({"error": "userData is required"}), 400
         
-        if not hairstyle_options or len(hairstyle_options) == 0:
-            print("❌ [REC] ERROR: hairstyleOptions is missing or empty")
-            return jsonify({"error": "hairstyleOptions is required"}), 400
+        # Registered catalog (catalogId + version) or inline hairstyleOptions
+        catalog, hairstyle_options, error = resolve_catalog(data)
+        if error:
+            log.error(f"❌ [REC] ERROR: {error[0]}")
+            return jsonify({"error": error[0]}), error[1]
+        if catalog is not None:
+            log.debug(f"✅ [REC] Using registered catalog {catalog.catalog_id}@{catalog.version}")
         
-        print(f"✅ [REC] User data received: {json.dumps(user_data, indent=2)}")
-        print(f"✅ [REC] Hairstyle options count: {len(hairstyle_options)}")
+        if data.get('mode') == 'rank':
+            return recommend_ranked(data, user_data, catalog, hairstyle_options)
+        
+        try:
+            timeout = request_timeout(data)
+        except (TypeError, ValueError):
+            return jsonify({"error": "timeoutMs must be a number"}), 400
+        
+        log.debug("✅ [REC] User data received: %s", user_data)
+        log.debug(f"✅ [REC] Hairstyle options count: {len(hairstyle_options)}")
         
         if model_path:
-            print(f"🔄 [REC] Using custom model: {model_path}")
+            log.debug(f"🔄 [REC] Using custom model: {model_path}")
             if 'github.com' in model_path or (github_token and model_path.count('/') == 1):
-                print(f"🔄 [REC] ✅✅✅ GITHUB MODEL DETECTED! Using GitHub repository!")
+                log.debug(f"🔄 [REC] ✅✅✅ GITHUB MODEL DETECTED! Using GitHub repository!")
         else:
-            print(f"🔄 [REC] Using default model (Hugging Face)")
+            log.debug(f"🔄 [REC] Using default model (Hugging Face)")
         
         if github_token:
-            print(f"🔑 [REC] GitHub token provided: {github_token[:20]}... (for GitHub models/private repos)")
+            log.debug(f"🔑 [REC] GitHub token provided: {github_token[:20]}... (for GitHub models/private repos)")
         else:
-            print(f"⚠️ [REC] No GitHub token provided - using public models only")
+            log.debug(f"⚠️ [REC] No GitHub token provided - using public models only")
         
         # Check if model is loaded
         if model is None or tokenizer is None:
-            print("⚠️ [REC] Model not loaded yet, loading now...")
+            log.info("⚠️ [REC] Model not loaded yet, loading now...")
         else:
-            print(f"✅ [REC] Model already loaded: {model_source}")
+            log.debug(f"✅ [REC] Model already loaded: {model_source}")
         
         # Load model if not already loaded
-        print("🔄 [REC] Loading/checking model...")
+        log.debug("🔄 [REC] Loading/checking model...")
         current_model, current_tokenizer = load_model(model_path=model_path, github_token=github_token)
         
         if current_model is None or current_tokenizer is None:
-            print("❌ [REC] ERROR: Failed to load model")
+            log.error("❌ [REC] ERROR: Failed to load model")
             return jsonify({
                 "success": False,
                 "error": "Failed to load model",
                 "recommendations": []
             }), 500
         
-        print("✅ [REC] Model loaded successfully!")
-        print(f"🔄 [REC] Generating recommendations...")
+        log.debug("✅ [REC] Model loaded successfully!")
+        log.debug(f"🔄 [REC] Generating recommendations...")
+        
+        fingerprint = catalog.fingerprint if catalog is not None else catalog_fingerprint(hairstyle_options)
+        cache_key = recommendation_cache_key(user_data, fingerprint, model_identity())
+        cancel = Cancellation.for_request(request.environ, timeout)
         
-        # Generate recommendations
-        recommendations = generate_recommendations(user_data, hairstyle_options, current_model, current_tokenizer)
+        result, cache_status = response_cache.get_or_compute(
+            cache_key,
+            lambda: compute_recommendations(user_data, hairstyle_options, fingerprint, current_model, current_tokenizer,
+                                            catalog=catalog, cancel=cancel),
+            cacheable=lambda value: bool(value["recommendations"]), cancel=cancel)
+        recommendations, prerank, generation = result["recommendations"], result["prerank"], result["generation"]
+        metrics.inc("response_cache_total", status=cache_status)
+        if cache_status != "miss":
+            log.debug(f"✅ [REC] Recommendation cache {cache_status} ({cache_key[:8]})")
         
         if recommendations:
-            print(f"✅ [REC] ✅✅✅ SUCCESS: Generated {len(recommendations)} ACTUAL AI RECOMMENDATIONS")
-            print(f"📊 [REC] Recommendations:")
+            log.debug(f"✅ [REC] ✅✅✅ SUCCESS: Generated {len(recommendations)} ACTUAL AI RECOMMENDATIONS")
+            log.debug(f"📊 [REC] Recommendations:")
             for i, rec in enumerate(recommendations, 1):
-                print(f"   {i}. ID: {rec.get('id')}, Name: {rec.get('name')}, Score: {rec.get('matchScore')}")
-                print(f"      Reason: {rec.get('whyRecommendation', 'N/A')}")
-            print("=" * 60)
-            print("✅ [REC] ✅✅✅ USING GITHUB/HUGGING FACE MODELS (NO OPENAI) ✅✅✅")
-            print("=" * 60)
+                log.debug(f"   {i}. ID: {rec.get('id')}, Name: {rec.get('name')}, Score: {rec.get('matchScore')}")
+                log.debug(f"      Reason: {rec.get('whyRecommendation', 'N/A')}")
+            log.debug("✅ [REC] ✅✅✅ USING GITHUB/HUGGING FACE MODELS (NO OPENAI) ✅✅✅")
             return jsonify({
                 "success": True,
                 "recommendations": recommendations,
                 "source": "local_ai_model",
-                "model": model_source
+                "model": model_source,
+                "prerank": prerank,
+                "generation": generation,
+                "cache": cache_status
             })
         else:
-            print("❌ [REC] ERROR: Failed to generate recommendations (model returned None)")
-            print("❌ [REC] ⚠️⚠️⚠️ WILL FALL BACK TO RULE-BASED RECOMMENDATIONS ⚠️⚠️⚠️")
-            print("=" * 60)
+            log.error("❌ [REC] ERROR: Failed to generate recommendations (model returned None)")
+            log.error("❌ [REC] ⚠️⚠️⚠️ WILL FALL BACK TO RULE-BASED RECOMMENDATIONS ⚠️⚠️⚠️")
+            metrics.inc("fallbacks_total", route="/recommend", reason="invalid_response")
             return jsonify({
                 "success": False,
                 "error": "Failed to generate recommendations - model returned invalid response",
                 "recommendations": [],
-                "will_fallback": True
+                "will_fallback": True,
+                "prerank": prerank,
+                "generation": generation,
+                "cache": cache_status
             }), 500
         
+    except (Overloaded, RequestCancelled) as e:
+        log.warning(f"⚠️ [REC] {e}")
+        return error_response(e)
     except Exception as e:
-        print(f"❌ [REC] Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ [REC] Error: {e}")
         return jsonify({
             "error": str(e),
             "details": "Failed to generate recommendations. Make sure the model is loaded correctly."
         }), 500
 
-if __name__ == '__main__':
-    print("🚀 [REC] Starting AI Recommendation Service...")
-    print("🚀 [REC] This service uses language models - 100% FREE!")
-    print("🚀 [REC] No API credits needed!")
+@app.route('/recommend/explanations', methods=['POST'])
+def recommend_explanations():
+    """
+    Short explanations for ranked picks (e.g. after /recommend with mode='rank', explain='defer')
+    Takes: {'userData', 'styleIds': [...], 'catalogId'/'version' or 'hairstyleOptions', 'model_path', 'github_token'}
+    """
+    data = request.get_json(silent=True) or {}
+    user_data = data.get('userData')
+    style_ids = data.get('styleIds')
+    if not user_data:
+        return jsonify({"error": "userData is required"}), 400
+    if not isinstance(style_ids, list) or not style_ids:
+        return jsonify({"error": "styleIds must be a non-empty list"}), 400
+    catalog, hairstyle_options, error = resolve_catalog(data)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    
+    by_id = {str(style.get('id')): style for style in hairstyle_options}
+    missing = [style_id for style_id in style_ids if str(style_id) not in by_id]
+    if missing:
+        return jsonify({"error": f"Unknown style ids: {missing}"}), 404
     
-    # Load model on startup (optional - can also lazy load)
     try:
-        load_model()
+        start = time.perf_counter()
+        current_model, current_tokenizer = load_model(model_path=data.get('model_path'), github_token=data.get('github_token'))
+        if current_model is None or current_tokenizer is None:
+            return jsonify({"success": False, "error": "Failed to load model"}), 500
+        explanations, counts = explain_styles(user_data, [by_id[str(style_id)] for style_id in style_ids],
+                                              current_model, current_tokenizer)
+        return jsonify({
+            "success": True,
+            "explanations": explanations,
+            "counts": counts,
+            "model": model_source,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3)
+        })
     except Exception as e:
-        print(f"⚠️ [REC] Model will be loaded on first request: {e}")
+        log.error(f"❌ [REC] Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/catalogs/<catalog_id>', methods=['PUT'])
+def put_catalog(catalog_id):
+    """
+    Register a hairstyle catalog version
+    Takes: {'hairstyles': [...], 'version': optional (defaults to the next integer)} or a bare list
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        data = {"hairstyles": data}
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON body with 'hairstyles' is required"}), 400
+    
+    try:
+        start = time.time()
+        entry, created = catalog_registry.put(catalog_id, data.get('hairstyles'), data.get('version'))
+    except ValueError as e:
+        status = 409 if "already exists" in str(e) else 400
+        return jsonify({"error": str(e)}), status
+    
+    if created:
+        log.info(f"📚 [REC] Registered catalog {catalog_id}@{entry.version} ({len(entry.styles)} styles) "
+                 f"in {time.time() - start:.2f}s")
+        # Tokenize the prompt lines now rather than on the first request
+        if tokenizer is not None:
+            entry.line_token_ids(tokenizer)
+    return jsonify({**entry.describe(), "created": created}), 201 if created else 200
+
+@app.route('/catalogs/<catalog_id>', methods=['GET'])
+def get_catalog(catalog_id):
+    """Registered versions of a catalog (metadata only)"""
+    versions = catalog_registry.describe(catalog_id)[catalog_id]
+    if not versions:
+        return jsonify({"error": f"Unknown catalog {catalog_id}"}), 404
+    return jsonify({"catalogId": catalog_id, "versions": versions})
+
+@app.route('/recommend/stream', methods=['POST'])
+def recommend_stream():
+    """
+    Streaming variant of /recommend (Server-Sent Events)
+    Takes: same body as /recommend
+    Emits: a 'recommendation' event as soon as each recommendation object is generated,
+    then a final 'result' event with the /recommend response plus time-to-first-recommendation
+    """
+    data = request.get_json(silent=True) or {}
+    user_data = data.get('userData')
+    if not user_data:
+        return jsonify({"error": "userData is required"}), 400
+    catalog, hairstyle_options, error = resolve_catalog(data)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    try:
+        timeout = request_timeout(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "timeoutMs must be a number"}), 400
+    
+    # Closing the event stream (client gone) also cancels the generation
+    cancel = Cancellation.for_request(request.environ, timeout)
+    events = queue.Queue()
+    
+    def worker():
+        start = time.perf_counter()
+        streamed = []
+        
+        def emit(rec):
+            if len(streamed) >= RECOMMENDATION_COUNT:
+                return
+            streamed.append(time.perf_counter() - start)
+            events.put(("recommendation", {
+                "index": len(streamed) - 1,
+                "recommendation": rec,
+                "elapsed_ms": round(streamed[-1] * 1000, 1)
+            }))
+        
+        try:
+            current_model, current_tokenizer = load_model(model_path=data.get('model_path'), github_token=data.get('github_token'))
+            if current_model is None or current_tokenizer is None:
+                metrics.inc("fallbacks_total", route="/recommend/stream", reason="model_load")
+                events.put(("error", {"success": False, "error": "Failed to load model", "will_fallback": True}))
+                return
+            fingerprint = catalog.fingerprint if catalog is not None else catalog_fingerprint(hairstyle_options)
+            cache_key = recommendation_cache_key(user_data, fingerprint, model_identity())
+            result, cache_status = response_cache.get_or_compute(
+                cache_key,
+                lambda: compute_recommendations(user_data, hairstyle_options, fingerprint, current_model,
+                                                current_tokenizer, on_recommendation=emit, catalog=catalog,
+                                                cancel=cancel),
+                cacheable=lambda value: bool(value["recommendations"]), cancel=cancel)
+            recommendations = result["recommendations"]
+            metrics.inc("response_cache_total", status=cache_status)
+            if cache_status != "miss":
+                # Nothing was generated for this request; send the cached objects right away
+                for rec in recommendations or []:
+                    emit(rec)
+            
+            total = time.perf_counter() - start
+            body = {
+                "success": bool(recommendations),
+                "recommendations": recommendations or [],
+                "source": "local_ai_model",
+                "model": model_source,
+                "prerank": result["prerank"],
+                "generation": result["generation"],
+                "cache": cache_status,
+                "timing": {
+                    "time_to_first_recommendation_ms": round(streamed[0] * 1000, 1) if streamed else None,
+                    "total_ms": round(total * 1000, 1)
+                }
+            }
+            if not recommendations:
+                body["error"] = "Failed to generate recommendations - model returned invalid response"
+                body["will_fallback"] = True
+                metrics.inc("fallbacks_total", route="/recommend/stream", reason="invalid_response")
+            log.info(f"✅ [REC] Stream finished in {total:.2f}s, first recommendation after "
+                     f"{body['timing']['time_to_first_recommendation_ms']}ms")
+            events.put(("result", body))
+        except (Overloaded, RequestCancelled) as e:
+            log.warning(f"⚠️ [REC] {e}")
+            events.put(("error", {"success": False, "error": str(e), "cancelled": getattr(e, "reason", None),
+                                  "retry_after": getattr(e, "retry_after", None)}))
+        except Exception as e:
+            log.exception(f"❌ [REC] Error: {e}")
+            metrics.inc("fallbacks_total", route="/recommend/stream", reason="error")
+            events.put(("error", {"success": False, "error": str(e), "will_fallback": True}))
+    
+    def stream():
+        threading.Thread(target=worker, name="recommend-stream", daemon=True).start()
+        try:
+            while True:
+                event, payload = events.get()
+                yield sse_event(event, payload)
+                if event in ("result", "error"):
+                    break
+        finally:
+            # Runs on GeneratorExit when the client disconnects mid-stream
+            cancel.cancel()
+    
+    log.debug("🤖 [REC] ===== STREAMING RECOMMENDATION REQUEST RECEIVED =====")
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+if __name__ == '__main__':
+    log.info("🚀 [REC] Starting AI Recommendation Service...")
+    log.info("🚀 [REC] This service uses language models - 100% FREE!")
+    log.info("🚀 [REC] No API credits needed!")
+    
+    if len(sys.argv) == 3 and sys.argv[1] == '--save-snapshot':
+        save_snapshot(sys.argv[2])
+        sys.exit(0)
+    
+    prefork_mode = WORKERS > 1 and not torch.cuda.is_available()
+    if WORKERS > 1 and not prefork_mode:
+        log.warning("⚠️ [REC] RECOMMEND_WORKERS ignored: CUDA cannot be shared across forked workers")
+    
+    # Load and warm up the model on startup: in the background while the server already answers
+    # /health/live, or before serving with RECOMMEND_BACKGROUND_LOAD=0
+    if prefork_mode:
+        # Load once before forking so every worker shares the weights; each worker warms up itself
+        try:
+            startup_state.enter("loading")
+            load_model()
+        except Exception as e:
+            log.warning(f"⚠️ [REC] Pre-fork load failed, each worker will load its own copy: {e}")
+    elif BACKGROUND_LOAD:
+        threading.Thread(target=warm_start, name="warm-start", daemon=True).start()
+    else:
+        warm_start()
     
     # Run on port 5001 (different from image editor on 5000)
     port = int(os.environ.get('PORT', 5001))
-    print(f"🌐 [REC] Server starting on http://localhost:{port}")
-    print(f"🌐 [REC] Health check: http://localhost:{port}/health")
-    print(f"🌐 [REC] Recommend endpoint: http://localhost:{port}/recommend")
+    log.info(f"🌐 [REC] Server starting on http://localhost:{port}")
+    log.info(f"🌐 [REC] Health check: http://localhost:{port}/health")
+    log.info(f"🌐 [REC] Probes: http://localhost:{port}/health/live, http://localhost:{port}/health/ready")
+    log.info(f"🌐 [REC] Recommend endpoint: http://localhost:{port}/recommend")
+    log.info(f"🌐 [REC] Streaming endpoint: http://localhost:{port}/recommend/stream")
+    log.info(f"🌐 [REC] Metrics: http://localhost:{port}/metrics (log level: {os.environ.get('RECOMMEND_LOG_LEVEL', 'INFO')})")
+    log.info(f"🚦 [REC] Admission control: max queue {MAX_QUEUE or 'unbounded'}, default deadline "
+             f"{f'{REQUEST_TIMEOUT_SECONDS:g}s' if REQUEST_TIMEOUT_SECONDS else 'none'} "
+             "(RECOMMEND_MAX_QUEUE / RECOMMEND_REQUEST_TIMEOUT_SECONDS)")
     
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if prefork_mode:
+        prefork.serve(app, '0.0.0.0', port, WORKERS, WORKER_THREADS, log=log, tag="[REC]",
+                      on_worker_start=warm_start, units="tokens", metrics=metrics)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Metrics and logging shared by the local AI services
+Prometheus text-format metrics for GET /metrics (no client library needed), and a level-gated
+logger whose records are written by a background thread so request threads never block on stdout.
+"""
+
+import os
+import sys
+import time
+import math
+import queue
+import atexit
+import bisect
+import logging
+import logging.handlers
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Latency buckets in seconds: from sub-millisecond parsing up to multi-minute model loads
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def create_logger(name, level="INFO"):
+    """
+    Logger for one service
+    Records below `level` cost only the level check. The rest are queued and written to
+    stdout by a listener thread, so a slow terminal or pipe never stalls a request.
+    """
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    queue_handler = logging.handlers.QueueHandler(records)
+    logger.addHandler(queue_handler)
+
+    def restart_in_child():
+        # Threads do not survive fork: give a forked worker its own queue and writer thread
+        queue_handler.queue = listener.queue = queue.SimpleQueue()
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    logger.setLevel(str(level).upper())
+    logger.propagate = False
+    return logger
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    In-process registry of counters, gauges and histograms, rendered in the Prometheus text format.
+
+    Metrics are declared once with their help text and then updated by name with label keyword
+    arguments. A gauge may instead be given a callable, which is evaluated on every scrape.
+    constant_labels are added to every rendered sample (e.g. the worker of a pre-forked process).
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.constant_labels = ()
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._declare(name, "counter", help_text)
+
+    def gauge(self, name, help_text, value=None):
+        """Declare a gauge; `value`, if given, is a callable returning the current value"""
+        self._declare(name, "gauge", help_text, collect=value)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._declare(name, "histogram", help_text, buckets=tuple(sorted(buckets)))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._metrics[name]["samples"]
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._metrics[name]["samples"][key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics[name]
+            sample = metric["samples"].get(key)
+            if sample is None:
+                sample = metric["samples"][key] = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(metric["buckets"], value)
+            if index < len(metric["buckets"]):
+                sample["buckets"][index] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the with-block (in seconds) in histogram `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = [(name, metric["type"], metric["help"], metric.get("buckets"), metric.get("collect"),
+                        {key: dict(sample, buckets=list(sample["buckets"])) if isinstance(sample, dict) else sample
+                         for key, sample in metric["samples"].items()})
+                       for name, metric in self._metrics.items()]
+
+        lines = []
+        for name, metric_type, help_text, buckets, collect, samples in metrics:
+            full_name = f"{self.namespace}_{name}"
+            if collect is not None:
+                try:
+                    samples = {(): collect()}
+                except Exception:
+                    continue
+            if self.constant_labels:
+                samples = {self.constant_labels + key: sample for key, sample in samples.items()}
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            for key, sample in samples.items():
+                if metric_type != "histogram":
+                    lines.append(f"{full_name}{_format_labels(key)} {_format_value(sample)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, sample["buckets"]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels(key + (('le', _format_value(float(bound))),))} "
+                                 f"{cumulative}")
+                lines.append(f"{full_name}_bucket{_format_labels(key + (('le', '+Inf'),))} {sample['count']}")
+                lines.append(f"{full_name}_sum{_format_labels(key)} {_format_value(sample['sum'])}")
+                lines.append(f"{full_name}_count{_format_labels(key)} {sample['count']}")
+        return "\n".join(lines) + "\n"
+
+    def _declare(self, name, metric_type, help_text, **extra):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = {"type": metric_type, "help": help_text, "samples": {}, **extra}
+
+
+def instrument_app(app, metrics):
+    """
+    Count and time every request of a Flask app by route and status
+    Declares requests_total, errors_total (5xx responses) and request_seconds on `metrics`.
+    """
+    from flask import g, request
+
+    metrics.counter("requests_total", "HTTP requests by route, method and status code")
+    metrics.counter("errors_total", "HTTP requests that failed with a 5xx status, by route")
+    metrics.histogram("request_seconds", "HTTP request latency by route (until the response starts)")
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        # Route templates (e.g. /edit-jobs/<job_id>) keep the label set bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.inc("requests_total", route=route, method=request.method, status=str(response.status_code))
+        if response.status_code >= 500:
+            metrics.inc("errors_total", route=route)
+        start = g.get("metrics_start")
+        if start is not None:
+            metrics.observe("request_seconds", time.perf_counter() - start, route=route)
+        return response
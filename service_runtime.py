@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Startup and streaming helpers shared by the local AI services
+Local snapshot loading options, the cold-start state behind /health/live and /health/ready,
+and Server-Sent Event formatting for the streaming routes.
+"""
+
+import os
+import glob
+import json
+import time
+import threading
+
+
+def local_snapshot_kwargs(model_path, snapshot_dir=None):
+    """
+    from_pretrained kwargs for a local model directory: files are never resolved against the hub,
+    and the configured snapshot (snapshot_dir) must hold safetensors weights (memory-mapped instead
+    of unpickled)
+    """
+    if not os.path.isdir(model_path):
+        return {}
+    kwargs = {"local_files_only": True}
+    if snapshot_dir and os.path.abspath(model_path) == os.path.abspath(snapshot_dir):
+        if not glob.glob(os.path.join(model_path, '**', '*.safetensors'), recursive=True):
+            raise FileNotFoundError(f"No .safetensors weights in snapshot directory {model_path}")
+        kwargs["use_safetensors"] = True
+    return kwargs
+
+
+class StartupState:
+    """
+    Cold-start progress: starting -> loading -> warming -> ready, or failed.
+
+    Liveness only needs the HTTP server to answer. Readiness waits for the default model
+    to be loaded and warmed, so orchestrators only route traffic to a warm replica.
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self.error = None
+        self.started_at = time.monotonic()
+        self._phase_started = self.started_at
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.phase == "ready"
+
+    def enter(self, phase):
+        with self._lock:
+            now = time.monotonic()
+            self._timings[f"{self.phase}_seconds"] = round(now - self._phase_started, 3)
+            self.phase, self._phase_started = phase, now
+            if phase == "ready":
+                self._timings["time_to_ready_seconds"] = round(now - self.started_at, 3)
+
+    def fail(self, error):
+        with self._lock:
+            self.phase, self.error = "failed", str(error)
+
+    def stats(self):
+        with self._lock:
+            status = {"phase": self.phase, "ready": self.phase == "ready", **self._timings}
+            if self.error:
+                status["error"] = self.error
+            return status
+
+
+def sse_event(event, payload):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"